@@ -1,10 +1,14 @@
+import asyncio
 import os
 import random
 import string
+import threading
 import time
-from typing import Optional, Any, Callable
+import tracemalloc
+from typing import Optional, Any, Callable, BinaryIO
 
 from my_collection import buffer_db
+from my_collection.buffer_db import bench
 
 
 def random_string(min_length: int, max_length: int) -> str:
@@ -12,39 +16,62 @@ def random_string(min_length: int, max_length: int) -> str:
     return "".join(random.choices(string.ascii_uppercase + string.digits, k=length))
 
 
-def p(p: int, handle: Callable, *data: Any):
-    num_rounds = len(data[0])
-    sort = [0.0 for _ in range(int(num_rounds * (100 - p) / 100))]
-    for i in range(num_rounds):
-        args = [data[j][i] for j in range(len(data))]
-        t0 = time.perf_counter()
+def p(p: int, handle: Callable, *data: Any) -> float:
+    """
+    p-th percentile latency in seconds of handle over data
+    """
+    hist = bench.Histogram()
+    for args in zip(*data):
+        t0 = time.perf_counter_ns()
         handle(*args)
-        t1 = time.perf_counter()
-        dt = t1 - t0
-        if dt < sort[0]:
-            continue
-        for k in range(len(sort)):
-            if sort[k] <= dt:
-                sort[:k] = sort[1:k + 1]
-                sort[k] = dt
-                break
-    return sort[0]
-
-
-def main(path: Optional[str] = "data.db", p_count: int = 95):
+        t1 = time.perf_counter_ns()
+        hist.record(t1 - t0)
+    return hist.percentile(p) / 1e9
+
+
+def open_file(path: str) -> BinaryIO:
+    if not os.path.exists(path):
+        open(path, "wb").close()
+    # r : open for reading
+    # + : open a disk file for updating (reading and writing)
+    # b : binary mode
+    return open(path, "r+b")
+
+
+def main(path: Optional[str] = "data.db", p_count: int = 95, use_mmap: bool = False,
+         wal_path: Optional[str] = None, group_commit_latency: float = 0.0, use_batch: bool = False,
+         compress_threshold: Optional[int] = None, slab_threshold: Optional[int] = None, cache_size: int = 0,
+         num_shards: int = 1):
+    def shard_path(base: str, i: int) -> str:
+        return base if num_shards == 1 else f"{base}.{i}"
+
     if path is None:
-        file = buffer_db.Buffer()
+        file_list = [buffer_db.Buffer() for _ in range(num_shards)]
     else:
-        if not os.path.exists(path):
-            open(path, "wb").close()
-        # r : open for reading
-        # + : open a disk file for updating (reading and writing)
-        # b : binary mode
-        file = open(path, "r+b")
+        file_list = [open_file(shard_path(path, i)) for i in range(num_shards)]
+    wal_file_list = None
+    if wal_path is not None:
+        wal_file_list = [open_file(shard_path(wal_path, i)) for i in range(num_shards)]
 
-    db = buffer_db.DB(file=file, block_size=32 * 1024)
+    if num_shards == 1:
+        db = buffer_db.DB(
+            file=file_list[0], block_size=32 * 1024, use_mmap=use_mmap,
+            wal_file=None if wal_file_list is None else wal_file_list[0], group_commit_latency=group_commit_latency,
+            compress_threshold=compress_threshold, slab_threshold=slab_threshold, cache_size=cache_size,
+        )
+        backend = type(db.ctx.file).__name__
+    else:
+        db = buffer_db.ShardedDB(
+            file_list=file_list, block_size=32 * 1024, use_mmap=use_mmap,
+            wal_file_list=wal_file_list, group_commit_latency=group_commit_latency,
+            compress_threshold=compress_threshold, slab_threshold=slab_threshold, cache_size=cache_size,
+        )
+        backend = type(db.db_list[0].ctx.file).__name__
 
     with db.context() as ctx:
+        print(f"backend: {backend}, shards: {num_shards}, wal: {wal_path}, "
+              f"group commit latency: {group_commit_latency}, batch: {use_batch}, "
+              f"compress threshold: {compress_threshold}, slab threshold: {slab_threshold}, cache size: {cache_size}")
         print(f"stats: {db.stats()}")
 
         max_length = 64 * 1024
@@ -55,31 +82,201 @@ def main(path: Optional[str] = "data.db", p_count: int = 95):
         delete1_keys = random.choices(write1_keys, k=len(write1_keys) // 2)
         write2_keys = random.choices(write1_keys, k=len(write1_keys) // 2) + list(range(2 * num_keys // 3, num_keys))
         read1_keys = range(num_keys)
+        read2_keys = random.choices(range(num_keys // 10), k=num_keys)  # hot keys
 
         # write 8000 keys
         val_list = [random_string(min_length, max_length).encode("utf-8") for _ in range(len(write1_keys))]
-        p_val = p(p_count, ctx.write, [f"key_{k}" for k in write1_keys], val_list)
-        print(f"write1 p{p_count} {p_val * 1000000} μs")
+        t0 = time.perf_counter()
+        if use_batch:
+            ctx.write_many(zip([f"key_{k}" for k in write1_keys], val_list))
+            t1 = time.perf_counter()
+            print(f"write1 batch, throughput {len(write1_keys) / (t1 - t0)} ops/s")
+        else:
+            p_val = p(p_count, ctx.write, [f"key_{k}" for k in write1_keys], val_list)
+            t1 = time.perf_counter()
+            print(f"write1 p{p_count} {p_val * 1000000} μs, throughput {len(write1_keys) / (t1 - t0)} ops/s")
         print(f"stats: {db.stats()}")
 
         # delete 4000 keys
-        p_val = p(p_count, ctx.delete, [f"key_{k}" for k in delete1_keys])
-        print(f"delete1 p{p_count} {p_val * 1000000} μs")
+        t0 = time.perf_counter()
+        if use_batch:
+            ctx.delete_many([f"key_{k}" for k in delete1_keys])
+            t1 = time.perf_counter()
+            print(f"delete1 batch, throughput {len(delete1_keys) / (t1 - t0)} ops/s")
+        else:
+            p_val = p(p_count, ctx.delete, [f"key_{k}" for k in delete1_keys])
+            t1 = time.perf_counter()
+            print(f"delete1 p{p_count} {p_val * 1000000} μs, throughput {len(delete1_keys) / (t1 - t0)} ops/s")
+        print(f"stats: {db.stats()}")
+
+        # compact
+        t0 = time.perf_counter()
+        num_steps = 0
+        while db.compact() > 0:
+            num_steps += 1
+        t1 = time.perf_counter()
+        print(f"compact {num_steps} steps, {(t1 - t0) * 1000} ms")
         print(f"stats: {db.stats()}")
 
         # write 8000 keys
         val_list = [random_string(min_length, max_length).encode("utf-8") for _ in range(len(write2_keys))]
-        p_val = p(p_count, ctx.write, [f"key_{k}" for k in write2_keys], val_list)
-        print(f"write2 p{p_count} {p_val * 1000000} μs")
+        t0 = time.perf_counter()
+        if use_batch:
+            ctx.write_many(zip([f"key_{k}" for k in write2_keys], val_list))
+            t1 = time.perf_counter()
+            print(f"write2 batch, throughput {len(write2_keys) / (t1 - t0)} ops/s")
+        else:
+            p_val = p(p_count, ctx.write, [f"key_{k}" for k in write2_keys], val_list)
+            t1 = time.perf_counter()
+            print(f"write2 p{p_count} {p_val * 1000000} μs, throughput {len(write2_keys) / (t1 - t0)} ops/s")
         print(f"stats: {db.stats()}")
 
         # read 12000 keys
-        p_val = p(p_count, ctx.read, [f"key_{k}" for k in read1_keys])
-        print(f"read1 p{p_count} {p_val * 1000000} μs")
+        t0 = time.perf_counter()
+        if use_batch:
+            ctx.read_many([f"key_{k}" for k in read1_keys])
+            t1 = time.perf_counter()
+            print(f"read1 batch, throughput {len(read1_keys) / (t1 - t0)} ops/s")
+        else:
+            p_val = p(p_count, ctx.read, [f"key_{k}" for k in read1_keys])
+            t1 = time.perf_counter()
+            print(f"read1 p{p_count} {p_val * 1000000} μs, throughput {len(read1_keys) / (t1 - t0)} ops/s")
         print(f"stats: {db.stats()}")
 
+        # read 12000 hot keys
+        t0 = time.perf_counter()
+        if use_batch:
+            ctx.read_many([f"key_{k}" for k in read2_keys])
+            t1 = time.perf_counter()
+            print(f"read2 batch, throughput {len(read2_keys) / (t1 - t0)} ops/s")
+        else:
+            p_val = p(p_count, ctx.read, [f"key_{k}" for k in read2_keys])
+            t1 = time.perf_counter()
+            print(f"read2 p{p_count} {p_val * 1000000} μs, throughput {len(read2_keys) / (t1 - t0)} ops/s")
+        print(f"stats: {db.stats()}")
+
+    db.close()
+    if path is not None:
+        for file in file_list:
+            file.close()
+    if wal_file_list is not None:
+        for wal_file in wal_file_list:
+            wal_file.close()
+
+
+def open_benchmark(path: str = "data_open.db", num_keys: int = 1000000, num_journals: int = 0):
+    """
+    time to first read and peak python memory of opening a file by DB and by PagedReader
+
+    :param num_journals: number of small contexts run after the first one, each appends a journal
+    """
+    if not os.path.exists(path):
+        open(path, "wb").close()
+        with open(path, "r+b") as file:
+            db = buffer_db.DB(file=file, block_size=4 * 1024, slab_threshold=1024)
+            with db.context() as ctx:
+                ctx.write_many((f"key_{k:08d}", random_string(8, 32).encode("utf-8")) for k in range(num_keys))
+            for _ in range(num_journals):
+                with db.context() as ctx:
+                    ctx.write_many(
+                        (f"key_{random.randrange(num_keys):08d}", random_string(8, 32).encode("utf-8"))
+                        for _ in range(10)
+                    )
+            db.close()
+    key = f"key_{random.randrange(num_keys):08d}"
+    for name, open_db in [
+        ("DB", lambda file: buffer_db.DB(file=file, block_size=4 * 1024, slab_threshold=1024).ctx),
+        ("PagedReader", lambda file: buffer_db.PagedReader(file=file, block_size=4 * 1024)),
+    ]:
+        with open(path, "r+b") as file:
+            t0 = time.perf_counter()
+            open_db(file).read(key)
+            t1 = time.perf_counter()
+        # tracing allocations slows down open, memory is measured by another open
+        with open(path, "r+b") as file:
+            tracemalloc.start()
+            open_db(file).read(key)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        print(f"open {name} {num_keys} keys {num_journals} journals, time to first read {(t1 - t0) * 1000} ms, "
+              f"peak memory {peak / 1024 / 1024} MB")
+
+
+def async_benchmark(path: Optional[str] = "data_async.db", num_clients: int = 100, num_ops: int = 100):
+    """
+    throughput of concurrent clients writing and reading their keys through AsyncDB
+    """
+    async def client(adb: buffer_db.AsyncDB, c: int):
+        for i in range(num_ops):
+            key = f"key_{c}_{i % 10}"
+            await adb.write(key, random_string(16, 1024).encode("utf-8"))
+            await adb.read(key)
+
+    async def run():
+        file = buffer_db.Buffer() if path is None else open_file(path)
+        adb = buffer_db.AsyncDB(buffer_db.DB(file=file, block_size=4 * 1024))
+        t0 = time.perf_counter()
+        await asyncio.gather(*(client(adb, c) for c in range(num_clients)))
+        t1 = time.perf_counter()
+        print(f"async {num_clients} clients, {adb.num_batches} batches, "
+              f"throughput {2 * num_clients * num_ops / (t1 - t0)} ops/s")
+        await adb.close()
+        if path is not None:
+            file.close()
+
+    asyncio.run(run())
+
+
+def crash_recovery_check(path: str = "data_crash.db", wal_path: str = "data_crash.log", num_threads: int = 4,
+                         num_keys: int = 1000, group_commit_latency: float = 0.0):
+    """
+    threads write concurrently in write-ahead log mode, the DB is reopened without exiting its context,
+    every key must be recovered from the log
+    """
+    for p in (path, wal_path):
+        open(p, "wb").close()
+    file, wal_file = open(path, "r+b"), open(wal_path, "r+b")
+    db = buffer_db.DB(file=file, block_size=4 * 1024, wal_file=wal_file, group_commit_latency=group_commit_latency)
+    ctx = db.context().__enter__()
+
+    def writer(t: int):
+        for k in range(num_keys):
+            if k % 2 == 0:
+                ctx.write(f"key_{t}_{k}", f"val_{t}_{k}".encode("utf-8"))
+            else:
+                ctx.write_many([(f"key_{t}_{k}", f"val_{t}_{k}".encode("utf-8"))])
+
+    thread_list = [threading.Thread(target=writer, args=(t,)) for t in range(num_threads)]
+    for thread in thread_list:
+        thread.start()
+    for thread in thread_list:
+        thread.join()
+    ctx.sync()
+    # crash: neither the context is exited nor the DB is closed
+    with open(path, "r+b") as recovered_file, open(wal_path, "r+b") as recovered_wal_file:
+        recovered = buffer_db.DB(file=recovered_file, block_size=4 * 1024, wal_file=recovered_wal_file).ctx
+        for t in range(num_threads):
+            for k in range(num_keys):
+                val = recovered.read(f"key_{t}_{k}")
+                if val is None or bytes(val) != f"val_{t}_{k}".encode("utf-8"):
+                    raise Exception(f"key_{t}_{k} is not recovered")
+    print(f"crash recovery {num_threads} threads, {num_threads * num_keys} keys recovered")
     file.close()
+    wal_file.close()
 
 
 if __name__ == "__main__":
-    main()
+    main(path="data.db")
+    main(path="data_mmap.db", use_mmap=True)
+    main(path="data_wal.db", wal_path="data_wal.log")
+    main(path="data_wal_group.db", wal_path="data_wal_group.log", group_commit_latency=0.01)
+    main(path="data_batch.db", use_batch=True)
+    main(path="data_wal_batch.db", wal_path="data_wal_batch.log", use_batch=True)
+    main(path="data_compress.db", use_batch=True, compress_threshold=1024, slab_threshold=4 * 1024)
+    main(path="data_cache.db", compress_threshold=1024, cache_size=4 * 1024 * 1024)
+    main(path="data_sharded.db", use_batch=True, num_shards=4)
+    async_benchmark(path="data_async.db")
+    open_benchmark(path="data_open.db")
+    open_benchmark(path="data_open_journal.db", num_journals=10000)
+    crash_recovery_check(path="data_crash.db", wal_path="data_crash.log")
+    crash_recovery_check(path="data_crash_group.db", wal_path="data_crash_group.log", group_commit_latency=0.01)
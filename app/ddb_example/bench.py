@@ -0,0 +1,93 @@
+import argparse
+import asyncio
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+
+import aiohttp
+import uvicorn
+
+from my_collection import ddb
+
+
+def run_storage(addr: ddb.Addr, dir: str):
+    uvicorn.run(ddb.Storage(os.path.join(dir, f"data_{addr.port}.db")).app,
+                host=addr.host, port=addr.port, log_level="error")
+
+
+def run_server(addr: ddb.Addr, storage_list: ddb.Addr):
+    uvicorn.run(ddb.Server(storage_list).app, host=addr.host, port=addr.port, log_level="error")
+
+
+async def wait_ready(session: aiohttp.ClientSession, url: str):
+    for _ in range(100):
+        try:
+            async with session.get(url):
+                return
+        except aiohttp.ClientError:
+            await asyncio.sleep(0.1)
+    raise Exception(f"{url} is not ready")
+
+
+async def load(addr: ddb.Addr, num_ops: int, concurrency: int, write_ratio: float, num_keys: int) -> float:
+    """
+    num_ops requests from concurrency clients, each client waits for its previous request
+
+    :return: requests per second
+    """
+    url = f"http://{addr.host}:{addr.port}/query/bench"
+    count = 0
+
+    async def client(session: aiohttp.ClientSession):
+        nonlocal count
+        while count < num_ops:
+            j = count
+            count += 1
+            params = {"key": f"key{j * 7919 % num_keys}"}
+            if (j * 2654435761 % 1000) < write_ratio * 1000:
+                async with session.post(url, params=params, json={"i": j}) as r:
+                    await r.read()
+            else:
+                async with session.get(url, params=params) as r:
+                    await r.read()
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        await wait_ready(session, f"http://{addr.host}:{addr.port}/file/bench")
+        # populate
+        async with session.post(f"http://{addr.host}:{addr.port}/file/bench",
+                                json={f"key{i}": {"i": i} for i in range(num_keys)}) as r:
+            await r.read()
+        t0 = time.perf_counter()
+        await asyncio.gather(*(client(session) for _ in range(concurrency)))
+        t1 = time.perf_counter()
+    return num_ops / (t1 - t0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="throughput of ddb.Server under concurrent clients")
+    parser.add_argument("--num_storages", type=int, default=4)
+    parser.add_argument("--num_ops", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 64])
+    parser.add_argument("--write_ratio", type=float, default=0.5)
+    parser.add_argument("--num_keys", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=2999)
+    args = parser.parse_args()
+
+    dir = tempfile.mkdtemp()
+    storage_list = [ddb.Addr(host="localhost", port=args.port + 1 + i) for i in range(args.num_storages)]
+    addr = ddb.Addr(host="localhost", port=args.port)
+    p_list = [mp.Process(target=run_storage, args=(storage_addr, dir)) for storage_addr in storage_list]
+    p_list.append(mp.Process(target=run_server, args=(addr, storage_list)))
+    for p in p_list:
+        p.start()
+    try:
+        for concurrency in args.concurrency:
+            ops = asyncio.run(load(addr, args.num_ops, concurrency, args.write_ratio, args.num_keys))
+            print(f"concurrency {concurrency}: {ops:.0f} requests/s")
+    finally:
+        for p in p_list:
+            p.terminate()
+            p.join()
+        shutil.rmtree(dir)
@@ -0,0 +1,108 @@
+import argparse
+import multiprocessing as mp
+import operator
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, List, Tuple
+
+import requests
+import uvicorn
+
+from my_collection import ddb
+from my_collection.transform import t_filter, t_map
+
+OP_MAP = {"==": operator.eq, "<": operator.lt, "<=": operator.le, ">": operator.gt, ">=": operator.ge}
+
+
+def run_storage(addr: ddb.Addr, dir: str):
+    uvicorn.run(ddb.Storage(os.path.join(dir, f"data_{addr.port}.db")).app,
+                host=addr.host, port=addr.port, log_level="error")
+
+
+def run_server(addr: ddb.Addr, storage_list: ddb.Addr):
+    uvicorn.run(ddb.Server(storage_list).app, host=addr.host, port=addr.port, log_level="error")
+
+
+def wait_ready(addr: ddb.Addr):
+    for _ in range(100):
+        try:
+            requests.get(f"http://{addr.host}:{addr.port}/docs")
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise Exception(f"{addr.host}:{addr.port} is not ready")
+
+
+def timeit(f, num_runs: int) -> float:
+    """
+    :return: average seconds per run
+    """
+    f()  # warm up
+    t0 = time.perf_counter()
+    for _ in range(num_runs):
+        f()
+    return (time.perf_counter() - t0) / num_runs
+
+
+def bench(c: ddb.Client, path: str, op: str, value: Any, num_runs: int) -> List[Tuple[str, float]]:
+    """
+    :return: seconds per lookup of each method
+    """
+    compare = OP_MAP[op]
+    pred = lambda val: compare(val["idx"], value)
+    out = [
+        ("transform filter", timeit(lambda: c.transform(
+            path,
+            transform_func=t_map(lambda val: [val]) * t_filter(pred),
+            reduce_func=lambda a, b: (a or []) + b,  # reduce starts from 0
+        ), num_runs)),
+        ("scan filter", timeit(lambda: dict(c.scan(
+            path, transform_func=t_filter(lambda kv: pred(kv[1])),
+        )), num_runs)),
+        ("query, no index", timeit(lambda: c.query(path, "idx", op, value), num_runs)),
+    ]
+    c.create_index(path, "idx")
+    out.append(("query, index", timeit(lambda: c.query(path, "idx", op, value), num_runs)))
+    c.drop_index(path, "idx")
+    return out
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="indexed lookup vs transform filter in ddb")
+    parser.add_argument("--num_storages", type=int, default=4)
+    parser.add_argument("--num_keys", type=int, default=100000)
+    parser.add_argument("--num_values", type=int, default=1000)  # distinct values of the indexed field
+    parser.add_argument("--num_runs", type=int, default=10)
+    parser.add_argument("--port", type=int, default=2999)
+    args = parser.parse_args()
+
+    dir = tempfile.mkdtemp()
+    storage_list = [ddb.Addr(host="localhost", port=args.port + 1 + i) for i in range(args.num_storages)]
+    addr = ddb.Addr(host="localhost", port=args.port)
+    p_list = [mp.Process(target=run_storage, args=(storage_addr, dir)) for storage_addr in storage_list]
+    p_list.append(mp.Process(target=run_server, args=(addr, storage_list)))
+    for p in p_list:
+        p.start()
+    try:
+        for a in storage_list + [addr]:
+            wait_ready(a)
+        c = ddb.Client(addr, binary=True)
+        path = "index_bench"
+        c.write(path, {f"key{i}": {"idx": i % args.num_values, "name": f"name{i}"} for i in range(args.num_keys)})
+
+        n = args.num_values
+        case_list = [
+            ("idx == num_values / 2", "==", n // 2),
+            ("idx < num_values / 100", "<", n // 100),
+        ]
+        for name, op, value in case_list:
+            print(f"{name}: {len(c.query(path, 'idx', op, value))} of {args.num_keys} keys")
+            for method, t in bench(c, path, op, value, args.num_runs):
+                print(f"    {method:<20}{t * 1000:8.1f} ms")
+    finally:
+        for p in p_list:
+            p.terminate()
+            p.join()
+        shutil.rmtree(dir)
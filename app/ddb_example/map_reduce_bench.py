@@ -0,0 +1,92 @@
+import argparse
+import multiprocessing as mp
+import os
+import random
+import shutil
+import tempfile
+import time
+from collections import Counter
+
+import requests
+import uvicorn
+
+from my_collection import ddb
+from my_collection.transform import t_map, t_flat_map
+
+
+def run_storage(addr: ddb.Addr, dir: str):
+    uvicorn.run(ddb.Storage(os.path.join(dir, f"data_{addr.port}.db")).app,
+                host=addr.host, port=addr.port, log_level="error")
+
+
+def run_server(addr: ddb.Addr, storage_list: ddb.Addr):
+    uvicorn.run(ddb.Server(storage_list, timeout=60.0).app, host=addr.host, port=addr.port, log_level="error")
+
+
+def wait_ready(addr: ddb.Addr):
+    for _ in range(100):
+        try:
+            requests.get(f"http://{addr.host}:{addr.port}/docs")
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise Exception(f"{addr.host}:{addr.port} is not ready")
+
+
+def merge_count(a: dict, b: dict) -> dict:
+    a = a or {}  # reduce starts from 0
+    for word, count in b.items():
+        a[word] = a.get(word, 0) + count
+    return a
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="word count by transform vs keyed map reduce in ddb")
+    parser.add_argument("--num_storages", type=int, default=4)
+    parser.add_argument("--num_lines", type=int, default=50000)
+    parser.add_argument("--num_words", type=int, default=100000)  # vocabulary size
+    parser.add_argument("--words_per_line", type=int, default=10)
+    parser.add_argument("--port", type=int, default=2999)
+    args = parser.parse_args()
+
+    dir = tempfile.mkdtemp()
+    storage_list = [ddb.Addr(host="localhost", port=args.port + 1 + i) for i in range(args.num_storages)]
+    addr = ddb.Addr(host="localhost", port=args.port)
+    p_list = [mp.Process(target=run_storage, args=(storage_addr, dir)) for storage_addr in storage_list]
+    p_list.append(mp.Process(target=run_server, args=(addr, storage_list)))
+    for p in p_list:
+        p.start()
+    try:
+        for a in storage_list + [addr]:
+            wait_ready(a)
+        c = ddb.Client(addr)
+        path = "map_reduce_bench"
+        random.seed(0)
+        c.write(path, {
+            f"line{i}": " ".join(f"word{random.randrange(args.num_words)}" for _ in range(args.words_per_line))
+            for i in range(args.num_lines)
+        })
+
+        t0 = time.perf_counter()
+        # every storage sends its whole dict to the server
+        count_transform = c.transform(
+            path,
+            transform_func=t_map(lambda line: Counter(line.split(" "))),
+            reduce_func=merge_count,
+        )
+        t1 = time.perf_counter()
+        count_map_reduce = c.map_reduce(
+            path,
+            map_func=t_map(lambda word: (word, 1)) * t_flat_map(lambda line: line.split(" ")),
+            reduce_func=lambda a, b: a + b,
+        )
+        t2 = time.perf_counter()
+        assert count_transform == count_map_reduce
+        print(f"{len(count_map_reduce)} distinct words in {args.num_lines} lines")
+        print(f"    transform:   {t1 - t0:.2f}s")
+        print(f"    map reduce:  {t2 - t1:.2f}s")
+    finally:
+        for p in p_list:
+            p.terminate()
+            p.join()
+        shutil.rmtree(dir)
@@ -0,0 +1,120 @@
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+
+import fastapi
+import requests
+import uvicorn
+
+from my_collection import ddb
+
+
+def run_storage(addr: ddb.Addr, dir: str):
+    uvicorn.run(ddb.Storage(os.path.join(dir, f"data_{addr.port}.db")).app,
+                host=addr.host, port=addr.port, log_level="error")
+
+
+def run_server(addr: ddb.Addr, storage_list: ddb.Addr, read_quorum: int):
+    server = ddb.Server(storage_list, timeout=1.0, replication=3, read_quorum=read_quorum, write_quorum=2)
+    uvicorn.run(server.app, host=addr.host, port=addr.port, log_level="error")
+
+
+def start_storage(addr: ddb.Addr, dir: str) -> mp.Process:
+    p = mp.Process(target=run_storage, args=(addr, dir))
+    p.start()
+    return p
+
+
+def wait_ready(addr: ddb.Addr):
+    for _ in range(100):
+        try:
+            requests.get(f"http://{addr.host}:{addr.port}/docs")
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise Exception(f"{addr.host}:{addr.port} is not ready")
+
+
+def count_readable(c: ddb.Client, path: str, expected: dict) -> int:
+    count = 0
+    for key, val in expected.items():
+        try:
+            if c.get(path, key) == val:
+                count += 1
+        except fastapi.HTTPException as e:
+            print(e.status_code, e.detail)
+    return count
+
+
+if __name__ == "__main__":
+    # 4 storages, 3 copies of each key, writes wait for 2 copies, reads ask 2 copies
+    # a second server asks all 3 copies, repairing every stale copy it reads
+    dir = tempfile.mkdtemp()
+    storage_list = [ddb.Addr(host="localhost", port=3000 + i) for i in range(4)]
+    addr = ddb.Addr(host="localhost", port=2999)
+    repair_addr = ddb.Addr(host="localhost", port=2998)
+    storage_p_list = [start_storage(storage_addr, dir) for storage_addr in storage_list]
+    server_p_list = [
+        mp.Process(target=run_server, args=(addr, storage_list, 2)),
+        mp.Process(target=run_server, args=(repair_addr, storage_list, 3)),
+    ]
+    for p in server_p_list:
+        p.start()
+    for a in storage_list + [addr, repair_addr]:
+        wait_ready(a)
+
+    try:
+        c = ddb.Client(addr)
+        path = "replicated"
+        data = {f"key{i}": {"idx": i} for i in range(100)}
+        c.write(path, {key: val for key, val in list(data.items())[:50]})
+        for key, val in list(data.items())[50:]:
+            c.post(path, key, val)
+        print("readable keys before node loss:", count_readable(c, path, data), "of", len(data))
+
+        lost = storage_list[0]
+        storage_p_list[0].terminate()
+        storage_p_list[0].join()
+        print(f"storage {lost.host}:{lost.port} is lost")
+        t0 = time.perf_counter()
+        print("readable keys after node loss:", count_readable(c, path, data), "of", len(data),
+              f"in {time.perf_counter() - t0:.2f}s")
+        for i in range(0, 100, 2):
+            data[f"key{i}"] = {"idx": i, "updated": True}
+            c.post(path, f"key{i}", data[f"key{i}"])
+        c.delete(path, "key99")
+        data.pop("key99")
+        print("updated 50 keys and deleted 1 key while the storage is lost")
+        missing = []
+        c.read(path, policy=ddb.POLICY_BEST_EFFORT, missing=missing)
+        print("bulk read misses the primary copies of", missing)
+
+        storage_p_list[0] = start_storage(lost, dir)
+        wait_ready(lost)
+        print(f"storage {lost.host}:{lost.port} is back with stale copies")
+
+        def stale_copies() -> int:
+            count = 0
+            for key in list(data) + ["key99"]:
+                r = requests.get(f"http://{lost.host}:{lost.port}/replica/{path}", params={"key": key})
+                r_replica = requests.get(f"http://{lost.host}:{lost.port}/replica/{path}",
+                                         params={"key": key, "replica": "true"})
+                for v in (r.json(), r_replica.json()):
+                    if v["version"] > 0 and (v["deleted"] != (key not in data) or v.get("val") != data.get(key)):
+                        count += 1
+            return count
+
+        print("stale copies on the storage:", stale_copies())
+        print("readable keys:", count_readable(c, path, data), "of", len(data), ", key99 is",
+              c.get(path, "key99"))
+        count_readable(ddb.Client(repair_addr), path, data)
+        ddb.Client(repair_addr).get(path, "key99")
+        time.sleep(0.5)  # read repairs are written in the background
+        print("stale copies on the storage after reading all keys with read quorum 3:", stale_copies())
+    finally:
+        for p in storage_p_list + server_p_list:
+            p.terminate()
+            p.join()
+        shutil.rmtree(dir)
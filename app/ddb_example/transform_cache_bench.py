@@ -0,0 +1,88 @@
+import argparse
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+
+import requests
+import uvicorn
+
+from my_collection import ddb
+from my_collection.transform import t_map, t_filter
+
+
+def run_storage(addr: ddb.Addr, dir: str):
+    uvicorn.run(ddb.Storage(os.path.join(dir, f"data_{addr.port}.db")).app,
+                host=addr.host, port=addr.port, log_level="error")
+
+
+def run_server(addr: ddb.Addr, storage_list: ddb.Addr):
+    uvicorn.run(ddb.Server(storage_list).app, host=addr.host, port=addr.port, log_level="error")
+
+
+def wait_ready(addr: ddb.Addr):
+    for _ in range(100):
+        try:
+            requests.get(f"http://{addr.host}:{addr.port}/docs")
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    raise Exception(f"{addr.host}:{addr.port} is not ready")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="repeated transforms, sent every time vs registered in ddb")
+    parser.add_argument("--num_storages", type=int, default=4)
+    parser.add_argument("--num_keys", type=int, nargs="+", default=[100, 10000])
+    parser.add_argument("--num_runs", type=int, default=100)
+    parser.add_argument("--port", type=int, default=2999)
+    args = parser.parse_args()
+
+    dir = tempfile.mkdtemp()
+    storage_list = [ddb.Addr(host="localhost", port=args.port + 1 + i) for i in range(args.num_storages)]
+    addr = ddb.Addr(host="localhost", port=args.port)
+    p_list = [mp.Process(target=run_storage, args=(storage_addr, dir)) for storage_addr in storage_list]
+    p_list.append(mp.Process(target=run_server, args=(addr, storage_list)))
+    for p in p_list:
+        p.start()
+    try:
+        for a in storage_list + [addr]:
+            wait_ready(a)
+        c = ddb.Client(addr)
+        # a dashboard tile: sum of a field over filtered values
+        transform_func = t_map(lambda val: val["amount"]) * t_filter(lambda val: val["region"] in ("eu", "us"))
+        reduce_func = lambda a, b: a + b
+        transform_id = c.register_transform(transform_func, reduce_func)
+        region_list = ["eu", "us", "asia", "africa"]
+        for num_keys in args.num_keys:
+            path = f"transform_cache_bench_{num_keys}"
+            c.write(path, {f"key{i}": {"region": region_list[i % 4], "amount": i} for i in range(num_keys)})
+
+            t0 = time.perf_counter()
+            for _ in range(args.num_runs):
+                expected = c.transform(path, transform_func, reduce_func)
+            t_sent = (time.perf_counter() - t0) / args.num_runs
+
+            t_miss = 0.0
+            for i in range(args.num_runs):
+                c.post(path, "key0", {"region": "eu", "amount": 0})  # invalidates cached results of path
+                t0 = time.perf_counter()
+                assert c.run_transform(path, transform_id) == expected
+                t_miss += time.perf_counter() - t0
+            t_miss /= args.num_runs
+
+            t0 = time.perf_counter()
+            for _ in range(args.num_runs):
+                assert c.run_transform(path, transform_id) == expected
+            t_hit = (time.perf_counter() - t0) / args.num_runs
+
+            print(f"{num_keys} keys:")
+            print(f"    transform sent every time:       {t_sent * 1000:7.2f} ms")
+            print(f"    registered, path written before: {t_miss * 1000:7.2f} ms")
+            print(f"    registered, cached result:       {t_hit * 1000:7.2f} ms")
+    finally:
+        for p in p_list:
+            p.terminate()
+            p.join()
+        shutil.rmtree(dir)
@@ -1,3 +1,7 @@
-from .db import DB, Context
-from .io import IO, Buffer
+from .async_db import AsyncDB
+from .db import DB, Context, Snapshot
+from .io import IO, Buffer, File, MmapIO
 from .model import Key, Stats
+from .paged import PagedReader
+from .sharded import ShardedDB, ShardedContext
+from .wal import WAL
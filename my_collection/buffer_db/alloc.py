@@ -0,0 +1,97 @@
+import bisect
+from typing import List, Dict, Tuple, Optional
+
+from .model import Block, Extent
+
+
+class Allocator:
+    """
+    best-fit extent allocator
+
+    - free extents are indexed by start for coalescing and by (length, start) for best-fit
+    - allocation takes the smallest free extent that fits, or grows the file
+    - freed extents are coalesced with their neighbours, free extents at the end of the file are removed
+    """
+    num_blocks: int
+    start_list: List[Block]  # sorted starts of free extents
+    length_map: Dict[Block, int]  # start -> length of free extents
+    size_list: List[Tuple[int, Block]]  # sorted (length, start) of free extents
+
+    def __init__(self, num_blocks: int, extent_list: List[Extent]):
+        self.num_blocks = num_blocks
+        self.start_list = []
+        self.length_map = {}
+        self.size_list = []
+        for start, length in extent_list:
+            self.free((start, length))
+
+    def extent_list(self) -> List[Extent]:
+        return [(start, self.length_map[start]) for start in self.start_list]
+
+    def num_free_blocks(self) -> int:
+        return sum(self.length_map.values())
+
+    def __insert(self, start: Block, length: int):
+        bisect.insort(self.start_list, start)
+        bisect.insort(self.size_list, (length, start))
+        self.length_map[start] = length
+
+    def __remove(self, start: Block):
+        length = self.length_map.pop(start)
+        del self.start_list[bisect.bisect_left(self.start_list, start)]
+        del self.size_list[bisect.bisect_left(self.size_list, (length, start))]
+
+    def alloc(self, length: int) -> Extent:
+        if length == 0:
+            return self.num_blocks, 0
+        i = bisect.bisect_left(self.size_list, (length, -1))
+        if i < len(self.size_list):
+            # best fit
+            free_length, start = self.size_list[i]
+            return self.__take(start, free_length, length)
+        # grow file, reuse the free extent at the end of file if any
+        start = self.num_blocks
+        if len(self.start_list) > 0:
+            last = self.start_list[-1]
+            if last + self.length_map[last] == self.num_blocks:
+                self.__remove(last)
+                start = last
+        self.num_blocks = start + length
+        return start, length
+
+    def __take(self, start: Block, free_length: int, length: int) -> Extent:
+        self.__remove(start)
+        if free_length > length:
+            self.__insert(start + length, free_length - length)
+        return start, length
+
+    def alloc_before(self, length: int, end: Block) -> Optional[Extent]:
+        """
+        best-fit allocation of an extent ending before end without growing the file, None if no free extent fits
+        """
+        i = bisect.bisect_left(self.size_list, (length, -1))
+        for free_length, start in self.size_list[i:]:
+            if start + length <= end:
+                return self.__take(start, free_length, length)
+        return None
+
+    def free(self, extent: Extent):
+        start, length = extent
+        if length == 0:
+            return
+        i = bisect.bisect_left(self.start_list, start)
+        # coalesce with next
+        if i < len(self.start_list) and self.start_list[i] == start + length:
+            length += self.length_map[self.start_list[i]]
+            self.__remove(self.start_list[i])
+        # coalesce with prev
+        if i > 0 and self.start_list[i - 1] + self.length_map[self.start_list[i - 1]] == start:
+            prev = self.start_list[i - 1]
+            length += self.length_map[prev]
+            self.__remove(prev)
+            start = prev
+        if start + length >= self.num_blocks:
+            # remove blocks at the end of file
+            self.num_blocks = start
+            return
+        self.__insert(start, length)
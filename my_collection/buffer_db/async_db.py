@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+from typing import Union, Optional, List, Tuple, Dict
+
+from .db import DB
+from .model import Key, Stats
+from .sharded import ShardedDB
+
+
+class AsyncDB:
+    """
+    asyncio interface of DB
+
+    - IO runs on a bounded thread pool, the event loop is not blocked
+    - concurrent reads of the same key share a single read
+    - writes and deletes issued while a batch is applied are queued, the next batch applies all of them
+      by write_many and delete_many in a single context, metadata is written once per batch
+    - the DB must not be used by another context while AsyncDB is open
+    """
+    db: Union[DB, ShardedDB]
+    executor: concurrent.futures.ThreadPoolExecutor
+    reading: Dict[Key, asyncio.Future]  # key -> read in progress
+    pending: List[Tuple[Key, Optional[bytes], asyncio.Future]]  # (key, value or None for delete, future) not applied
+    flushing: Optional[asyncio.Task]  # task applying pending batches, None if idle
+    num_batches: int
+
+    def __init__(self, db: Union[DB, ShardedDB], num_threads: int = 4):
+        self.db = db
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads)
+        self.reading = {}
+        self.pending = []
+        self.flushing = None
+        self.num_batches = 0
+
+    def __read(self, key: Key) -> Optional[bytes]:
+        value = self.db.ctx.read(key)
+        # memoryview is valid until the key is written, which may happen in the next batch
+        return bytes(value) if isinstance(value, memoryview) else value
+
+    def __apply(self, change_map: Dict[Key, Optional[bytes]]):
+        with self.db.context() as ctx:
+            ctx.write_many([(key, b) for key, b in change_map.items() if b is not None])
+            ctx.delete_many([key for key, b in change_map.items() if b is None])
+
+    async def __flush(self):
+        loop = asyncio.get_running_loop()
+        while len(self.pending) > 0:
+            batch, self.pending = self.pending, []
+            change_map = {}
+            for key, b, _ in batch:
+                change_map[key] = b  # last change of a key wins
+            error = None
+            try:
+                await loop.run_in_executor(self.executor, self.__apply, change_map)
+            except Exception as e:
+                error = e
+            self.num_batches += 1
+            # reads started before the batch must not be shared with reads after it
+            for key in change_map:
+                self.reading.pop(key, None)
+            for _, _, future in batch:
+                if future.done():  # cancelled
+                    continue
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+        self.flushing = None
+
+    async def __submit(self, key: Key, b: Optional[bytes]):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((key, b, future))
+        if self.flushing is None:
+            self.flushing = asyncio.ensure_future(self.__flush())
+        await future
+
+    async def read(self, key: Key) -> Optional[bytes]:
+        future = self.reading.get(key, None)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self.executor, self.__read, key)
+            self.reading[key] = future
+            future.add_done_callback(lambda _: self.reading.pop(key) if self.reading.get(key) is future else None)
+        # a cancelled reader does not cancel the shared read
+        return await asyncio.shield(future)
+
+    async def write(self, key: Key, b: bytes):
+        await self.__submit(key, b)
+
+    async def delete(self, key: Key):
+        await self.__submit(key, None)
+
+    async def compact(self, max_blocks: int = 1024) -> int:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, lambda: self.db.compact(max_blocks=max_blocks),
+        )
+
+    async def close(self):
+        """
+        wait for pending writes and deletes, then close the DB
+        """
+        while self.flushing is not None:
+            await self.flushing
+        self.executor.shutdown()
+        self.db.close()
+
+    def stats(self) -> Stats:
+        return self.db.stats()
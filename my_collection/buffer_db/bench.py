@@ -0,0 +1,447 @@
+"""
+benchmark of buffer_db
+
+    python -m my_collection.buffer_db.bench --workload a b c --backend buffer file mmap --output result.json
+    python -m my_collection.buffer_db.bench --workload a --backend file --baseline result.json
+
+    - workloads are YCSB core workloads A to F over keys chosen by uniform, zipfian or latest distribution
+    - latencies are recorded into log-linear histograms with bounded relative error, like HdrHistogram
+    - write amplification is bytes written to data and wal files over bytes of values written,
+      space amplification is bytes stored over bytes of live values
+"""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import itertools
+import json
+import math
+import os
+import random
+import tempfile
+import time
+from typing import Union, Optional, List, Dict, Tuple
+
+import pydantic
+
+from .db import DB
+from .io import IO, Buffer, File, MmapIO
+
+
+class Workload(pydantic.BaseModel):
+    name: str
+    read: float = 0.0  # proportions of operations
+    update: float = 0.0
+    insert: float = 0.0
+    scan: float = 0.0
+    read_modify_write: float = 0.0
+    key_distribution: str = "zipfian"  # uniform, zipfian or latest
+    num_keys: int = 10000  # keys loaded before the run
+    num_ops: int = 10000
+    min_value_size: int = 100
+    max_value_size: int = 1000
+    value_distribution: str = "uniform"  # constant, uniform or zipfian
+    max_scan_length: int = 100
+    ops_per_context: int = 1000  # metadata is written on each context exit
+
+
+WORKLOADS: Dict[str, Workload] = {
+    "a": Workload(name="a", read=0.5, update=0.5),
+    "b": Workload(name="b", read=0.95, update=0.05),
+    "c": Workload(name="c", read=1.0),
+    "d": Workload(name="d", read=0.95, insert=0.05, key_distribution="latest"),
+    "e": Workload(name="e", scan=0.95, insert=0.05),
+    "f": Workload(name="f", read=0.5, read_modify_write=0.5),
+}
+
+
+class Latency(pydantic.BaseModel):
+    count: int
+    mean_us: float
+    p50_us: float
+    p95_us: float
+    p99_us: float
+    p999_us: float
+    max_us: float
+
+
+class Result(pydantic.BaseModel):
+    workload: str
+    backend: str
+    num_ops: int
+    duration: float  # seconds of the run phase
+    throughput: float  # operations per second of the run phase
+    latency: Dict[str, Latency]  # operation -> latency
+    write_amplification: float
+    space_amplification: float
+
+
+class Histogram:
+    """
+    histogram of non-negative integers with log-linear buckets
+
+    - values below 2^precision are kept exactly
+    - larger values are kept in 2^(precision-1) buckets per power of two, relative error is below 2^(1-precision)
+    """
+    precision: int
+    count_map: Dict[int, int]  # bucket -> number of values
+    count: int
+    total: int
+    max: int
+
+    def __init__(self, precision: int = 8):
+        self.precision = precision
+        self.count_map = {}
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def __bucket(self, value: int) -> int:
+        p = self.precision
+        if value < (1 << p):
+            return value
+        e = value.bit_length() - p
+        return (1 << p) + ((e - 1) << (p - 1)) + (value >> e) - (1 << (p - 1))
+
+    def __value(self, bucket: int) -> int:
+        """
+        middle value of bucket
+        """
+        p = self.precision
+        if bucket < (1 << p):
+            return bucket
+        e = ((bucket - (1 << p)) >> (p - 1)) + 1
+        m = ((bucket - (1 << p)) & ((1 << (p - 1)) - 1)) + (1 << (p - 1))
+        return (m << e) + (1 << (e - 1))
+
+    def record(self, value: int):
+        bucket = self.__bucket(value)
+        self.count_map[bucket] = self.count_map.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other: Histogram):
+        for bucket, count in other.count_map.items():
+            self.count_map[bucket] = self.count_map.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p: float) -> int:
+        """
+        :param p: percentile in [0, 100]
+        """
+        if self.count == 0:
+            return 0
+        rank = max(1, math.ceil(self.count * p / 100))
+        seen = 0
+        for bucket in sorted(self.count_map):
+            seen += self.count_map[bucket]
+            if seen >= rank:
+                return min(self.__value(bucket), self.max)
+        return self.max
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count > 0 else 0.0
+
+    def latency(self) -> Latency:
+        """
+        latency summary of a histogram of nanoseconds
+        """
+        return Latency(
+            count=self.count,
+            mean_us=self.mean() / 1000,
+            p50_us=self.percentile(50) / 1000,
+            p95_us=self.percentile(95) / 1000,
+            p99_us=self.percentile(99) / 1000,
+            p999_us=self.percentile(99.9) / 1000,
+            max_us=self.max / 1000,
+        )
+
+
+class CountingIO(IO):
+    """
+    IO counting bytes written to another IO
+    """
+    io: IO
+    bytes_written: int
+
+    def __init__(self, io: IO):
+        self.io = io
+        self.bytes_written = 0
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self.io.seek(offset, whence)
+
+    def read(self, n: Optional[int] = None) -> bytes:
+        return self.io.read(n)
+
+    def write(self, b: Union[bytes, bytearray]):
+        self.bytes_written += len(b)
+        self.io.write(b)
+
+    def truncate(self, size: Optional[int] = None) -> int:
+        return self.io.truncate(size)
+
+    def readinto(self, b: Union[bytearray, memoryview]) -> int:
+        return self.io.readinto(b)
+
+    def pread(self, n: int, offset: int) -> bytes:
+        return self.io.pread(n, offset)
+
+    def preadv(self, buffers: List[memoryview], offset: int) -> int:
+        return self.io.preadv(buffers, offset)
+
+    def pwritev(self, buffers: List[memoryview], offset: int) -> int:
+        n = self.io.pwritev(buffers, offset)
+        self.bytes_written += n
+        return n
+
+    def view(self, offset: int, n: int) -> Optional[memoryview]:
+        return self.io.view(offset, n)
+
+    def fsync(self):
+        self.io.fsync()
+
+
+class Zipfian:
+    """
+    zipfian distribution over [0, n) by Gray et al., as in YCSB, 0 is the most popular
+    """
+
+    def __init__(self, n: int, rnd: random.Random, theta: float = 0.99):
+        self.n = n
+        self.rnd = rnd
+        self.theta = theta
+        self.zetan = sum(1 / (i ** theta) for i in range(1, n + 1))
+        zeta2 = 1 + 0.5 ** theta
+        self.alpha = 1 / (1 - theta)
+        self.eta = (1 - (2 / n) ** (1 - theta)) / (1 - zeta2 / self.zetan) if n > 1 else 0.0
+
+    def next(self) -> int:
+        uz = self.rnd.random() * self.zetan
+        if uz < 1:
+            return 0
+        if uz < 1 + 0.5 ** self.theta:
+            return min(1, self.n - 1)
+        u = uz / self.zetan
+        return min(self.n - 1, int(self.n * (self.eta * u - self.eta + 1) ** self.alpha))
+
+
+def fnv(n: int) -> int:
+    """
+    64-bit FNV-1a hash of n, it scatters popular zipfian ranks over the key space
+    """
+    h = 0xCBF29CE484222325
+    for _ in range(8):
+        h = ((h ^ (n & 0xFF)) * 0x100000001B3) & 0xFFFFFFFFFFFFFFFF
+        n >>= 8
+    return h
+
+
+def key_of(i: int) -> str:
+    return f"user{i:010d}"
+
+
+class Generator:
+    """
+    keys and values of a workload
+    """
+
+    def __init__(self, workload: Workload, rnd: random.Random):
+        self.workload = workload
+        self.rnd = rnd
+        self.num_keys = workload.num_keys
+        self.key_zipf = Zipfian(max(1, workload.num_keys), rnd)
+        self.size_zipf = Zipfian(workload.max_value_size - workload.min_value_size + 1, rnd)
+        self.op_list = [
+            (op, getattr(workload, op))
+            for op in ["read", "update", "insert", "scan", "read_modify_write"]
+            if getattr(workload, op) > 0
+        ]
+
+    def op(self) -> str:
+        x = self.rnd.random() * sum(weight for _, weight in self.op_list)
+        for op, weight in self.op_list:
+            if x < weight:
+                return op
+            x -= weight
+        return self.op_list[-1][0]
+
+    def key(self) -> str:
+        distribution = self.workload.key_distribution
+        if distribution == "uniform":
+            return key_of(self.rnd.randrange(self.num_keys))
+        if distribution == "zipfian":
+            return key_of(fnv(self.key_zipf.next()) % self.num_keys)
+        if distribution == "latest":
+            return key_of(max(0, self.num_keys - 1 - self.key_zipf.next()))
+        raise Exception(f"key distribution {distribution}")
+
+    def new_key(self) -> str:
+        self.num_keys += 1
+        return key_of(self.num_keys - 1)
+
+    def value(self) -> bytes:
+        distribution = self.workload.value_distribution
+        if distribution == "constant":
+            size = self.workload.max_value_size
+        elif distribution == "uniform":
+            size = self.rnd.randint(self.workload.min_value_size, self.workload.max_value_size)
+        elif distribution == "zipfian":
+            size = self.workload.min_value_size + self.size_zipf.next()
+        else:
+            raise Exception(f"value distribution {distribution}")
+        return self.rnd.randbytes(size)
+
+
+def run(workload: Workload, file: IO, backend: str, wal_file: Optional[IO] = None, seed: int = 0,
+        **kwargs) -> Result:
+    """
+    load workload.num_keys keys then run workload.num_ops operations
+
+    :param kwargs: passed to DB
+    """
+    rnd = random.Random(seed)
+    gen = Generator(workload, rnd)
+    data = CountingIO(file)
+    wal = None if wal_file is None else CountingIO(wal_file)
+    db = DB(file=data, wal_file=wal, **kwargs)
+    bytes_written = 0
+
+    # load
+    for start in range(0, workload.num_keys, workload.ops_per_context):
+        with db.context() as ctx:
+            item_list = [
+                (key_of(i), gen.value())
+                for i in range(start, min(start + workload.ops_per_context, workload.num_keys))
+            ]
+            bytes_written += sum(len(b) for _, b in item_list)
+            ctx.write_many(item_list)
+
+    # run
+    hist_map: Dict[str, Histogram] = {}
+    num_done = 0
+    t0 = time.perf_counter()
+    while num_done < workload.num_ops:
+        with db.context() as ctx:
+            for _ in range(min(workload.ops_per_context, workload.num_ops - num_done)):
+                op = gen.op()
+                key = gen.new_key() if op == "insert" else gen.key()
+                b = gen.value() if op in ("update", "insert", "read_modify_write") else b""
+                scan_length = rnd.randint(1, workload.max_scan_length)
+                bytes_written += len(b)
+                o0 = time.perf_counter_ns()
+                if op == "read":
+                    ctx.read(key)
+                elif op == "scan":
+                    for scan_key in itertools.islice(ctx.scan(start=key), scan_length):
+                        ctx.read(scan_key)
+                elif op == "read_modify_write":
+                    ctx.read(key)
+                    ctx.write(key, b)
+                else:
+                    ctx.write(key, b)
+                o1 = time.perf_counter_ns()
+                hist_map.setdefault(op, Histogram()).record(o1 - o0)
+        num_done += min(workload.ops_per_context, workload.num_ops - num_done)
+    t1 = time.perf_counter()
+
+    stats = db.stats()
+    db.close()
+    return Result(
+        workload=workload.name,
+        backend=backend,
+        num_ops=workload.num_ops,
+        duration=t1 - t0,
+        throughput=workload.num_ops / (t1 - t0),
+        latency={op: hist.latency() for op, hist in sorted(hist_map.items())},
+        write_amplification=(data.bytes_written + (0 if wal is None else wal.bytes_written)) / max(1, bytes_written),
+        space_amplification=1 / stats.storage_efficiency if stats.storage_efficiency > 0 else 0.0,
+    )
+
+
+def run_backend(workload: Workload, backend: str, directory: str, **kwargs) -> Result:
+    """
+    run workload on a new file of backend buffer, file, mmap, wal (file with write-ahead log)
+    """
+    if backend == "buffer":
+        return run(workload, Buffer(), backend, **kwargs)
+    path = os.path.join(directory, f"{workload.name}_{backend}.db")
+    with open(path, "w+b") as file:
+        if backend == "file":
+            return run(workload, File(file), backend, **kwargs)
+        if backend == "mmap":
+            return run(workload, MmapIO(file), backend, **kwargs)
+        if backend == "wal":
+            with open(path + ".wal", "w+b") as wal_file:
+                return run(workload, File(file), backend, wal_file=File(wal_file), **kwargs)
+    raise Exception(f"backend {backend}")
+
+
+def compare(baseline_list: List[Result], result_list: List[Result]) -> List[Tuple[str, str, float, float]]:
+    """
+    :return: (workload, backend, throughput ratio, p99 ratio of all operations) of results in baseline
+    """
+    baseline_map = {(r.workload, r.backend): r for r in baseline_list}
+    out = []
+    for r in result_list:
+        b = baseline_map.get((r.workload, r.backend), None)
+        if b is None:
+            continue
+        p99 = max(latency.p99_us for latency in r.latency.values())
+        b_p99 = max(latency.p99_us for latency in b.latency.values())
+        out.append((r.workload, r.backend, r.throughput / b.throughput, p99 / b_p99 if b_p99 > 0 else 0.0))
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="buffer_db benchmark")
+    parser.add_argument("--workload", nargs="+", default=list(WORKLOADS), choices=list(WORKLOADS))
+    parser.add_argument("--backend", nargs="+", default=["buffer", "file"], choices=["buffer", "file", "mmap", "wal"])
+    parser.add_argument("--num_keys", type=int, default=None)
+    parser.add_argument("--num_ops", type=int, default=None)
+    parser.add_argument("--key_distribution", default=None, choices=["uniform", "zipfian", "latest"])
+    parser.add_argument("--value_distribution", default=None, choices=["constant", "uniform", "zipfian"])
+    parser.add_argument("--min_value_size", type=int, default=None)
+    parser.add_argument("--max_value_size", type=int, default=None)
+    parser.add_argument("--block_size", type=int, default=4096)
+    parser.add_argument("--cache_size", type=int, default=0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="write results as json")
+    parser.add_argument("--baseline", default=None, help="compare with results of a previous --output")
+    args = parser.parse_args()
+
+    override = {
+        name: getattr(args, name)
+        for name in ["num_keys", "num_ops", "key_distribution", "value_distribution", "min_value_size",
+                     "max_value_size"]
+        if getattr(args, name) is not None
+    }
+    result_list = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.workload:
+            workload = Workload(**(WORKLOADS[name].dict() | override))
+            for backend in args.backend:
+                # the log of every operation goes to stdout, it is kept apart from the results
+                with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+                    result = run_backend(
+                        workload, backend, directory,
+                        seed=args.seed, block_size=args.block_size, cache_size=args.cache_size,
+                    )
+                result_list.append(result)
+                print(json.dumps(result.dict()))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump([result.dict() for result in result_list], f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline_list = [Result(**o) for o in json.load(f)]
+        for workload, backend, throughput_ratio, p99_ratio in compare(baseline_list, result_list):
+            print(f"{workload} {backend}: throughput x{throughput_ratio:.3f}, p99 x{p99_ratio:.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import collections
+import threading
+from typing import Optional, Tuple, OrderedDict, Union
+
+from .model import Key, BlockInfo
+
+
+class Cache:
+    """
+    LRU cache of values bounded by a byte budget
+
+    - a value is cached with the block_info it was read from, it is a hit only for the same block_info,
+      so that readers of different versions share the cache
+    - values are invalidated when their key is changed
+    """
+    budget: int
+    size: int
+    entry_map: OrderedDict[Key, Tuple[BlockInfo, Union[bytes, memoryview]]]
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.size = 0
+        self.entry_map = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Key, block_info: BlockInfo) -> Optional[Union[bytes, memoryview]]:
+        with self.lock:
+            entry = self.entry_map.get(key, None)
+            if entry is None or entry[0] is not block_info:
+                self.misses += 1
+                return None
+            self.entry_map.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Key, block_info: BlockInfo, value: Union[bytes, memoryview]):
+        if len(value) > self.budget:
+            return
+        with self.lock:
+            self.__pop(key)
+            self.entry_map[key] = (block_info, value)
+            self.size += len(value)
+            while self.size > self.budget:
+                _, (_, evicted) = self.entry_map.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, key: Key):
+        with self.lock:
+            self.__pop(key)
+
+    def __pop(self, key: Key):
+        entry = self.entry_map.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
@@ -0,0 +1,298 @@
+"""
+binary metadata format
+
+    [metadata] = [checkpoint][journal]...[journal]
+
+    [checkpoint] = MAGIC VERSION <header_size> <num_blocks> [free_list] <num_entries> [page_list] [entry]...
+    [journal]    = JOURNAL       <num_blocks> [free_list] <num_entries> [entry]...
+
+    [free_list]  = <num_runs> (start, length)... as little endian uint64 array
+    [page_list]  = <num_pages> (<key_length> first_key <page_size> <page_entries>)...
+    [entry]      = <key_length> key flags [<length> [compression <value_length>] [<offset>] [extent_list]]
+    [extent_list] = <num_runs> (<start_delta> <run_length>)...
+
+    - <x> is unsigned LEB128 varint, start_delta is zigzag encoded relative to the end of the previous run
+    - flags is 0 for a deleted key (journal only), otherwise PRESENT with COMPRESSED and SLAB bits,
+      compression and value_length follow if COMPRESSED is set, offset in the first block follows if SLAB is set
+    - version 1 has no COMPRESSED and SLAB bits, version 1 and 2 have no header_size and page_list
+    - each journal records only the entries changed by one context, later journals override earlier ones
+    - checkpoint entries are sorted by key, the checkpoint is a sorted run of the key index
+    - header_size is the size from num_blocks to the end of page_list, page_list splits checkpoint entries
+      into pages of about PAGE_SIZE bytes so that entries can be loaded page by page
+"""
+
+import array
+import json
+import sys
+from typing import Dict, List, Optional, Tuple
+
+from .model import Metadata, BlockInfo, Block, Key, Extent
+
+MAGIC = b"BFDB"
+VERSION = 3
+JOURNAL = b"J"
+PAGE_SIZE = 4096
+
+PRESENT = 0x01
+COMPRESSED = 0x02
+SLAB = 0x04
+
+
+def encode_varint(out: bytearray, n: int):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def decode_varint(b: bytes, i: int) -> Tuple[int, int]:
+    byte = b[i]
+    if byte < 0x80:
+        return byte, i + 1
+    n = 0
+    shift = 0
+    while True:
+        byte = b[i]
+        i += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, i
+        shift += 7
+
+
+def _to_runs(block_list: List[Block]) -> List[Extent]:
+    run_list = []
+    for block in block_list:
+        if len(run_list) > 0 and run_list[-1][0] + run_list[-1][1] == block:
+            run_list[-1] = (run_list[-1][0], run_list[-1][1] + 1)
+        else:
+            run_list.append((block, 1))
+    return run_list
+
+
+def _encode_extent_list(out: bytearray, extent_list: List[Extent]):
+    encode_varint(out, len(extent_list))
+    prev_end = 0
+    for start, length in extent_list:
+        delta = start - prev_end
+        encode_varint(out, (delta << 1) ^ (delta >> 63))  # zigzag
+        encode_varint(out, length)
+        prev_end = start + length
+
+
+def _decode_extent_list(b: bytes, i: int) -> Tuple[List[Extent], int]:
+    num_runs, i = decode_varint(b, i)
+    extent_list = []
+    prev_end = 0
+    for _ in range(num_runs):
+        zigzag, i = decode_varint(b, i)
+        length, i = decode_varint(b, i)
+        start = prev_end + ((zigzag >> 1) ^ -(zigzag & 1))
+        extent_list.append((start, length))
+        prev_end = start + length
+    return extent_list, i
+
+
+def _encode_free_list(out: bytearray, free_list: List[Extent]):
+    encode_varint(out, len(free_list))
+    a = array.array("Q", [x for extent in free_list for x in extent])
+    if sys.byteorder != "little":
+        a.byteswap()
+    out += a.tobytes()
+
+
+def _decode_free_list(b: bytes, i: int) -> Tuple[List[Extent], int]:
+    num_runs, i = decode_varint(b, i)
+    a = array.array("Q")
+    a.frombytes(b[i:i + 16 * num_runs])
+    if sys.byteorder != "little":
+        a.byteswap()
+    free_list = [(a[j], a[j + 1]) for j in range(0, len(a), 2)]
+    return free_list, i + 16 * num_runs
+
+
+def _encode_entry(out: bytearray, key: Key, block_info: Optional[BlockInfo]):
+    key_bytes = key.encode("utf-8")
+    encode_varint(out, len(key_bytes))
+    out += key_bytes
+    if block_info is None:
+        out.append(0)
+        return
+    flags = PRESENT
+    if block_info.compression != 0:
+        flags |= COMPRESSED
+    if block_info.slab:
+        flags |= SLAB
+    out.append(flags)
+    encode_varint(out, block_info.length)
+    if flags & COMPRESSED:
+        out.append(block_info.compression)
+        encode_varint(out, block_info.value_length)
+    if flags & SLAB:
+        encode_varint(out, block_info.offset)
+    _encode_extent_list(out, block_info.extent_list)
+
+
+def encode_checkpoint(meta: Metadata, key_list: Optional[List[Key]] = None) -> bytes:
+    """
+    :param key_list: sorted keys of block_map, sorted here if None
+    """
+    if key_list is None:
+        key_list = sorted(meta.block_map)
+    entries = bytearray()
+    page_list = []  # (first key, size, number of entries)
+    for key in key_list:
+        if len(page_list) == 0 or page_list[-1][1] >= PAGE_SIZE:
+            page_list.append((key, 0, 0))
+        start = len(entries)
+        _encode_entry(entries, key, meta.block_map[key])
+        first_key, size, num_entries = page_list[-1]
+        page_list[-1] = (first_key, size + len(entries) - start, num_entries + 1)
+    header = bytearray()
+    encode_varint(header, meta.num_blocks)
+    _encode_free_list(header, meta.unused_extent_list)
+    encode_varint(header, len(key_list))
+    encode_varint(header, len(page_list))
+    for first_key, size, num_entries in page_list:
+        key_bytes = first_key.encode("utf-8")
+        encode_varint(header, len(key_bytes))
+        header += key_bytes
+        encode_varint(header, size)
+        encode_varint(header, num_entries)
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    encode_varint(out, len(header))
+    out += header
+    out += entries
+    return bytes(out)
+
+
+def encode_journal(meta: Metadata, key_set) -> bytes:
+    out = bytearray(JOURNAL)
+    encode_varint(out, meta.num_blocks)
+    _encode_free_list(out, meta.unused_extent_list)
+    encode_varint(out, len(key_set))
+    for key in key_set:
+        _encode_entry(out, key, meta.block_map.get(key, None))
+    return bytes(out)
+
+
+def decode_entries(b: bytes, i: int, num_entries: int, entry_map: Dict[Key, Optional[BlockInfo]],
+                   keep_deleted: bool = False) -> int:
+    """
+    decode entries into entry_map, deleted keys are removed or set to None if keep_deleted
+
+    :return: position after the entries
+    """
+    for _ in range(num_entries):
+        key_length, i = decode_varint(b, i)
+        key = b[i:i + key_length].decode("utf-8")
+        i += key_length
+        flags = b[i]
+        i += 1
+        if flags == 0:
+            if keep_deleted:
+                entry_map[key] = None
+            else:
+                entry_map.pop(key, None)
+            continue
+        length, i = decode_varint(b, i)
+        compression, value_length, offset = 0, None, 0
+        if flags & COMPRESSED:
+            compression = b[i]
+            value_length, i = decode_varint(b, i + 1)
+        if flags & SLAB:
+            offset, i = decode_varint(b, i)
+        extent_list, i = _decode_extent_list(b, i)
+        entry_map[key] = BlockInfo.construct(
+            extent_list=extent_list, length=length, offset=offset, slab=flags & SLAB != 0,
+            compression=compression, value_length=value_length,
+        )
+    return i
+
+
+def _decode_body(b: bytes, i: int, meta: Metadata) -> int:
+    meta.num_blocks, i = decode_varint(b, i)
+    meta.unused_extent_list, i = _decode_free_list(b, i)
+    num_entries, i = decode_varint(b, i)
+    return decode_entries(b, i, num_entries, meta.block_map)
+
+
+def decode_header(b: bytes, i: int, meta: Metadata) -> Tuple[int, List[Tuple[Key, int, int]], int]:
+    """
+    decode checkpoint header from num_blocks to the end of page_list
+
+    :return: number of entries, page_list of (first key, size, number of entries) and position after the header
+    """
+    meta.num_blocks, i = decode_varint(b, i)
+    meta.unused_extent_list, i = _decode_free_list(b, i)
+    num_entries, i = decode_varint(b, i)
+    num_pages, i = decode_varint(b, i)
+    page_list = []
+    for _ in range(num_pages):
+        key_length, i = decode_varint(b, i)
+        first_key = b[i:i + key_length].decode("utf-8")
+        i += key_length
+        size, i = decode_varint(b, i)
+        page_entries, i = decode_varint(b, i)
+        page_list.append((first_key, size, page_entries))
+    return num_entries, page_list, i
+
+
+def decode_journals(b: bytes, i: int, meta: Metadata, entry_map: Dict[Key, Optional[BlockInfo]]) -> int:
+    """
+    decode journals into entry_map, deleted keys are set to None
+    """
+    while i < len(b):
+        if b[i:i + len(JOURNAL)] != JOURNAL:
+            raise Exception("metadata journal")
+        meta.num_blocks, i = decode_varint(b, i + len(JOURNAL))
+        meta.unused_extent_list, i = _decode_free_list(b, i)
+        num_entries, i = decode_varint(b, i)
+        i = decode_entries(b, i, num_entries, entry_map, keep_deleted=True)
+    return i
+
+
+def is_binary(b: bytes) -> bool:
+    return b[:len(MAGIC)] == MAGIC
+
+
+def decode_metadata(b: bytes) -> Tuple[Metadata, int]:
+    """
+    decode checkpoint followed by journals
+
+    :return: metadata and size of the checkpoint
+    """
+    if not is_binary(b):
+        raise Exception("metadata magic")
+    version = b[len(MAGIC)]
+    if version not in (1, 2, VERSION):
+        raise Exception(f"metadata version {version}")
+    meta = Metadata.construct(num_blocks=0, block_map={}, unused_extent_list=[])
+    if version == VERSION:
+        _, i = decode_varint(b, len(MAGIC) + 1)
+        num_entries, _, i = decode_header(b, i, meta)
+        i = decode_entries(b, i, num_entries, meta.block_map)
+    else:
+        i = _decode_body(b, len(MAGIC) + 1, meta)
+    checkpoint_size = i
+    while i < len(b):
+        if b[i:i + len(JOURNAL)] != JOURNAL:
+            raise Exception("metadata journal")
+        i = _decode_body(b, i + len(JOURNAL), meta)
+    return meta, checkpoint_size
+
+
+def decode_legacy_metadata(b: bytes) -> Metadata:
+    """
+    decode json metadata with per block lists
+    """
+    o = json.loads(b)
+    return Metadata.construct(
+        num_blocks=o["num_blocks"],
+        block_map={
+            key: BlockInfo.construct(extent_list=_to_runs(block_info["block_list"]), length=block_info["length"])
+            for key, block_info in o["block_map"].items()
+        },
+        unused_extent_list=_to_runs(o["unused_block_list"]),
+    )
@@ -0,0 +1,72 @@
+import lzma
+import zlib
+from typing import Optional, Tuple, Union
+
+NONE = 0
+ZLIB = 1
+LZMA = 2
+
+
+def compress(b: bytes, zlib_threshold: Optional[int], lzma_threshold: Optional[int]) -> Tuple[bytes, int]:
+    """
+    compress b by lzma if it is at least lzma_threshold bytes, by zlib if it is at least zlib_threshold bytes
+
+    :return: stored bytes and compression, b is stored as is if it does not get smaller
+    """
+    if lzma_threshold is not None and len(b) >= lzma_threshold:
+        compression, out = LZMA, lzma.compress(b)
+    elif zlib_threshold is not None and len(b) >= zlib_threshold:
+        compression, out = ZLIB, zlib.compress(b)
+    else:
+        return b, NONE
+    if len(out) >= len(b):
+        return b, NONE
+    return out, compression
+
+
+def decompress(b: Union[bytes, memoryview], compression: int) -> Union[bytes, memoryview]:
+    if compression == NONE:
+        return b
+    if compression == ZLIB:
+        return zlib.decompress(b)
+    if compression == LZMA:
+        return lzma.decompress(b)
+    raise Exception(f"compression {compression}")
+
+
+class Decompressor:
+    """
+    incremental decompression with bounded output
+    """
+    compression: int
+    tail: bytes  # input not consumed by zlib
+
+    def __init__(self, compression: int):
+        self.compression = compression
+        self.tail = b""
+        if compression == ZLIB:
+            self.obj = zlib.decompressobj()
+        elif compression == LZMA:
+            self.obj = lzma.LZMADecompressor()
+        else:
+            raise Exception(f"compression {compression}")
+
+    @property
+    def eof(self) -> bool:
+        return self.obj.eof
+
+    @property
+    def needs_input(self) -> bool:
+        if self.compression == ZLIB:
+            return len(self.tail) == 0
+        return self.obj.needs_input
+
+    def decompress(self, b: Union[bytes, memoryview], max_length: int) -> bytes:
+        """
+        decompress b following the previous input, at most max_length bytes are returned
+        """
+        if self.compression == ZLIB:
+            out = self.obj.decompress(self.tail + bytes(b), max_length)
+            self.tail = self.obj.unconsumed_tail
+            return out
+        return self.obj.decompress(b, max_length)
@@ -1,47 +1,510 @@
 from __future__ import annotations
 
+import bisect
+import collections
+import contextlib
+import heapq
+import io
 import os
-from typing import BinaryIO, Union, Set, Optional
+import threading
+from typing import BinaryIO, Union, Set, Optional, List, Tuple, Deque, Dict, Iterable, Iterator, Callable, ContextManager
 
-from .io import IO
-from .model import Config, Metadata, Block, Key, BlockInfo, Stats
+from . import codec
+from .alloc import Allocator
+from .cache import Cache
+from .compress import NONE, compress, decompress, Decompressor
+from .io import IO, File, MmapIO
+from .model import Config, Metadata, Key, BlockInfo, Stats, Extent, Block
+from .wal import WAL, WRITE, DELETE
 from ..logger import logger
 
+SCAN_CHUNK = 1024  # number of keys read at a time by scan
+STREAM_CHUNK = 1024 * 1024  # number of bytes read or written at a time by streams
+
+
+def range_list(block_size: int, extent_list: List[Extent], length: int, offset: int = 0) -> List[Tuple[int, int, int]]:
+    """
+    coalesce adjacent extents into (file offset, value offset, size) ranges covering length bytes
+    starting from offset in the first block
+    """
+    out = []
+    pos = 0
+    for start, num_blocks in extent_list:
+        skip = offset if pos == 0 else 0
+        size = min(num_blocks * block_size - skip, length - pos)
+        if size <= 0:
+            break
+        file_offset = start * block_size + skip
+        if len(out) > 0 and out[-1][0] + out[-1][2] == file_offset:
+            out[-1] = (out[-1][0], out[-1][1], out[-1][2] + size)
+        else:
+            out.append((file_offset, pos, size))
+        pos += size
+    return out
+
+
+def read_stored(file: IO, block_size: int, block_info: BlockInfo) -> Union[bytes, memoryview]:
+    """
+    read stored bytes of block_info
+
+    memoryview is returned by IO supporting zero copy view if the stored bytes are in a single range,
+    stored bytes in many ranges are read into a buffer returned as a read-only memoryview without another copy
+    """
+    r_list = range_list(block_size, block_info.extent_list, block_info.length, block_info.offset)
+    if len(r_list) == 1:
+        view = file.view(r_list[0][0], block_info.length)
+        if view is not None:
+            return view
+        return file.pread(block_info.length, r_list[0][0])
+    value = bytearray(block_info.length)
+    with memoryview(value) as view:
+        for offset, pos, size in r_list:
+            file.preadv([view[pos:pos + size]], offset)
+    return memoryview(value).toreadonly()
+
+
+def read_value(file: IO, block_size: int, block_info: BlockInfo) -> Union[bytes, memoryview]:
+    """
+    read value of block_info
+
+    memoryview is returned by IO supporting zero copy view if the value is not compressed and in a single range
+    """
+    return decompress(read_stored(file, block_size, block_info), block_info.compression)
+
+
+def is_view(file: IO, block_size: int, block_info: BlockInfo) -> bool:
+    """
+    whether read_value of block_info returns a zero copy view
+    """
+    return (
+            file.zero_copy and block_info.compression == NONE and block_info.length > 0 and
+            len(range_list(block_size, block_info.extent_list, block_info.length, block_info.offset)) == 1
+    )
+
+
+def read_cached(cache: Optional[Cache], file: IO, block_size: int, key: Key,
+                block_info: BlockInfo) -> Union[bytes, memoryview]:
+    """
+    read value of block_info through cache
+
+    zero copy views are not cached, they are already served by the IO without copy, nor counted as misses
+    """
+    if cache is None or is_view(file, block_size, block_info):
+        return read_value(file, block_size, block_info)
+    value = cache.get(key, block_info)
+    if value is None:
+        # not a view of the file, the value owns its buffer
+        value = read_value(file, block_size, block_info)
+        cache.put(key, block_info, value)
+    return value
+
+
+def scan_keys(key_list: Callable[[], List[Key]], lock: ContextManager, prefix: str = "",
+              start: Optional[Key] = None, end: Optional[Key] = None) -> Iterator[Key]:
+    """
+    iterate sorted keys with prefix in [start, end) lazily, key_list is read in chunks under lock
+    """
+    lower = prefix if start is None else max(start, prefix)
+    last = None
+    while True:
+        with lock:
+            keys = key_list()
+            i = bisect.bisect_left(keys, lower) if last is None else bisect.bisect_right(keys, last)
+            chunk = keys[i:i + SCAN_CHUNK]
+        if len(chunk) == 0:
+            return
+        for key in chunk:
+            if (end is not None and key >= end) or not key.startswith(prefix):
+                return
+            yield key
+        last = chunk[-1]
+
+
+class Snapshot:
+    """
+    read-only view of a context pinned to a metadata version
+
+    - extents visible to a snapshot are not overwritten nor reused by the writer until the snapshot is released
+    - reads do not take the writer lock, snapshots can be read from many threads
+    """
+    ctx: Context
+    version: int
+    block_map: Dict[Key, BlockInfo]
+    key_list: List[Key]
+
+    def __init__(self, ctx: Context, version: int, block_map: Dict[Key, BlockInfo], key_list: List[Key]):
+        self.ctx = ctx
+        self.version = version
+        self.block_map = block_map
+        self.key_list = key_list
+        self.released = False
+
+    def __enter__(self) -> Snapshot:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def keys(self) -> Set[Key]:
+        return set(self.block_map.keys())
+
+    def __len__(self) -> int:
+        return len(self.block_map)
+
+    def __contains__(self, key: Key) -> bool:
+        return key in self.block_map
+
+    def scan(self, prefix: str = "", start: Optional[Key] = None, end: Optional[Key] = None) -> Iterator[Key]:
+        """
+        iterate keys with prefix in [start, end) in order
+        """
+        return scan_keys(lambda: self.key_list, contextlib.nullcontext(), prefix=prefix, start=start, end=end)
+
+    def read(self, key: Key) -> Optional[Union[bytes, memoryview]]:
+        block_info = self.block_map.get(key, None)
+        if block_info is None:
+            return None
+        return read_cached(self.ctx.cache, self.ctx.file, self.ctx.cfg.block_size, key, block_info)
+
+    def open_reader(self, key: Key) -> Optional[ValueReader]:
+        """
+        file-like reader of the value of key, None if key does not exist,
+        it is readable until the snapshot is released
+        """
+        block_info = self.block_map.get(key, None)
+        if block_info is None:
+            return None
+        return ValueReader(self.ctx.file, self.ctx.cfg.block_size, block_info)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.ctx.release_snapshot(self)
+
+
+class ValueReader(io.RawIOBase):
+    """
+    file-like reader of a value, stored bytes are read lazily chunk by chunk
+
+    - the value is readable until the reader is closed even if the key is written or deleted meanwhile
+    - uncompressed value is seekable, compressed value is decompressed incrementally with bounded memory
+    """
+    file: IO
+    range_list: List[Tuple[int, int, int]]  # (file offset, stored offset, size)
+    length: int  # number of stored bytes
+    pos: int  # position in the value
+    stored_pos: int  # position in the stored bytes, compressed value only
+    decompressor: Optional[Decompressor]
+    pending: bytes  # decompressed bytes not read yet
+    release: Optional[Callable[[], None]]  # called on close
+
+    def __init__(self, file: IO, block_size: int, block_info: BlockInfo,
+                 release: Optional[Callable[[], None]] = None, chunk_size: int = STREAM_CHUNK):
+        super().__init__()
+        self.file = file
+        self.range_list = range_list(block_size, block_info.extent_list, block_info.length, block_info.offset)
+        self.length = block_info.length
+        self.pos = 0
+        self.stored_pos = 0
+        self.decompressor = None if block_info.compression == NONE else Decompressor(block_info.compression)
+        self.pending = b""
+        self.release = release
+        self.chunk_size = chunk_size
+
+    def __read_stored(self, b: memoryview, pos: int) -> int:
+        """
+        read stored bytes starting from pos into b
+        """
+        i = bisect.bisect_right(self.range_list, pos, key=lambda r: r[1]) - 1
+        n = 0
+        while n < len(b) and 0 <= i < len(self.range_list):
+            file_offset, stored_offset, size = self.range_list[i]
+            skip = pos + n - stored_offset
+            k = min(size - skip, len(b) - n)
+            self.file.preadv([b[n:n + k]], file_offset + skip)
+            n += k
+            i += 1
+        return n
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return self.decompressor is None
+
+    def readinto(self, b: Union[bytearray, memoryview]) -> int:
+        with memoryview(b) as view, view.cast("B") as view:
+            if self.decompressor is None:
+                n = self.__read_stored(view[:max(0, min(len(view), self.length - self.pos))], self.pos)
+                self.pos += n
+                return n
+            while len(self.pending) == 0 and not self.decompressor.eof:
+                stored = b""
+                if self.decompressor.needs_input:
+                    if self.stored_pos >= self.length:
+                        break  # truncated
+                    chunk = bytearray(min(self.chunk_size, self.length - self.stored_pos))
+                    with memoryview(chunk) as chunk_view:
+                        self.stored_pos += self.__read_stored(chunk_view, self.stored_pos)
+                    stored = chunk
+                self.pending = self.decompressor.decompress(stored, self.chunk_size)
+            n = min(len(view), len(self.pending))
+            view[:n] = self.pending[:n]
+            self.pending = self.pending[n:]
+            self.pos += n
+            return n
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if self.decompressor is not None:
+            raise Exception("compressed value is not seekable")
+        if whence == os.SEEK_SET:
+            self.pos = offset
+        elif whence == os.SEEK_CUR:
+            self.pos += offset
+        elif whence == os.SEEK_END:
+            self.pos = self.length + offset
+        else:
+            raise Exception("seek whence")
+        return self.pos
+
+    def tell(self) -> int:
+        return self.pos
+
+    def close(self):
+        if not self.closed and self.release is not None:
+            self.release()
+        super().close()
+
+
+class ValueWriter(io.RawIOBase):
+    """
+    file-like writer of a value, blocks are allocated and written as data arrives
+
+    - the value is set on close, an exception in a with statement or dropping the writer without close discards it
+    - the value is stored uncompressed and not packed into a slab block
+    """
+    ctx: Context
+    key: Key
+    chunk_size: int  # multiple of block_size
+    buffer: bytearray  # bytes not written yet
+    extent_list: List[Extent]
+    length: int
+
+    def __init__(self, ctx: Context, key: Key, chunk_size: int = STREAM_CHUNK):
+        super().__init__()
+        self.ctx = ctx
+        self.key = key
+        block_size = ctx.cfg.block_size
+        self.chunk_size = max(1, chunk_size // block_size) * block_size
+        self.buffer = bytearray()
+        self.extent_list = []
+        self.length = 0
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    def writable(self) -> bool:
+        return True
+
+    def __flush_chunk(self, n: int):
+        with memoryview(self.buffer) as view:
+            start, num_blocks = self.ctx.write_extent(view[:n])
+        del self.buffer[:n]
+        self.length += n
+        if len(self.extent_list) > 0 and sum(self.extent_list[-1]) == start:
+            # coalesce with the previous extent
+            self.extent_list[-1] = (self.extent_list[-1][0], self.extent_list[-1][1] + num_blocks)
+        else:
+            self.extent_list.append((start, num_blocks))
+
+    def write(self, b: Union[bytes, bytearray, memoryview]) -> int:
+        if self.closed:
+            raise Exception("write to closed writer")
+        self.buffer += b
+        while len(self.buffer) >= self.chunk_size:
+            self.__flush_chunk(self.chunk_size)
+        return len(b)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if len(self.buffer) > 0:
+                self.__flush_chunk(len(self.buffer))
+            self.ctx.commit_writer(self.key, self.extent_list, self.length)
+        finally:
+            super().close()
+
+    def abort(self):
+        """
+        discard the value, its blocks are freed
+        """
+        if self.closed:
+            return
+        self.ctx.abort_writer(self.extent_list)
+        self.extent_list = []
+        super().close()
+
+    def __del__(self):
+        # IOBase.__del__ would close, that is commit, a value never closed
+        self.abort()
+        super().__del__()
+
 
 class Context:
     cfg: Config
-    file: Union[BinaryIO, IO]
+    file: IO
     meta: Metadata
+    key_list: List[Key]  # sorted keys of block_map
+    batch_key_set: Optional[Set[Key]]  # keys changed by the running batch, merged into key_list at its end
+    alloc: Allocator
+    meta_start: Optional[int]  # position of metadata on file, None if it must be rewritten as a checkpoint
+    meta_end: int
+    checkpoint_size: int
+    journal_size: int
+    dirty: Set[Key]  # keys changed since metadata was written
+    wal: Optional[WAL]
+    deferred: Deque[Tuple[int, int, Extent]]  # (lsn, version, extent) freed extents not yet reusable
+    version: int  # number of writes and deletes applied
+    pinned: Dict[int, int]  # version -> number of live snapshots
+    shared: bool  # block_map and key_list are referenced by a snapshot, they are copied before the next change
+    lock: threading.RLock  # writer lock, also taken by reads of context and compaction, not by snapshot reads
+    relocated: List[Tuple[int, Extent]]  # (version, extent) moved from by compaction in wal mode
+    compaction: List[Tuple[Block, Key]]  # (last block, key) of objects to move in the current pass, sorted
+    compaction_total: int  # blocks planned in the current pass
+    compaction_moved: int  # blocks moved in the current pass
+    reclaimed_blocks: int  # blocks removed from the end of file by compaction
+    slab_live: Dict[Block, int]  # slab block -> number of live objects
+    slab_block: Optional[Block]  # slab block being filled
+    slab_end: int  # end of the objects in the slab block being filled
+    cache: Optional[Cache]  # LRU cache of read values, None if disabled
     using: bool
 
-    def __init__(self, file: Union[BinaryIO, IO], block_size: int, index_size: int):
+    def __init__(self, file: Union[BinaryIO, IO], block_size: int, index_size: int, wal: Optional[WAL] = None,
+                 compress_threshold: Optional[int] = None, lzma_threshold: Optional[int] = None,
+                 slab_threshold: Optional[int] = None, cache_size: int = 0, journal_budget: int = 1 << 20):
         """
         FileDB
 
         memory structure
 
             [file] = [block][block]...[block][block][metadata][start_of_metadata]
+            [metadata] = [checkpoint][journal]...[journal]
 
             - start_of_metadata is position of meta
             - metadata contains necessary information to get records
-            - object is written into blocks
-            - object is deleted leads to unused blocks
-            - unused blocks will be allocated for newly inserted object
+            - checkpoint contains all metadata, journal contains keys changed by a context
+            - journal is appended on context exit, checkpoint is rewritten when journals grow larger than
+              the checkpoint or than journal_budget bytes, so that readers opening the file decode few journals
+            - object is written into an extent of contiguous blocks
+            - object is deleted leads to unused extents, adjacent unused extents are coalesced
+            - unused extents will be allocated for newly inserted object by best-fit
+
+        write-ahead log mode
+
+            - every write and delete is appended to wal before it is applied
+            - objects are never overwritten in place, freed extents are reused once their wal record is durable
+            - on exit, metadata checkpoint is written and fsync-ed, then wal is reset to a copy of the checkpoint
+            - on init, wal checkpoint is loaded instead of file metadata and wal records are replayed
+
+        snapshot
+
+            - snapshot keeps the block_map and key_list of its version, the writer copies them on its first change after
+            - while snapshots are live, objects are never overwritten in place,
+              freed extents are reused once all snapshots older than the change are released
+
+        compaction
+
+            - a pass plans objects lying after the total size of live objects, and moves them in bounded steps
+              into free extents before them, last object first
+            - when a pass is done, checkpoint is written at the new end of file and the file is truncated
+            - in write-ahead log mode, extents moved from are reused after the next checkpoint
+
+        compression and slab
+
+            - object of at least compress_threshold (lzma_threshold) bytes is compressed by zlib (lzma),
+              it is stored as is if it does not get smaller
+            - object of at most slab_threshold stored bytes is appended into a slab block shared by small objects,
+              its position in the block is kept in metadata
+            - slab block is freed when its last object is deleted, compaction moves objects one by one
+              into a slab block before them
+
+        key index
+
+            - sorted keys are kept alongside block_map, scan iterates keys by prefix or range in order
+            - checkpoint is written in key order, sorting keys on open is linear for a file without journals
+
+        stream
+
+            - open_writer allocates and writes blocks as data arrives, the value is set on close
+            - open_reader pins the current version like a snapshot and reads stored bytes chunk by chunk
+
+        cache
+
+            - values read are kept in an LRU cache bounded by cache_size bytes
+            - a cached value is served only for the block_info it was read from,
+              it is invalidated when its key is written, deleted or moved by compaction
 
         """
-        self.cfg = Config(block_size=block_size, index_size=index_size)
-        self.file = file
+        if slab_threshold is not None and slab_threshold > block_size:
+            raise Exception("slab_threshold larger than block_size")
+        self.cfg = Config(
+            block_size=block_size, index_size=index_size,
+            compress_threshold=compress_threshold, lzma_threshold=lzma_threshold, slab_threshold=slab_threshold,
+            cache_size=cache_size, journal_budget=journal_budget,
+        )
+        self.file = file if isinstance(file, IO) else File(file)
+        self.meta_start = None
+        self.meta_end = 0
+        self.checkpoint_size = 0
+        self.journal_size = 0
+        self.dirty = set()
+        self.wal = wal
+        self.deferred = collections.deque()
+        self.version = 0
+        self.pinned = {}
+        self.shared = False
+        self.batch_key_set = None
+        self.lock = threading.RLock()
+        self.relocated = []
+        self.compaction = []
+        self.compaction_total = 0
+        self.compaction_moved = 0
+        self.reclaimed_blocks = 0
+        self.slab_live = {}
+        self.slab_block = None
+        self.slab_end = 0
+        self.cache = Cache(cache_size) if cache_size > 0 else None
+        checkpoint, record_list = (None, []) if self.wal is None else self.wal.recover()
         is_new_file = self.file.seek(0, os.SEEK_END) == 0
-        if not is_new_file:
+        if checkpoint is not None:
+            # file metadata might be overwritten after the checkpoint
+            self.meta, _ = codec.decode_metadata(checkpoint)
+        elif not is_new_file:
             self.__read_metadata()
         else:
             self.meta = Metadata(
                 num_blocks=0,
-                value_length_map={},
                 block_map={},
-                unused_block_list=[],
+                unused_extent_list=[],
             )
-            self.__write_metadata()
+        self.alloc = Allocator(num_blocks=self.meta.num_blocks, extent_list=self.meta.unused_extent_list)
+        self.key_list = sorted(self.meta.block_map)
+        for block_info in self.meta.block_map.values():
+            if block_info.slab:
+                block = block_info.extent_list[0][0]
+                self.slab_live[block] = self.slab_live.get(block, 0) + 1
+        with self.__batch():
+            for _, op, key, value in record_list:
+                if op == WRITE:
+                    self.__write(key, value, None)
+                else:
+                    self.__delete(key, None)
+        if is_new_file or (self.wal is not None and (checkpoint is None or len(record_list) > 0)):
+            self.__write_metadata(force=True)
         self.using = False
 
     def __enter__(self) -> Context:
@@ -60,12 +523,67 @@ class Context:
             signed=False,
         )
         self.file.seek(start_of_meta)
-        self.meta = Metadata.parse_raw(self.file.read(end_of_meta - start_of_meta))
+        b = self.file.read(end_of_meta - start_of_meta)
+        if not codec.is_binary(b):  # legacy json metadata, rewritten as checkpoint on exit
+            self.meta = codec.decode_legacy_metadata(b)
+            return
+        self.meta, self.checkpoint_size = codec.decode_metadata(b)
+        if b[len(codec.MAGIC)] != codec.VERSION:  # older version, rewritten as checkpoint on exit
+            return
+        self.meta_start = start_of_meta
+        self.meta_end = end_of_meta
+        self.journal_size = end_of_meta - start_of_meta - self.checkpoint_size
 
-    def __write_metadata(self):
+    def __write_metadata(self, force: bool = False):
+        with self.lock:
+            if self.wal is not None:
+                if not force and len(self.dirty) == 0:
+                    return
+                self.wal.sync()
+                self.__release_deferred()
+            self.meta.num_blocks = self.alloc.num_blocks
+            # extents deferred for snapshots are free on file
+            self.meta.unused_extent_list = sorted(
+                self.alloc.extent_list() +
+                [extent for _, _, extent in self.deferred] +
+                [extent for _, extent in self.relocated]
+            )
+            if self.wal is not None:
+                checkpoint = self.__write_checkpoint()
+                self.file.fsync()
+                self.wal.reset(checkpoint)
+                # checkpoint points to objects at their new extents
+                self.deferred.extend((0, version, extent) for version, extent in self.relocated)
+                self.relocated.clear()
+                return
+            if self.meta_start is not None and not force:
+                if len(self.dirty) == 0:
+                    return
+                journal = codec.encode_journal(self.meta, self.dirty)
+                if self.journal_size + len(journal) <= min(self.checkpoint_size, self.cfg.journal_budget):
+                    self.file.seek(self.meta_end)
+                    self.file.write(journal)
+                    self.__write_start_of_meta(self.meta_start)
+                    self.meta_end += len(journal)
+                    self.journal_size += len(journal)
+                    self.dirty.clear()
+                    return
+            self.__write_checkpoint()
+
+    def __write_checkpoint(self) -> bytes:
         start_of_meta = self.cfg.block_size * self.meta.num_blocks
+        checkpoint = codec.encode_checkpoint(self.meta, self.key_list)
         self.file.seek(start_of_meta)
-        self.file.write(self.meta.json().encode("utf-8"))
+        self.file.write(checkpoint)
+        self.__write_start_of_meta(start_of_meta)
+        self.meta_start = start_of_meta
+        self.meta_end = start_of_meta + len(checkpoint)
+        self.checkpoint_size = len(checkpoint)
+        self.journal_size = 0
+        self.dirty.clear()
+        return checkpoint
+
+    def __write_start_of_meta(self, start_of_meta: int):
         self.file.write(start_of_meta.to_bytes(
             length=self.cfg.index_size,
             byteorder="little",
@@ -73,109 +591,483 @@ class Context:
         ))
         self.file.truncate()
 
-    def __create_blocks_local(self, num_create_blocks: int):  # _local does not write to file
-        if num_create_blocks == 0:
-            return
-        self.meta.unused_block_list.extend(range(self.meta.num_blocks, self.meta.num_blocks + num_create_blocks))
-        self.meta.num_blocks += num_create_blocks
+    def __release_deferred(self):
+        with self.lock:
+            durable_lsn = self.wal.durable_lsn if self.wal is not None else 0
+            oldest_version = min(self.pinned) if len(self.pinned) > 0 else self.version
+            while len(self.deferred) > 0 and self.deferred[0][0] <= durable_lsn and \
+                    self.deferred[0][1] <= oldest_version:
+                self.alloc.free(self.deferred.popleft()[2])
 
-    def __remove_blocks_local(self, num_remove_blocks: int):  # _local does not write to file
+    def __free(self, extent: Extent, lsn: Optional[int]):
         """
-        assume
-        - unused_block_list always sorted
-        - all del blocks are at the tail of unused_block_list
+        free extent changed at current version
         """
-        if num_remove_blocks == 0:
-            return
-        self.meta.unused_block_list = self.meta.unused_block_list[:-num_remove_blocks]
-        self.meta.num_blocks -= num_remove_blocks
+        if lsn is None and len(self.pinned) == 0:
+            self.alloc.free(extent)
+        else:
+            self.deferred.append((lsn or 0, self.version, extent))
 
-    def __write_block(self, block: Block, b: bytes):
-        self.file.seek(block * self.cfg.block_size)
-        self.file.write(b)
+    def __free_value(self, block_info: BlockInfo, lsn: Optional[int], relocate: bool = False):
+        """
+        free blocks of an object changed at current version, or moved by compaction if relocate
+        """
+        if block_info.slab:
+            block = block_info.extent_list[0][0]
+            self.slab_live[block] -= 1
+            if self.slab_live[block] > 0:
+                return
+            # last object of the slab block
+            self.slab_live.pop(block)
+            if block == self.slab_block:
+                self.slab_block = None
+        for extent in block_info.extent_list:
+            if relocate and self.wal is not None:
+                # checkpoint on file and wal records still point to the old extent
+                self.relocated.append((self.version, extent))
+            else:
+                self.__free(extent, lsn)
 
-    def __read_block(self, block: Block) -> bytes:
-        self.file.seek(block * self.cfg.block_size)
-        return self.file.read(self.cfg.block_size)
+    def __alloc_slab(self, length: int, before: Optional[Block] = None) -> Optional[Tuple[Block, int]]:
+        """
+        :param before: the slab block must be before this block without growing the file
+        :return: slab block and offset in the block for length bytes, None if no block before fits
+        """
+        if self.slab_block is None or self.slab_end + length > self.cfg.block_size or \
+                (before is not None and self.slab_block >= before):
+            if before is None:
+                self.slab_block, _ = self.__alloc(1)
+            else:
+                extent = self.alloc.alloc_before(1, before)
+                if extent is None:
+                    return None
+                self.slab_block, _ = extent
+            self.slab_end = 0
+            self.slab_live[self.slab_block] = 0
+        offset = self.slab_end
+        self.slab_end += length
+        self.slab_live[self.slab_block] += 1
+        return self.slab_block, offset
+
+    def __alloc(self, length: int) -> Extent:
+        if len(self.deferred) > 0:
+            self.__release_deferred()
+        extent = self.alloc.alloc(length)
+        if self.meta_start is not None and self.cfg.block_size * self.alloc.num_blocks > self.meta_start:
+            self.meta_start = None  # new blocks overwrite metadata, journal cannot be appended
+        return extent
+
+    def __set(self, key: Key, block_info: Optional[BlockInfo]):
+        """
+        set or delete block_info of key as a new version
+        """
+        if self.shared:
+            self.meta.block_map = dict(self.meta.block_map)
+            if self.batch_key_set is None:
+                self.key_list = list(self.key_list)
+            # in a batch, key_list is replaced by the merge at its end
+            self.shared = False
+        if self.batch_key_set is not None:
+            self.batch_key_set.add(key)
+        elif block_info is None:
+            del self.key_list[bisect.bisect_left(self.key_list, key)]
+        elif key not in self.meta.block_map:
+            bisect.insort(self.key_list, key)
+        if block_info is None:
+            self.meta.block_map.pop(key)
+        else:
+            self.meta.block_map[key] = block_info
+        self.version += 1
+        self.dirty.add(key)
+        if self.cache is not None:
+            self.cache.invalidate(key)
+
+    @contextlib.contextmanager
+    def __batch(self):
+        """
+        hold the lock while keys are changed, key_list is updated by a single merge at the end
+        instead of an insert or a delete per key
+        """
+        with self.lock:
+            if self.batch_key_set is not None:
+                yield
+                return
+            self.batch_key_set = set()
+            try:
+                yield
+            finally:
+                changed, self.batch_key_set = self.batch_key_set, None
+                if len(changed) > 0:
+                    self.key_list = list(heapq.merge(
+                        (key for key in self.key_list if key not in changed),
+                        sorted(key for key in changed if key in self.meta.block_map),
+                    ))
+
+    def __write_plan(self, plan: List[Tuple[BlockInfo, bytes]]):
+        """
+        write stored bytes into their blocks in offset order, contiguous ones are written by a single vectored write
+        """
+        offset, end, buffers = 0, None, []
+        write_list = [
+            (block_info.extent_list[0][0] * self.cfg.block_size + block_info.offset, b)
+            for block_info, b in plan if len(b) > 0
+        ]
+        for o, b in sorted(write_list, key=lambda item: item[0]):
+            if o != end:
+                if len(buffers) > 0:
+                    self.file.pwritev(buffers, offset)
+                offset, end, buffers = o, o, []
+            buffers.append(memoryview(b))
+            end += len(b)
+        if len(buffers) > 0:
+            self.file.pwritev(buffers, offset)
+
+    def snapshot(self) -> Snapshot:
+        with self.lock:
+            self.shared = True
+            self.pinned[self.version] = self.pinned.get(self.version, 0) + 1
+            return Snapshot(ctx=self, version=self.version, block_map=self.meta.block_map, key_list=self.key_list)
+
+    def release_snapshot(self, snapshot: Snapshot):
+        self.__unpin(snapshot.version)
+
+    def __unpin(self, version: int):
+        with self.lock:
+            self.pinned[version] -= 1
+            if self.pinned[version] == 0:
+                self.pinned.pop(version)
 
     def keys(self) -> Set[Key]:
         return set(self.meta.block_map.keys())
 
-    def write(self, key: Key, b: bytes):
-        if key not in self.meta.block_map:
-            self.meta.block_map[key] = BlockInfo(
-                block_list=[],
-                length=0,
-            )
+    def __len__(self) -> int:
+        return len(self.meta.block_map)
 
-        # CALCULATE
-        # number of blocks of input
-        num_blocks = 1 + (len(b) - 1) // self.cfg.block_size
-        # number of blocks in old assignment will be reused
-        num_reuse_blocks = min(num_blocks, len(self.meta.block_map[key].block_list))
-        # number of blocks in unused blocks will be used
-        num_new_blocks = max(0, num_blocks - len(self.meta.block_map[key].block_list))
-        # number of new blocks to be created
-        num_create_blocks = max(
-            0,
-            num_new_blocks - len(self.meta.unused_block_list),
+    def __contains__(self, key: Key) -> bool:
+        return key in self.meta.block_map
+
+    def scan(self, prefix: str = "", start: Optional[Key] = None, end: Optional[Key] = None) -> Iterator[Key]:
+        """
+        iterate keys with prefix in [start, end) in order lazily
+
+        keys are read in chunks under the lock, keys written or deleted during the iteration
+        are seen if they are after the current chunk
+        """
+        return scan_keys(lambda: self.key_list, self.lock, prefix=prefix, start=start, end=end)
+
+    def __plan_compaction(self):
+        num_slab_bytes = sum(block_info.length for block_info in self.meta.block_map.values() if block_info.slab)
+        num_live_blocks = (num_slab_bytes + self.cfg.block_size - 1) // self.cfg.block_size + sum(
+            length
+            for block_info in self.meta.block_map.values() if not block_info.slab
+            for _, length in block_info.extent_list
         )
-        # CREATE NEW BLOCKS IF ANY
-        self.__create_blocks_local(num_create_blocks)
-        # WRITE METADATA
-        # block_list = old_assignment[:num_reused_blocks] + unused_blocks[:num_new_blocks]
-        block_list = [
-            *self.meta.block_map[key].block_list[:num_reuse_blocks],
-            *self.meta.unused_block_list[:num_new_blocks],
-        ]
-        # unused_blocks = sort(old_assignment[num_reused_blocks:] + unused_blocks[num_new_blocks:])
-        self.meta.unused_block_list = [
-            *self.meta.unused_block_list[num_new_blocks:],
-            *self.meta.block_map[key].block_list[num_reuse_blocks:],
-        ]
-        self.meta.unused_block_list.sort()
-        # set block_map and value_length
-        self.meta.block_map[key].block_list = block_list
-        self.meta.block_map[key].length = len(b)
+        self.compaction = sorted(
+            (max(start for start, _ in block_info.extent_list), key)
+            for key, block_info in self.meta.block_map.items()
+            if any(length > 0 and start + length > num_live_blocks for start, length in block_info.extent_list)
+        )
+        self.compaction_total = sum(
+            length for _, key in self.compaction for _, length in self.meta.block_map[key].extent_list
+        )
+        self.compaction_moved = 0
 
-        # WRITE BLOCK AND METADATA TO FILE
-        for i, block in enumerate(block_list):
-            start_idx = i * self.cfg.block_size
-            stop_idx = min(start_idx + self.cfg.block_size, len(b))
-            self.__write_block(block, b[start_idx:stop_idx])
+    def compact(self, max_blocks: int = 1024) -> int:
+        """
+        a step of compaction, at most max_blocks blocks are moved
 
-        logger.now().info(f"write key {key}, written blocks {block_list}")
+        memoryview returned by read of a moved object is invalidated as if the key was written
 
-    def read(self, key: Key) -> Optional[bytes]:
-        if key not in self.meta.block_map:
-            return None
-        block_list = self.meta.block_map[key].block_list
-        value = b""
-        for block in block_list:
-            value += self.__read_block(block)
-        length = self.meta.block_map[key].length
-        return value[:length]
+        :return: number of blocks moved, 0 if there is nothing to move
+        """
+        with self.lock:
+            num_blocks = self.alloc.num_blocks
+            if len(self.deferred) > 0:
+                self.__release_deferred()
+            if len(self.compaction) == 0:
+                self.__plan_compaction()
+            moved = 0
+            while len(self.compaction) > 0 and moved < max_blocks:
+                last, key = self.compaction.pop()
+                block_info = self.meta.block_map.get(key, None)
+                if block_info is None or max(start for start, _ in block_info.extent_list) != last:
+                    continue  # written or deleted since planned
+                length = sum(length for _, length in block_info.extent_list)
+                if block_info.slab:
+                    slab = self.__alloc_slab(block_info.length, before=last)
+                    if slab is None:
+                        continue
+                    block, offset = slab
+                    new_block_info = BlockInfo(
+                        extent_list=[(block, 1)], length=block_info.length, offset=offset, slab=True,
+                        compression=block_info.compression, value_length=block_info.value_length,
+                    )
+                else:
+                    extent = self.alloc.alloc_before(length, last)
+                    if extent is None:
+                        continue
+                    new_block_info = BlockInfo(
+                        extent_list=[extent], length=block_info.length,
+                        compression=block_info.compression, value_length=block_info.value_length,
+                    )
+                self.__write_plan([(new_block_info, bytes(read_stored(self.file, self.cfg.block_size, block_info)))])
+                self.__set(key, new_block_info)
+                self.__free_value(block_info, None, relocate=True)
+                moved += length
+            self.compaction_moved += moved
+            self.reclaimed_blocks += max(0, num_blocks - self.alloc.num_blocks)
+            if len(self.compaction) == 0:
+                if self.compaction_moved > 0:
+                    # pass is done, checkpoint at the new end of file truncates the file
+                    self.__write_metadata(force=True)
+                self.compaction_total = self.compaction_moved = 0
+            return moved
+
+    def __encode(self, b: bytes) -> Tuple[bytes, int, Optional[int]]:
+        """
+        :return: stored bytes, compression and value_length of object b
+        """
+        stored, compression = compress(b, self.cfg.compress_threshold, self.cfg.lzma_threshold)
+        return stored, compression, None if compression == NONE else len(b)
+
+    def __place(self, key: Key, b: bytes, compression: int, value_length: Optional[int],
+                lsn: Optional[int]) -> BlockInfo:
+        """
+        allocate blocks for stored bytes b of key and set it as a new version,
+        b must be written into the blocks before the lock is released
+        """
+        length = len(b)
+        is_slab = self.cfg.slab_threshold is not None and 0 < length <= self.cfg.slab_threshold
+        # number of blocks of input
+        num_blocks = 1 + (length - 1) // self.cfg.block_size
+        old_block_info = self.meta.block_map.get(key, None)
+        if lsn is None and len(self.pinned) == 0 and old_block_info is not None:
+            if not is_slab and not old_block_info.slab and \
+                    len(old_block_info.extent_list) == 1 and old_block_info.extent_list[0][1] >= num_blocks:
+                # reuse old extent, free its tail
+                start, old_num_blocks = old_block_info.extent_list[0]
+                block_info = BlockInfo(
+                    extent_list=[(start, num_blocks)], length=length,
+                    compression=compression, value_length=value_length,
+                )
+                self.__set(key, block_info)
+                self.alloc.free((start + num_blocks, old_num_blocks - num_blocks))
+                return block_info
+            # old blocks can be reused by the new object
+            self.__free_value(old_block_info, None)
+            old_block_info = None
+        # copy on write
+        if is_slab:
+            block, offset = self.__alloc_slab(length)
+            block_info = BlockInfo(
+                extent_list=[(block, 1)], length=length, offset=offset, slab=True,
+                compression=compression, value_length=value_length,
+            )
+        else:
+            block_info = BlockInfo(
+                extent_list=[self.__alloc(num_blocks)], length=length,
+                compression=compression, value_length=value_length,
+            )
+        self.__set(key, block_info)
+        if old_block_info is not None:
+            self.__free_value(old_block_info, lsn)
+        return block_info
+
+    def __write(self, key: Key, b: bytes, lsn: Optional[int]) -> BlockInfo:
+        stored, compression, value_length = self.__encode(b)
+        with self.lock:
+            block_info = self.__place(key, stored, compression, value_length, lsn)
+            self.__write_plan([(block_info, stored)])
+            return block_info
+
+    def write(self, key: Key, b: bytes):
+        lsn = None
+        if self.wal is not None:
+            lsn = self.wal.append(WRITE, key, b)
+        block_info = self.__write(key, b, lsn)
+
+        logger.now().info(f"write key {key}, written extent {block_info.extent_list[0]}")
+
+    def write_many(self, items: Union[Dict[Key, bytes], Iterable[Tuple[Key, bytes]]]):
+        """
+        write many values at once
+
+        - extents of all values are allocated before any value is written, values are written in offset order
+        - wal records of all values are appended by a single write and a single fsync
+        - the last value of a duplicated key is written
+        """
+        item_map = dict(items)
+        lsn_list = [None] * len(item_map)
+        if self.wal is not None:
+            lsn_list = self.wal.append_many([(WRITE, key, b) for key, b in item_map.items()])
+        encoded_list = [self.__encode(b) for b in item_map.values()]
+        with self.__batch():
+            plan = [
+                (self.__place(key, stored, compression, value_length, lsn), stored)
+                for key, (stored, compression, value_length), lsn in zip(item_map, encoded_list, lsn_list)
+            ]
+            self.__write_plan(plan)
+
+        logger.now().info(f"write {len(plan)} keys, written {sum(len(stored) for _, stored in plan)} bytes")
+
+    def read(self, key: Key) -> Optional[Union[bytes, memoryview]]:
+        """
+        read value of key
+
+        memoryview is returned by IO supporting zero copy view if the value is in a single range,
+        it is valid until the key is written or deleted
+        """
+        with self.lock:
+            block_info = self.meta.block_map.get(key, None)
+            if block_info is None:
+                return None
+            return read_cached(self.cache, self.file, self.cfg.block_size, key, block_info)
+
+    def __delete(self, key: Key, lsn: Optional[int]) -> List[Extent]:
+        with self.lock:
+            block_info = self.meta.block_map[key]
+            self.__set(key, None)
+            self.__free_value(block_info, lsn)
+            return block_info.extent_list
 
     def delete(self, key: Key):
         if key not in self.meta.block_map:
             return
-        block_list = self.meta.block_map[key].block_list
-        self.meta.block_map.pop(key)
-        self.meta.unused_block_list.extend(block_list)
-        self.meta.unused_block_list.sort()
-        num_del_blocks = 0
-        for block in range(self.meta.num_blocks - 1, -1, -1):
-            if block not in self.meta.unused_block_list:
-                break
-            num_del_blocks += 1
-        self.__remove_blocks_local(num_del_blocks)
+        lsn = None
+        if self.wal is not None:
+            lsn = self.wal.append(DELETE, key)
+        extent_list = self.__delete(key, lsn)
 
-        logger.now().info(f"delete key {key}, deleted blocks {block_list}")
+        logger.now().info(f"delete key {key}, deleted extents {extent_list}")
+
+    def read_many(self, keys: Iterable[Key]) -> List[Optional[Union[bytes, memoryview]]]:
+        """
+        read values of keys in offset order
+
+        :return: values in the order of keys, None for missing keys
+        """
+        key_list = list(keys)
+        out: List[Optional[Union[bytes, memoryview]]] = [None] * len(key_list)
+        with self.lock:
+            read_list = []  # (first block, index of key)
+            for i, key in enumerate(key_list):
+                block_info = self.meta.block_map.get(key, None)
+                if block_info is not None:
+                    read_list.append((block_info.extent_list[0][0] if len(block_info.extent_list) > 0 else 0, i))
+            for _, i in sorted(read_list):
+                key = key_list[i]
+                out[i] = read_cached(self.cache, self.file, self.cfg.block_size, key, self.meta.block_map[key])
+        return out
+
+    def delete_many(self, keys: Iterable[Key]):
+        """
+        delete many keys at once, wal records of all keys are appended by a single write and a single fsync
+        """
+        key_list = [key for key in dict.fromkeys(keys) if key in self.meta.block_map]
+        lsn_list = [None] * len(key_list)
+        if self.wal is not None:
+            lsn_list = self.wal.append_many([(DELETE, key, None) for key in key_list])
+        num_extents = 0
+        with self.__batch():
+            for key, lsn in zip(key_list, lsn_list):
+                num_extents += len(self.__delete(key, lsn))
+
+        logger.now().info(f"delete {len(key_list)} keys, deleted {num_extents} extents")
+
+    def open_reader(self, key: Key, chunk_size: int = STREAM_CHUNK) -> Optional[ValueReader]:
+        """
+        file-like reader of the value of key, None if key does not exist
+
+        the version is pinned until the reader is closed, blocks of the value are not reused meanwhile
+        """
+        with self.lock:
+            block_info = self.meta.block_map.get(key, None)
+            if block_info is None:
+                return None
+            version = self.version
+            self.pinned[version] = self.pinned.get(version, 0) + 1
+        return ValueReader(
+            self.file, self.cfg.block_size, block_info,
+            release=lambda: self.__unpin(version), chunk_size=chunk_size,
+        )
+
+    def open_writer(self, key: Key, chunk_size: int = STREAM_CHUNK) -> ValueWriter:
+        """
+        file-like writer of the value of key, the value is set when the writer is closed
+
+        in write-ahead log mode, records contain whole values, streaming writer is not supported
+        """
+        if self.wal is not None:
+            raise Exception("streaming writer is not supported in write-ahead log mode")
+        return ValueWriter(ctx=self, key=key, chunk_size=chunk_size)
+
+    def write_extent(self, b: Union[bytes, memoryview]) -> Extent:
+        """
+        allocate an extent not referenced by any key and write b into it, used by ValueWriter
+        """
+        with self.lock:
+            extent = self.__alloc(1 + (len(b) - 1) // self.cfg.block_size)
+            self.file.pwritev([memoryview(b)], extent[0] * self.cfg.block_size)
+            return extent
+
+    def commit_writer(self, key: Key, extent_list: List[Extent], length: int):
+        """
+        set extents written by ValueWriter as the value of key
+        """
+        with self.lock:
+            if len(extent_list) == 0:
+                extent_list = [self.__alloc(0)]
+            old_block_info = self.meta.block_map.get(key, None)
+            self.__set(key, BlockInfo(extent_list=extent_list, length=length))
+            if old_block_info is not None:
+                self.__free_value(old_block_info, None)
+
+        logger.now().info(f"write key {key}, written {length} bytes into extents {extent_list}")
+
+    def abort_writer(self, extent_list: List[Extent]):
+        """
+        free extents written by an aborted ValueWriter
+        """
+        with self.lock:
+            for extent in extent_list:
+                self.alloc.free(extent)
+
+    def sync(self):
+        """
+        wait until all writes and deletes are durable in wal
+        """
+        if self.wal is not None:
+            self.wal.sync()
 
 
 class DB:
-    def __init__(self, file: Union[BinaryIO, IO], block_size: int = 32, index_size: int = 8):
-        self.ctx = Context(file=file, block_size=block_size, index_size=index_size)
+    def __init__(self, file: Union[BinaryIO, IO], block_size: int = 32, index_size: int = 8, use_mmap: bool = False,
+                 wal_file: Optional[Union[BinaryIO, IO]] = None, group_commit_latency: float = 0.0,
+                 compress_threshold: Optional[int] = None, lzma_threshold: Optional[int] = None,
+                 slab_threshold: Optional[int] = None, cache_size: int = 0, journal_budget: int = 1 << 20):
+        """
+        :param use_mmap: access binary file through memory map, values read as views must not be used after close
+        :param wal_file: enable write-ahead log mode, the same wal_file must be used to reopen file
+        :param group_commit_latency: maximal delay in seconds to batch wal fsyncs, 0 for fsync on every operation
+        :param compress_threshold: compress objects of at least this size by zlib, None to disable
+        :param lzma_threshold: compress objects of at least this size by lzma, None to disable
+        :param slab_threshold: pack objects of at most this size after compression into shared blocks, None to disable
+        :param cache_size: byte budget of the LRU cache of read values, 0 to disable
+        :param journal_budget: bytes of journals appended before metadata is rewritten as a checkpoint
+        """
+        if use_mmap and not isinstance(file, IO):
+            file = MmapIO(file)
+        wal_log = None
+        if wal_file is not None:
+            wal_log = WAL(
+                file=wal_file if isinstance(wal_file, IO) else File(wal_file),
+                group_commit_latency=group_commit_latency,
+            )
+        self.ctx = Context(
+            file=file, block_size=block_size, index_size=index_size, wal=wal_log,
+            compress_threshold=compress_threshold, lzma_threshold=lzma_threshold, slab_threshold=slab_threshold,
+            cache_size=cache_size, journal_budget=journal_budget,
+        )
 
     def context(self) -> Context:
         if self.ctx.using:
@@ -183,16 +1075,50 @@ class DB:
         self.ctx.__enter__()
         return self.ctx
 
+    def snapshot(self) -> Snapshot:
+        """
+        read-only view of the current version, it can be used from other threads while a context is in use
+        """
+        return self.ctx.snapshot()
+
+    def compact(self, max_blocks: int = 1024) -> int:
+        """
+        a step of compaction, it can be called from another thread while a context is in use
+
+        :return: number of blocks moved, 0 if there is nothing to move
+        """
+        return self.ctx.compact(max_blocks=max_blocks)
+
+    def close(self):
+        if self.ctx.wal is not None:
+            self.ctx.wal.close()
+        if isinstance(self.ctx.file, MmapIO):
+            # the file might be longer than its content while old mappings were in use
+            self.ctx.file.close()
+
     def stats(self) -> Stats:
         stats = Stats(
             bytes_written=0,
+            bytes_compressed=0,
             bytes_stored=0,
             storage_efficiency=0,
             metadata_size=0,
+            bytes_reclaimed=self.ctx.reclaimed_blocks * self.ctx.cfg.block_size,
+            compaction_progress=1.0,
+            cache_hits=0,
+            cache_misses=0,
+            cache_evictions=0,
         )
-        for key in self.ctx.meta.block_map:
-            stats.bytes_written += self.ctx.meta.block_map[key].length
+        for block_info in self.ctx.meta.block_map.values():
+            stats.bytes_compressed += block_info.length
+            stats.bytes_written += block_info.length if block_info.value_length is None else block_info.value_length
         stats.bytes_stored = self.ctx.file.seek(0, os.SEEK_END)
         stats.storage_efficiency = stats.bytes_written / stats.bytes_stored
-        stats.metadata_size = len(self.ctx.meta.json().encode("utf-8"))
+        stats.metadata_size = len(codec.encode_checkpoint(self.ctx.meta, self.ctx.key_list))
+        if self.ctx.compaction_total > 0:
+            stats.compaction_progress = self.ctx.compaction_moved / self.ctx.compaction_total
+        if self.ctx.cache is not None:
+            stats.cache_hits = self.ctx.cache.hits
+            stats.cache_misses = self.ctx.cache.misses
+            stats.cache_evictions = self.ctx.cache.evictions
         return stats
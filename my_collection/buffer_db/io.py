@@ -1,8 +1,14 @@
+import mmap
 import os
-from typing import Union, Optional
+import weakref
+from typing import Union, Optional, List, BinaryIO, Tuple
+
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") and "SC_IOV_MAX" in os.sysconf_names else 1024
 
 
 class IO:
+    zero_copy: bool = False  # view is supported
+
     def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
         raise NotImplemented
 
@@ -15,6 +21,51 @@ class IO:
     def truncate(self, size: Optional[int] = None) -> int:
         raise NotImplemented
 
+    def readinto(self, b: Union[bytearray, memoryview]) -> int:
+        out = self.read(len(b))
+        b[:len(out)] = out
+        return len(out)
+
+    def pread(self, n: int, offset: int) -> bytes:
+        """
+        read n bytes starting from offset, the current position is unspecified after the call
+        """
+        self.seek(offset)
+        return self.read(n)
+
+    def preadv(self, buffers: List[memoryview], offset: int) -> int:
+        """
+        read into buffers starting from offset, the current position is unspecified after the call
+        """
+        self.seek(offset)
+        n = 0
+        for b in buffers:
+            n += self.readinto(b)
+        return n
+
+    def pwritev(self, buffers: List[memoryview], offset: int) -> int:
+        """
+        write buffers starting from offset, the current position is unspecified after the call
+        """
+        self.seek(offset)
+        n = 0
+        for b in buffers:
+            self.write(b)
+            n += len(b)
+        return n
+
+    def view(self, offset: int, n: int) -> Optional[memoryview]:
+        """
+        zero copy view of n bytes starting from offset, None if not supported
+        """
+        return None
+
+    def fsync(self):
+        """
+        make written bytes durable
+        """
+        pass
+
 
 class Buffer(IO):
     buffer: bytearray
@@ -42,6 +93,29 @@ class Buffer(IO):
         self.index += n
         return out
 
+    def readinto(self, b: Union[bytearray, memoryview]) -> int:
+        n = max(0, min(len(b), len(self.buffer) - self.index))
+        with memoryview(self.buffer) as view:
+            b[:n] = view[self.index:self.index + n]
+        self.index += n
+        return n
+
+    def pread(self, n: int, offset: int) -> bytes:
+        # positional, the current position is not used by concurrent readers
+        return bytes(self.buffer[offset:offset + n])
+
+    def preadv(self, buffers: List[memoryview], offset: int) -> int:
+        # positional, the current position is not used by concurrent readers
+        done = 0
+        buffer = self.buffer
+        for b in buffers:
+            n = max(0, min(len(b), len(buffer) - offset - done))
+            if n == 0:
+                break
+            b[:n] = buffer[offset + done:offset + done + n]
+            done += n
+        return done
+
     def write(self, b: Union[bytes, bytearray]):
         self.buffer += b"\0" * max(0, self.index + len(b) - len(self.buffer))
         self.buffer[self.index:self.index + len(b)] = b
@@ -52,3 +126,254 @@ class Buffer(IO):
             self.seek(size)
         self.buffer = self.buffer[:self.index]
         return self.index
+
+
+class File(IO):
+    """
+    IO over a binary file
+
+    - positional vectored reads and writes go directly to the file descriptor by os.preadv and os.pwritev
+    - streams without file descriptor fall back to seek, readinto and write
+    """
+    file: BinaryIO
+    fd: Optional[int]
+    index: int
+
+    def __init__(self, file: BinaryIO):
+        file.flush()
+        self.file = file
+        try:
+            self.fd = file.fileno()
+        except (AttributeError, OSError):
+            self.fd = None
+        if not (hasattr(os, "preadv") and hasattr(os, "pwritev")):
+            self.fd = None
+        self.index = file.tell()
+
+    @staticmethod
+    def __advance(buffers: List[memoryview], n: int) -> List[memoryview]:
+        """
+        drop the first n bytes from buffers after a partial vectored read or write
+        """
+        for i, b in enumerate(buffers):
+            if n < len(b):
+                return [b[n:], *buffers[i + 1:]]
+            n -= len(b)
+        return []
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if self.fd is None:
+            return self.file.seek(offset, whence)
+        if whence == os.SEEK_SET:
+            self.index = offset
+        elif whence == os.SEEK_CUR:
+            self.index += offset
+        elif whence == os.SEEK_END:
+            self.index = os.fstat(self.fd).st_size + offset
+        else:
+            raise Exception("seek whence")
+        return self.index
+
+    def read(self, n: Optional[int] = None) -> bytes:
+        if self.fd is None:
+            return self.file.read(n)
+        if n is None:
+            n = max(0, os.fstat(self.fd).st_size - self.index)
+        out = os.pread(self.fd, n, self.index)
+        self.index += len(out)
+        return out
+
+    def readinto(self, b: Union[bytearray, memoryview]) -> int:
+        if self.fd is None:
+            return self.file.readinto(b)
+        n = self.preadv([memoryview(b)], self.index)
+        self.index += n
+        return n
+
+    def write(self, b: Union[bytes, bytearray]):
+        if self.fd is None:
+            self.file.write(b)
+            return
+        self.index += self.pwritev([memoryview(b)], self.index)
+
+    def truncate(self, size: Optional[int] = None) -> int:
+        if self.fd is None:
+            return self.file.truncate(size)
+        if size is not None:
+            self.index = size
+        os.ftruncate(self.fd, self.index)
+        return self.index
+
+    def fsync(self):
+        self.file.flush()
+        try:
+            os.fsync(self.file.fileno())
+        except (AttributeError, OSError):
+            pass  # stream without file descriptor
+
+    def pread(self, n: int, offset: int) -> bytes:
+        if self.fd is None:
+            return super().pread(n, offset)
+        return os.pread(self.fd, n, offset)
+
+    def preadv(self, buffers: List[memoryview], offset: int) -> int:
+        if self.fd is None:
+            return super().preadv(buffers, offset)
+        done = 0
+        while len(buffers) > 0:
+            n = os.preadv(self.fd, buffers[:IOV_MAX], offset + done)
+            if n == 0:  # end of file
+                break
+            done += n
+            buffers = self.__advance(buffers, n)
+        return done
+
+    def pwritev(self, buffers: List[memoryview], offset: int) -> int:
+        if self.fd is None:
+            return super().pwritev(buffers, offset)
+        done = 0
+        while len(buffers) > 0:
+            n = os.pwritev(self.fd, buffers[:IOV_MAX], offset + done)
+            done += n
+            buffers = self.__advance(buffers, n)
+        return done
+
+
+class MmapIO(IO):
+    """
+    memory mapped IO over a binary file
+
+    - writing past the end grows the file geometrically, the logical size is kept separately
+    - truncate shrinks the file to the logical size and remaps it
+    - view returns a zero copy slice of the mapping, it is valid until the bytes are overwritten or truncated
+    - the file is never shorter than a mapping still referenced by a view or a concurrent reader,
+      touching a page past the end of file would kill the process with SIGBUS, the file is shrunk
+      by a later remap once old mappings are released, and by close, which must be called before the file
+      is opened again
+    """
+    zero_copy: bool = True
+    fd: int
+    mm: Optional[mmap.mmap]
+    size: int
+    capacity: int
+    file_size: int
+    retired_list: List[Tuple[weakref.ref, int]]  # old mappings and their length
+    index: int
+
+    def __init__(self, file: BinaryIO):
+        file.flush()
+        self.fd = file.fileno()
+        self.mm = None
+        self.size = os.fstat(self.fd).st_size
+        self.capacity = 0
+        self.file_size = self.size
+        self.retired_list = []
+        self.index = 0
+        self.__remap(self.size)
+
+    def __remap(self, capacity: int):
+        # the old mapping is not closed, it is unmapped once views and concurrent readers release it
+        if capacity > self.file_size:
+            os.ftruncate(self.fd, capacity)
+            self.file_size = capacity
+        old, old_capacity = self.mm, self.capacity
+        self.capacity = capacity
+        self.mm = mmap.mmap(self.fd, capacity) if capacity > 0 else None
+        if old is not None:
+            self.retired_list.append((weakref.ref(old), old_capacity))
+            del old
+        # shrink the file down to the longest mapping still in use
+        self.retired_list = [(ref, length) for ref, length in self.retired_list if ref() is not None]
+        file_size = max([capacity] + [length for _, length in self.retired_list])
+        if file_size < self.file_size:
+            os.ftruncate(self.fd, file_size)
+            self.file_size = file_size
+
+    def __reserve(self, size: int):
+        if size > self.capacity:
+            self.__remap(max(size, 2 * self.capacity, mmap.ALLOCATIONGRANULARITY))
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            self.index = offset
+        elif whence == os.SEEK_CUR:
+            self.index += offset
+        elif whence == os.SEEK_END:
+            self.index = self.size + offset
+        else:
+            raise Exception("seek whence")
+        return self.index
+
+    def read(self, n: Optional[int] = None) -> bytes:
+        if n is None:
+            n = self.size
+        n = max(0, min(n, self.size - self.index))
+        mm = self.mm
+        out = mm[self.index:self.index + n] if n > 0 else b""
+        self.index += n
+        return out
+
+    def readinto(self, b: Union[bytearray, memoryview]) -> int:
+        n = self.preadv([memoryview(b)], self.index)
+        self.index += n
+        return n
+
+    def write(self, b: Union[bytes, bytearray]):
+        self.index += self.pwritev([memoryview(b)], self.index)
+
+    def truncate(self, size: Optional[int] = None) -> int:
+        if size is not None:
+            self.index = size
+        self.size = self.index
+        self.__remap(self.size)
+        return self.index
+
+    def pread(self, n: int, offset: int) -> bytes:
+        n = max(0, min(n, self.size - offset))
+        mm = self.mm
+        return mm[offset:offset + n] if n > 0 else b""
+
+    def preadv(self, buffers: List[memoryview], offset: int) -> int:
+        mm = self.mm
+        done = 0
+        for b in buffers:
+            n = max(0, min(len(b), self.size - offset - done))
+            if n == 0:
+                break
+            with memoryview(mm) as view:
+                b[:n] = view[offset + done:offset + done + n]
+            done += n
+        return done
+
+    def pwritev(self, buffers: List[memoryview], offset: int) -> int:
+        n = sum(len(b) for b in buffers)
+        if n == 0:
+            return 0
+        self.__reserve(offset + n)
+        with memoryview(self.mm) as view:
+            for b in buffers:
+                view[offset:offset + len(b)] = b
+                offset += len(b)
+        self.size = max(self.size, offset)
+        return n
+
+    def fsync(self):
+        if self.mm is not None:
+            self.mm.flush()
+        os.fsync(self.fd)
+
+    def view(self, offset: int, n: int) -> Optional[memoryview]:
+        mm = self.mm
+        if n == 0 or offset + n > self.size:
+            return None
+        return memoryview(mm)[offset:offset + n]
+
+    def close(self):
+        """
+        shrink the file to the logical size, views must not be used after close
+        """
+        self.mm = None
+        self.retired_list = []
+        if self.file_size != self.size:
+            os.ftruncate(self.fd, self.size)
+            self.file_size = self.size
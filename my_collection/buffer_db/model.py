@@ -1,4 +1,4 @@
-from typing import List, Dict
+from typing import List, Dict, Tuple, Optional
 
 import pydantic
 
@@ -6,25 +6,41 @@ import pydantic
 class Config(pydantic.BaseModel):
     block_size: int
     index_size: int
+    compress_threshold: Optional[int] = None  # objects of at least this size are compressed by zlib
+    lzma_threshold: Optional[int] = None  # objects of at least this size are compressed by lzma
+    slab_threshold: Optional[int] = None  # objects of at most this size are packed into shared blocks
+    cache_size: int = 0  # byte budget of the value cache, 0 to disable
+    journal_budget: int = 1 << 20  # bytes of journals after a checkpoint, beyond it the checkpoint is rewritten
 
 
 Key = str
 Block = int
+Extent = Tuple[Block, int]  # (start, length) of contiguous blocks
 
 
 class BlockInfo(pydantic.BaseModel):
-    block_list: List[Block]
-    length: int
+    extent_list: List[Extent]
+    length: int  # number of stored bytes
+    offset: int = 0  # position of stored bytes in the first block
+    slab: bool = False  # the first block is shared by small objects
+    compression: int = 0  # NONE, ZLIB or LZMA in compress
+    value_length: Optional[int] = None  # length of the object before compression, None if not compressed
 
 
 class Metadata(pydantic.BaseModel):
     num_blocks: int
     block_map: Dict[Key, BlockInfo]
-    unused_block_list: List[Block]  # always sorted
+    unused_extent_list: List[Extent]  # always sorted
 
 
 class Stats(pydantic.BaseModel):
     bytes_written: int
+    bytes_compressed: int  # bytes of objects after compression
     bytes_stored: int
     storage_efficiency: float
     metadata_size: int
+    bytes_reclaimed: int  # bytes removed from the end of file by compaction
+    compaction_progress: float  # fraction of blocks of the current compaction pass moved
+    cache_hits: int
+    cache_misses: int
+    cache_evictions: int
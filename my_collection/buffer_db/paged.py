@@ -0,0 +1,180 @@
+from __future__ import annotations
+
+import bisect
+import collections
+import heapq
+import os
+import threading
+from typing import BinaryIO, Union, Optional, List, Dict, Iterator, OrderedDict
+
+from . import codec
+from .db import read_value
+from .io import IO, File, MmapIO
+from .model import Metadata, Key, BlockInfo
+
+HEADER_READ_SIZE = 4096  # bytes read at open to find the header size
+
+
+class Page:
+    key_list: List[Key]  # sorted keys of the page
+    block_map: Dict[Key, BlockInfo]
+    size: int
+
+    def __init__(self, block_map: Dict[Key, BlockInfo], size: int):
+        self.key_list = list(block_map)  # entries are written in key order
+        self.block_map = block_map
+        self.size = size
+
+
+class PagedReader:
+    """
+    read-only view of a DB file with paged metadata
+
+    - on open, only start_of_metadata, the checkpoint header and journals are read,
+      checkpoint entries are loaded page by page on demand
+    - loaded pages are kept in an LRU bounded by page_cache_size bytes of encoded entries
+    - journals are kept as an overlay over the checkpoint, they are bounded by journal_budget of the writer,
+      beyond it they are rewritten into a checkpoint
+    - the file must not be written while it is open, a file in write-ahead log mode is read as of its last checkpoint
+    """
+    file: IO
+    block_size: int
+    meta: Metadata  # num_blocks and unused_extent_list only, block_map is empty
+    num_entries: int  # number of checkpoint entries
+    first_key_list: List[Key]
+    page_offset_list: List[int]  # position of each page on file
+    page_size_list: List[int]
+    page_entries_list: List[int]  # number of entries of each page
+    page_cache_size: int
+    page_map: OrderedDict[int, Page]  # loaded pages in LRU order
+    cached_size: int
+    overlay: Dict[Key, Optional[BlockInfo]]  # entries of journals, None for deleted keys
+    overlay_key_list: List[Key]
+    length: Optional[int]
+    page_loads: int
+    page_evictions: int
+
+    def __init__(self, file: Union[BinaryIO, IO], block_size: int = 32, index_size: int = 8,
+                 use_mmap: bool = False, page_cache_size: int = 16 * 1024 * 1024):
+        """
+        :param block_size: block_size the DB file was written with
+        :param index_size: index_size the DB file was written with
+        :param page_cache_size: byte budget of loaded pages
+        """
+        if use_mmap and not isinstance(file, IO):
+            file = MmapIO(file)
+        self.file = file if isinstance(file, IO) else File(file)
+        self.block_size = block_size
+        self.page_cache_size = page_cache_size
+        self.page_map = collections.OrderedDict()
+        self.cached_size = 0
+        self.length = None
+        self.page_loads = 0
+        self.page_evictions = 0
+        self.lock = threading.Lock()
+
+        end_of_meta = self.file.seek(-index_size, os.SEEK_END)
+        start_of_meta = int.from_bytes(
+            bytes=self.file.pread(index_size, end_of_meta),
+            byteorder="little",
+            signed=False,
+        )
+        b = bytes(self.file.pread(min(HEADER_READ_SIZE, end_of_meta - start_of_meta), start_of_meta))
+        if not codec.is_binary(b):
+            raise Exception("metadata magic")
+        if b[len(codec.MAGIC)] != codec.VERSION:
+            raise Exception(f"metadata version {b[len(codec.MAGIC)]} is not paged, it is rewritten by DB on exit")
+        header_size, i = codec.decode_varint(b, len(codec.MAGIC) + 1)
+        if i + header_size > len(b):
+            b += bytes(self.file.pread(i + header_size - len(b), start_of_meta + len(b)))
+        self.meta = Metadata.construct(num_blocks=0, block_map={}, unused_extent_list=[])
+        self.num_entries, page_list, i = codec.decode_header(b, i, self.meta)
+        self.first_key_list = []
+        self.page_offset_list = []
+        self.page_size_list = []
+        self.page_entries_list = []
+        offset = start_of_meta + i
+        for first_key, size, page_entries in page_list:
+            self.first_key_list.append(first_key)
+            self.page_offset_list.append(offset)
+            self.page_size_list.append(size)
+            self.page_entries_list.append(page_entries)
+            offset += size
+        self.overlay = {}
+        if offset < end_of_meta:
+            journals = bytes(self.file.pread(end_of_meta - offset, offset))
+            codec.decode_journals(journals, 0, self.meta, self.overlay)
+        self.overlay_key_list = sorted(self.overlay)
+
+    def __page(self, index: int) -> Page:
+        with self.lock:
+            page = self.page_map.get(index, None)
+            if page is not None:
+                self.page_map.move_to_end(index)
+                return page
+        size = self.page_size_list[index]
+        b = bytes(self.file.pread(size, self.page_offset_list[index]))
+        block_map = {}
+        codec.decode_entries(b, 0, self.page_entries_list[index], block_map)
+        page = Page(block_map=block_map, size=size)
+        with self.lock:
+            self.page_loads += 1
+            if index not in self.page_map:
+                self.page_map[index] = page
+                self.cached_size += size
+            while self.cached_size > self.page_cache_size and len(self.page_map) > 1:
+                _, evicted = self.page_map.popitem(last=False)
+                self.cached_size -= evicted.size
+                self.page_evictions += 1
+        return page
+
+    def __checkpoint_get(self, key: Key) -> Optional[BlockInfo]:
+        index = bisect.bisect_right(self.first_key_list, key) - 1
+        if index < 0:
+            return None
+        return self.__page(index).block_map.get(key, None)
+
+    def get(self, key: Key) -> Optional[BlockInfo]:
+        if key in self.overlay:
+            return self.overlay[key]
+        return self.__checkpoint_get(key)
+
+    def __contains__(self, key: Key) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        if self.length is None:
+            length = self.num_entries
+            for key, block_info in self.overlay.items():
+                length += int(block_info is not None) - int(self.__checkpoint_get(key) is not None)
+            self.length = length
+        return self.length
+
+    def read(self, key: Key) -> Optional[Union[bytes, memoryview]]:
+        block_info = self.get(key)
+        if block_info is None:
+            return None
+        return read_value(self.file, self.block_size, block_info)
+
+    def __checkpoint_scan(self, lower: Key) -> Iterator[Key]:
+        index = max(0, bisect.bisect_right(self.first_key_list, lower) - 1)
+        for index in range(index, len(self.first_key_list)):
+            key_list = self.__page(index).key_list
+            yield from key_list[bisect.bisect_left(key_list, lower):]
+
+    def scan(self, prefix: str = "", start: Optional[Key] = None, end: Optional[Key] = None) -> Iterator[Key]:
+        """
+        iterate keys with prefix in [start, end) in order, pages are loaded as the iteration goes
+        """
+        lower = prefix if start is None else max(start, prefix)
+        overlay_iter = iter(self.overlay_key_list[bisect.bisect_left(self.overlay_key_list, lower):])
+        last = None
+        for key in heapq.merge(self.__checkpoint_scan(lower), overlay_iter):
+            if (end is not None and key >= end) or not key.startswith(prefix):
+                return
+            if key == last:
+                continue
+            last = key
+            if key in self.overlay and self.overlay[key] is None:
+                continue
+            yield key
@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import concurrent.futures
+import heapq
+import zlib
+from typing import BinaryIO, Union, Set, Optional, List, Tuple, Dict, Iterable, Iterator, Callable, Any
+
+from .db import DB, Context
+from .io import IO
+from .model import Key, Stats
+
+
+def shard_of(key: Key, num_shards: int) -> int:
+    """
+    stable shard of key, python hash of str is randomized per process
+    """
+    return zlib.crc32(key.encode("utf-8")) % num_shards
+
+
+class ShardedContext:
+    """
+    context over the contexts of all shards
+
+    - a key is in the shard of shard_of(key), each shard has its own lock
+    - batch operations are grouped by shard and run on the thread pool, file IO of shards overlaps
+      as the GIL is released during reads and writes
+    """
+    ctx_list: List[Context]
+    executor: concurrent.futures.ThreadPoolExecutor
+
+    def __init__(self, ctx_list: List[Context], executor: concurrent.futures.ThreadPoolExecutor):
+        self.ctx_list = ctx_list
+        self.executor = executor
+
+    def __enter__(self) -> ShardedContext:
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__map(lambda ctx: ctx.__exit__(exc_type, exc_val, exc_tb), self.ctx_list)
+
+    def __map(self, f: Callable[..., Any], *args_list: List[Any]) -> List[Any]:
+        """
+        apply f on each group of arguments in parallel
+        """
+        return list(self.executor.map(f, *args_list))
+
+    def __group(self, keys: Iterable[Key]) -> List[List[Tuple[int, Key]]]:
+        """
+        group keys by shard, keeping their index
+        """
+        group_list = [[] for _ in self.ctx_list]
+        for i, key in enumerate(keys):
+            group_list[shard_of(key, len(self.ctx_list))].append((i, key))
+        return group_list
+
+    def __shard(self, key: Key) -> Context:
+        return self.ctx_list[shard_of(key, len(self.ctx_list))]
+
+    def keys(self) -> Set[Key]:
+        return set().union(*(ctx.keys() for ctx in self.ctx_list))
+
+    def __len__(self) -> int:
+        return sum(len(ctx) for ctx in self.ctx_list)
+
+    def __contains__(self, key: Key) -> bool:
+        return key in self.__shard(key)
+
+    def scan(self, prefix: str = "", start: Optional[Key] = None, end: Optional[Key] = None) -> Iterator[Key]:
+        """
+        iterate keys with prefix in [start, end) in order, merging the scans of all shards
+        """
+        return heapq.merge(*(ctx.scan(prefix=prefix, start=start, end=end) for ctx in self.ctx_list))
+
+    def write(self, key: Key, b: bytes):
+        self.__shard(key).write(key, b)
+
+    def read(self, key: Key) -> Optional[Union[bytes, memoryview]]:
+        return self.__shard(key).read(key)
+
+    def delete(self, key: Key):
+        self.__shard(key).delete(key)
+
+    def write_many(self, items: Union[Dict[Key, bytes], Iterable[Tuple[Key, bytes]]]):
+        if isinstance(items, dict):
+            items = items.items()
+        item_list_list = [[] for _ in self.ctx_list]
+        for key, b in items:
+            item_list_list[shard_of(key, len(self.ctx_list))].append((key, b))
+        self.__map(
+            lambda ctx, item_list: ctx.write_many(item_list) if len(item_list) > 0 else None,
+            self.ctx_list, item_list_list,
+        )
+
+    def read_many(self, keys: Iterable[Key]) -> List[Optional[Union[bytes, memoryview]]]:
+        key_list = list(keys)
+        out: List[Optional[Union[bytes, memoryview]]] = [None] * len(key_list)
+        group_list = self.__group(key_list)
+        value_list_list = self.__map(
+            lambda ctx, group: ctx.read_many([key for _, key in group]) if len(group) > 0 else [],
+            self.ctx_list, group_list,
+        )
+        for group, value_list in zip(group_list, value_list_list):
+            for (i, _), value in zip(group, value_list):
+                out[i] = value
+        return out
+
+    def delete_many(self, keys: Iterable[Key]):
+        self.__map(
+            lambda ctx, group: ctx.delete_many([key for _, key in group]) if len(group) > 0 else None,
+            self.ctx_list, self.__group(keys),
+        )
+
+    def sync(self):
+        self.__map(lambda ctx: ctx.sync(), self.ctx_list)
+
+
+class ShardedDB:
+    db_list: List[DB]
+    executor: concurrent.futures.ThreadPoolExecutor
+    ctx: ShardedContext
+
+    def __init__(self, file_list: List[Union[BinaryIO, IO]], block_size: int = 32, index_size: int = 8,
+                 use_mmap: bool = False, wal_file_list: Optional[List[Union[BinaryIO, IO]]] = None,
+                 group_commit_latency: float = 0.0,
+                 compress_threshold: Optional[int] = None, lzma_threshold: Optional[int] = None,
+                 slab_threshold: Optional[int] = None, cache_size: int = 0, journal_budget: int = 1 << 20,
+                 num_threads: Optional[int] = None):
+        """
+        DB sharded over many files, keys are hashed into shards
+
+        :param file_list: a file per shard, the same files in the same order must be used to reopen
+        :param wal_file_list: enable write-ahead log mode, a wal file per shard
+        :param cache_size: byte budget of the LRU cache of read values of each shard
+        :param num_threads: number of threads running batch operations, number of shards if None
+        other parameters are passed to the DB of each shard
+        """
+        if wal_file_list is not None and len(wal_file_list) != len(file_list):
+            raise Exception("wal_file_list and file_list have different lengths")
+        self.db_list = [
+            DB(
+                file=file, block_size=block_size, index_size=index_size, use_mmap=use_mmap,
+                wal_file=None if wal_file_list is None else wal_file_list[i],
+                group_commit_latency=group_commit_latency,
+                compress_threshold=compress_threshold, lzma_threshold=lzma_threshold,
+                slab_threshold=slab_threshold, cache_size=cache_size, journal_budget=journal_budget,
+            )
+            for i, file in enumerate(file_list)
+        ]
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(file_list) if num_threads is None else num_threads,
+        )
+        self.ctx = ShardedContext(ctx_list=[db.ctx for db in self.db_list], executor=self.executor)
+
+    def context(self) -> ShardedContext:
+        """
+        enter every shard, or none of them if a shard is in use
+        """
+        if any(db.ctx.using for db in self.db_list):
+            raise Exception("a single context is allowed to enter at the same time")
+        entered_list = []
+        try:
+            for db in self.db_list:
+                db.context()
+                entered_list.append(db)
+        except BaseException:
+            for db in entered_list:
+                db.ctx.__exit__(None, None, None)
+            raise
+        return self.ctx
+
+    def compact(self, max_blocks: int = 1024) -> int:
+        """
+        a step of compaction of every shard in parallel
+
+        :return: number of blocks moved, 0 if there is nothing to move
+        """
+        return sum(self.executor.map(lambda db: db.compact(max_blocks=max_blocks), self.db_list))
+
+    def close(self):
+        for db in self.db_list:
+            db.close()
+        self.executor.shutdown()
+
+    def stats(self) -> Stats:
+        stats_list = [db.stats() for db in self.db_list]
+        stats = Stats(
+            bytes_written=sum(s.bytes_written for s in stats_list),
+            bytes_compressed=sum(s.bytes_compressed for s in stats_list),
+            bytes_stored=sum(s.bytes_stored for s in stats_list),
+            storage_efficiency=0,
+            metadata_size=sum(s.metadata_size for s in stats_list),
+            bytes_reclaimed=sum(s.bytes_reclaimed for s in stats_list),
+            compaction_progress=min(s.compaction_progress for s in stats_list),
+            cache_hits=sum(s.cache_hits for s in stats_list),
+            cache_misses=sum(s.cache_misses for s in stats_list),
+            cache_evictions=sum(s.cache_evictions for s in stats_list),
+        )
+        stats.storage_efficiency = stats.bytes_written / stats.bytes_stored
+        return stats
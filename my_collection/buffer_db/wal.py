@@ -0,0 +1,196 @@
+"""
+write-ahead log
+
+    [wal] = [header][record]...[record]
+
+    [header] = MAGIC <crc32 u32> <length u64> checkpoint
+    [record] = <crc32 u32> <length u32> <lsn u64> op <key_length> key value
+
+    - checkpoint is a copy of the metadata checkpoint of the data file the records are replayed on
+    - op is WRITE or DELETE, a torn record at the end of the log is ignored on recovery
+"""
+
+from __future__ import annotations
+
+import os
+import struct
+import threading
+import time
+import zlib
+from typing import Optional, List, Tuple
+
+from . import codec
+from .io import IO
+from .model import Key
+
+MAGIC = b"BWAL"
+WRITE = b"W"
+DELETE = b"D"
+
+HEADER = struct.Struct("<IQ")
+RECORD = struct.Struct("<IIQ")
+
+Record = Tuple[int, bytes, Key, Optional[bytes]]  # (lsn, op, key, value)
+
+
+class WAL:
+    """
+    write-ahead log with group commit
+
+    - group_commit_latency == 0: every append is fsync-ed before it returns
+    - group_commit_latency > 0: a commit thread fsyncs all records appended within the latency budget at once,
+      sync waits until a record is durable
+    """
+    file: IO
+    group_commit_latency: float
+    end: int  # position of the next record
+    lsn: int  # lsn of the last appended record
+    durable_lsn: int  # lsn of the last fsync-ed record
+
+    def __init__(self, file: IO, group_commit_latency: float = 0.0):
+        self.file = file
+        self.group_commit_latency = group_commit_latency
+        self.end = 0
+        self.lsn = 0
+        self.durable_lsn = 0
+        self.cond = threading.Condition()
+        self.append_lock = threading.Lock()  # held from lsn assignment until records are written
+        self.closed = False
+        self.thread = None
+        if self.group_commit_latency > 0:
+            self.thread = threading.Thread(target=self.__commit_loop, daemon=True)
+            self.thread.start()
+
+    def __commit_loop(self):
+        while True:
+            with self.cond:
+                while not self.closed and self.lsn == self.durable_lsn:
+                    self.cond.wait()
+                if self.closed:
+                    return
+            # let more records join the batch
+            time.sleep(self.group_commit_latency)
+            with self.cond:
+                lsn = self.lsn
+            self.file.fsync()
+            with self.cond:
+                self.durable_lsn = max(self.durable_lsn, lsn)
+                self.cond.notify_all()
+
+    def recover(self) -> Tuple[Optional[bytes], List[Record]]:
+        """
+        :return: checkpoint and records after it, None checkpoint if the log has no valid header
+        """
+        size = self.file.seek(0, os.SEEK_END)
+        self.file.seek(0)
+        b = self.file.read(size)
+        i = len(MAGIC) + HEADER.size
+        if size < i or b[:len(MAGIC)] != MAGIC:
+            return None, []
+        crc, length = HEADER.unpack_from(b, len(MAGIC))
+        checkpoint = b[i:i + length]
+        if len(checkpoint) != length or zlib.crc32(checkpoint) != crc:
+            return None, []
+        i += length
+        record_list = []
+        while i + RECORD.size <= size:
+            crc, length, lsn = RECORD.unpack_from(b, i)
+            payload = b[i + RECORD.size:i + RECORD.size + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break  # torn record
+            if len(record_list) > 0 and lsn != self.lsn + 1:
+                break
+            op = payload[:1]
+            key_length, j = codec.decode_varint(payload, 1)
+            key = payload[j:j + key_length].decode("utf-8")
+            value = payload[j + key_length:] if op == WRITE else None
+            record_list.append((lsn, op, key, value))
+            i += RECORD.size + length
+            self.lsn = lsn
+        self.end = i
+        self.durable_lsn = self.lsn
+        return checkpoint, record_list
+
+    def reset(self, checkpoint: bytes):
+        """
+        replace the log by an empty log based on checkpoint, previous records must be durable in the data file
+        """
+        with self.append_lock:
+            self.sync()
+            self.file.seek(0)
+            self.file.write(MAGIC)
+            self.file.write(HEADER.pack(zlib.crc32(checkpoint), len(checkpoint)))
+            self.file.write(checkpoint)
+            self.end = self.file.truncate()
+            self.file.fsync()
+
+    def append(self, op: bytes, key: Key, value: Optional[bytes] = None) -> int:
+        """
+        :return: lsn of the record
+        """
+        return self.append_many([(op, key, value)])[-1]
+
+    def append_many(self, op_list: List[Tuple[bytes, Key, Optional[bytes]]]) -> List[int]:
+        """
+        append records (op, key, value) by a single write and a single fsync
+
+        :return: lsn of the records
+        """
+        encoded_list = []
+        for op, key, value in op_list:
+            payload = bytearray(op)
+            key_bytes = key.encode("utf-8")
+            codec.encode_varint(payload, len(key_bytes))
+            payload += key_bytes
+            record = [memoryview(payload)]
+            crc = zlib.crc32(payload)
+            length = len(payload)
+            if value is not None:
+                record.append(memoryview(value))
+                crc = zlib.crc32(value, crc)
+                length += len(value)
+            encoded_list.append((crc, length, record))
+        if len(encoded_list) == 0:
+            return []
+        # concurrent writers must not get the same lsn nor write at the same position
+        with self.append_lock:
+            buffers = []
+            lsn_list = []
+            for crc, length, record in encoded_list:
+                lsn = self.lsn + len(lsn_list) + 1
+                buffers.append(memoryview(RECORD.pack(crc, length, lsn)))
+                buffers.extend(record)
+                lsn_list.append(lsn)
+            self.end += self.file.pwritev(buffers, self.end)
+            lsn = lsn_list[-1]
+            with self.cond:
+                self.lsn = lsn
+                if self.group_commit_latency > 0:
+                    self.cond.notify_all()
+        if self.group_commit_latency == 0:
+            self.file.fsync()
+            with self.cond:
+                self.durable_lsn = max(self.durable_lsn, lsn)
+        return lsn_list
+
+    def sync(self, lsn: Optional[int] = None):
+        """
+        wait until record lsn (default: the last record) is durable
+        """
+        with self.cond:
+            if lsn is None:
+                lsn = self.lsn
+            while self.durable_lsn < lsn:
+                if self.thread is None:
+                    self.file.fsync()
+                    self.durable_lsn = self.lsn
+                    break
+                self.cond.wait()
+
+    def close(self):
+        self.sync()
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
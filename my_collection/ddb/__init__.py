@@ -1,3 +1,4 @@
 from .client import Client
-from .server import Addr, Server
-from .storage import Storage, TransformRequest
+from .ring import Addr, Ring
+from .server import Server, RebalanceRequest, POLICY_FAIL_FAST, POLICY_BEST_EFFORT
+from .storage import Storage, TransformRequest, ScanRequest, QueryRequest, MapReduceRequest
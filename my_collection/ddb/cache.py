@@ -0,0 +1,51 @@
+import collections
+from typing import Any, Hashable, Optional, Tuple, OrderedDict
+
+
+class LRU:
+    """
+    LRU cache bounded by the total size of its values
+
+    - a value is cached with a stamp, it is a hit only for the same stamp,
+      so that a value computed before a change is never returned after it
+    - used from the event loop only, there is no lock
+    """
+    budget: int
+    size: int
+    entry_map: OrderedDict[Hashable, Tuple[Any, Any, int]]  # key -> (stamp, value, size)
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.size = 0
+        self.entry_map = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, stamp: Any = None) -> Optional[Any]:
+        entry = self.entry_map.get(key, None)
+        if entry is None or entry[0] != stamp:
+            self.misses += 1
+            return None
+        self.entry_map.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: Hashable, value: Any, stamp: Any = None, size: int = 1):
+        if size > self.budget:
+            return
+        self.pop(key)
+        self.entry_map[key] = (stamp, value, size)
+        self.size += size
+        while self.size > self.budget:
+            _, (_, _, evicted_size) = self.entry_map.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def pop(self, key: Hashable):
+        entry = self.entry_map.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
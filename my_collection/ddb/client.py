@@ -1,18 +1,42 @@
 import base64
-from typing import Any, Callable, Dict
+import json
+import pickle
+from typing import Any, Callable, Dict, List, Optional, Iterator, Tuple
 
 import dill
 import fastapi
 import requests
 
 from my_collection import transform
-from my_collection.ddb.server import Addr
-from my_collection.ddb.storage import TransformRequest
+from my_collection.ddb import wire
+from my_collection.ddb.ring import Addr
+from my_collection.ddb.server import RebalanceRequest, POLICY_FAIL_FAST, MISSING_HEADER
+from my_collection.ddb.storage import TransformRequest, ScanRequest, QueryRequest, MapReduceRequest
+
+
+def report_missing(r: requests.Response, missing: Optional[List[str]]):
+    if missing is not None and len(r.headers.get(MISSING_HEADER, "")) > 0:
+        missing.extend(r.headers[MISSING_HEADER].split(","))
 
 
 class Client:
-    def __init__(self, addr: Addr):
+    """
+    transform, run_transform, read and write take a policy on failed storages, see server.POLICY_FAIL_FAST and
+    server.POLICY_BEST_EFFORT, host:port of storages skipped by best effort are appended into missing if given
+
+    if binary, transform, read and write use the binary protocol of wire instead of json
+
+    only get, post and delete honour the quorums of the server, read, scan, transform, run_transform, query and
+    map_reduce see primary copies only, they are eventually consistent and may miss the latest writes of keys
+    whose primary storage failed
+    """
+
+    registered_map: Dict[str, bytes]  # transform id -> wire [transform], registered again if the server lost it
+
+    def __init__(self, addr: Addr, binary: bool = False):
         self.addr = addr
+        self.binary = binary
+        self.registered_map = {}
 
     def get(self, path: str, key: str) -> Any:
         r = requests.get(f"http://{self.addr.host}:{self.addr.port}/query/{path}?key={key}")
@@ -30,29 +54,181 @@ class Client:
         if r.status_code != 200:
             raise fastapi.HTTPException(status_code=r.status_code, detail=r.text)
 
-    def transform(self, path: str, transform_func: transform.Transform, reduce_func: Callable[[Any, Any], Any]) -> Any:
-        t = TransformRequest(
-            transform_func=base64.b64encode(dill.dumps(transform_func)),
+    def scan(self, path: str, transform_func: Optional[transform.Transform] = None,
+             policy: str = POLICY_FAIL_FAST, missing: Optional[List[str]] = None) -> Iterator[Tuple[str, Any]]:
+        """
+        iterate (key, val) pairs of path as they are streamed, pairs are in key order within each storage
+
+        :param transform_func: applied on (key, val) pairs by storages, it must produce (key, val) pairs
+        """
+        url = f"http://{self.addr.host}:{self.addr.port}/scan/{path}"
+        if self.binary:
+            r = requests.post(
+                url, params={"policy": policy}, stream=True,
+                headers={"Accept": wire.CONTENT_TYPE, "Content-Type": wire.CONTENT_TYPE},
+                data=b"" if transform_func is None else dill.dumps(transform_func),
+            )
+        else:
+            t = ScanRequest(
+                transform_func=None if transform_func is None else base64.b64encode(dill.dumps(transform_func)),
+            )
+            r = requests.post(url, params={"policy": policy}, stream=True, json=t.dict())
+        with r:
+            if r.status_code != 200:
+                raise fastapi.HTTPException(status_code=r.status_code, detail=r.text)
+            report_missing(r, missing)
+            if wire.is_binary(r.headers.get("Content-Type")):
+                for key, val in wire.decode_item_stream(r.iter_content(chunk_size=wire.STREAM_CHUNK_SIZE)):
+                    yield key, json.loads(val)
+            else:
+                for line in r.iter_lines():
+                    if len(line) > 0:
+                        key, val = json.loads(line)
+                        yield key, val
+
+    def map_reduce(self, path: str, map_func: transform.Transform, reduce_func: Callable[[Any, Any], Any],
+                   combine_func: Optional[Callable[[Any, Any], Any]] = None) -> Dict[Any, Any]:
+        """
+        group (key, val) pairs mapped from values of path by key, values of each key are merged by reduce_func
+
+        - combine_func merges values of a key in each storage before they are shuffled, reduce_func if None
+        - reduce_func and combine_func must be commutative and associative
+        - keys are partitioned among storages by repr, equal keys must have the same repr
+        - keys and values are pickled, by pickle not dill
+
+        :param map_func: applied on values by storages, it must produce (key, val) pairs
+        """
+        t = MapReduceRequest(
+            map_func=base64.b64encode(dill.dumps(map_func)),
             reduce_func=base64.b64encode(dill.dumps(reduce_func)),
-            reduce_init=0,
+            combine_func=None if combine_func is None else base64.b64encode(dill.dumps(combine_func)),
         )
-        r = requests.post(f"http://{self.addr.host}:{self.addr.port}/transform/{path}", json=t.dict())
+        r = requests.post(f"http://{self.addr.host}:{self.addr.port}/map_reduce/{path}", json=t.dict())
+        if r.status_code != 200:
+            raise fastapi.HTTPException(status_code=r.status_code, detail=r.text)
+        out = {}
+        for partition_b in wire.decode_frames(r.content):
+            out.update(pickle.loads(partition_b))
+        return out
+
+    def register_transform(self, transform_func: transform.Transform, reduce_func: Callable[[Any, Any], Any],
+                           reduce_init: Any = 0) -> str:
+        """
+        register a transform on every storage for run_transform, storages keep it loaded and cache its result
+        of each path until the path is written
+
+        :return: transform id, hash of the transform, the same for the same dill bytes
+        """
+        t = wire.encode_frames([
+            dill.dumps(transform_func), dill.dumps(reduce_func), json.dumps(reduce_init).encode("utf-8"),
+        ])
+        r = requests.post(f"http://{self.addr.host}:{self.addr.port}/registry", data=t,
+                          headers={"Content-Type": wire.CONTENT_TYPE})
+        if r.status_code != 200:
+            raise fastapi.HTTPException(status_code=r.status_code, detail=r.text)
+        transform_id = r.json()
+        self.registered_map[transform_id] = t
+        return transform_id
+
+    def run_transform(self, path: str, transform_id: str,
+                      policy: str = POLICY_FAIL_FAST, missing: Optional[List[str]] = None) -> Any:
+        url = f"http://{self.addr.host}:{self.addr.port}/transform/{path}"
+        r = requests.post(url, params={"policy": policy, "transform_id": transform_id})
+        if r.status_code == 404 and transform_id in self.registered_map:
+            # the server restarted since the transform was registered
+            r_register = requests.post(f"http://{self.addr.host}:{self.addr.port}/registry",
+                                       data=self.registered_map[transform_id],
+                                       headers={"Content-Type": wire.CONTENT_TYPE})
+            if r_register.status_code == 200:
+                r = requests.post(url, params={"policy": policy, "transform_id": transform_id})
+        if r.status_code != 200:
+            raise fastapi.HTTPException(status_code=r.status_code, detail=r.text)
+        report_missing(r, missing)
+        return r.json()
+
+    def transform(self, path: str, transform_func: transform.Transform, reduce_func: Callable[[Any, Any], Any],
+                  policy: str = POLICY_FAIL_FAST, missing: Optional[List[str]] = None) -> Any:
+        url = f"http://{self.addr.host}:{self.addr.port}/transform/{path}"
+        if self.binary:
+            r = requests.post(url, params={"policy": policy}, headers={"Content-Type": wire.CONTENT_TYPE},
+                              data=wire.encode_frames([dill.dumps(transform_func), dill.dumps(reduce_func), b"0"]))
+        else:
+            t = TransformRequest(
+                transform_func=base64.b64encode(dill.dumps(transform_func)),
+                reduce_func=base64.b64encode(dill.dumps(reduce_func)),
+                reduce_init=0,
+            )
+            r = requests.post(url, json=t.dict(), params={"policy": policy})
         if r.status_code != 200:
             raise fastapi.HTTPException(status_code=r.status_code, detail=r.text)
+        report_missing(r, missing)
         return r.json()
 
-    def read(self, path: str) -> Dict[str, Any]:
-        r = requests.get(f"http://{self.addr.host}:{self.addr.port}/file/{path}")
+    def read(self, path: str, policy: str = POLICY_FAIL_FAST, missing: Optional[List[str]] = None) -> Dict[str, Any]:
+        url = f"http://{self.addr.host}:{self.addr.port}/file/{path}"
+        if self.binary:
+            r = requests.get(url, params={"policy": policy}, headers={"Accept": wire.CONTENT_TYPE})
+        else:
+            r = requests.get(url, params={"policy": policy})
         if r.status_code != 200:
             raise fastapi.HTTPException(status_code=r.status_code, detail=r.text)
+        report_missing(r, missing)
+        if wire.is_binary(r.headers.get("Content-Type")):
+            return {key: json.loads(bytes(val)) for key, val in wire.decode_items(r.content)}
         return r.json()
 
-    def write(self, path: str, data: Dict[str, Any]):
-        r = requests.post(f"http://{self.addr.host}:{self.addr.port}/file/{path}", json=data)
+    def write(self, path: str, data: Dict[str, Any], policy: str = POLICY_FAIL_FAST,
+              missing: Optional[List[str]] = None):
+        url = f"http://{self.addr.host}:{self.addr.port}/file/{path}"
+        if self.binary:
+            r = requests.post(url, params={"policy": policy}, headers={"Content-Type": wire.CONTENT_TYPE},
+                              data=wire.encode_items((key, json.dumps(val).encode("utf-8")) for key, val in data.items()))
+        else:
+            r = requests.post(url, json=data, params={"policy": policy})
         if r.status_code != 200:
             raise fastapi.HTTPException(status_code=r.status_code, detail=r.text)
+        report_missing(r, missing)
 
     def remove(self, path: str):
         r = requests.delete(f"http://{self.addr.host}:{self.addr.port}/file/{path}")
         if r.status_code != 200:
             raise fastapi.HTTPException(status_code=r.status_code, detail=r.text)
+
+    def create_index(self, path: str, field: str):
+        """
+        index field of json object values of path, used by query
+        """
+        r = requests.post(f"http://{self.addr.host}:{self.addr.port}/index/{path}", params={"field": field})
+        if r.status_code != 200:
+            raise fastapi.HTTPException(status_code=r.status_code, detail=r.text)
+
+    def drop_index(self, path: str, field: str):
+        r = requests.delete(f"http://{self.addr.host}:{self.addr.port}/index/{path}", params={"field": field})
+        if r.status_code != 200:
+            raise fastapi.HTTPException(status_code=r.status_code, detail=r.text)
+
+    def query(self, path: str, field: str, op: str, value: Any,
+              policy: str = POLICY_FAIL_FAST, missing: Optional[List[str]] = None) -> Dict[str, Any]:
+        """
+        keys and values of path whose field compares to value by op, one of "==", "<", "<=", ">", ">=",
+        only values of the same json type match, paths without index on field are scanned
+        """
+        q = QueryRequest(field=field, op=op, value=value)
+        r = requests.post(f"http://{self.addr.host}:{self.addr.port}/select/{path}", json=q.dict(),
+                          params={"policy": policy})
+        if r.status_code != 200:
+            raise fastapi.HTTPException(status_code=r.status_code, detail=r.text)
+        report_missing(r, missing)
+        return r.json()
+
+    def rebalance(self, storage_list: List[Addr], path_list: List[str]) -> Dict[str, int]:
+        """
+        route to a new list of storages and move every copy of keys of path_list to its new storages
+
+        :return: number of moved copies of each path
+        """
+        t = RebalanceRequest(storage_list=storage_list, path_list=path_list)
+        r = requests.post(f"http://{self.addr.host}:{self.addr.port}/rebalance", json=t.dict())
+        if r.status_code != 200:
+            raise fastapi.HTTPException(status_code=r.status_code, detail=r.text)
+        return r.json()
@@ -0,0 +1,133 @@
+"""
+secondary index entries of a storage, an entry is a plyvel key with an empty value
+
+    [entry] = path?index=field \x00 [value] key
+
+    [value] = NULL | BOOL (\x00 | \x01) | NUMBER <float> | STRING string \x00
+
+    - <float> is big endian float64 with the sign bit flipped, all bits are flipped for negative numbers,
+      numbers compare as floats, integers beyond 2^53 lose precision
+    - \x00 in string is escaped as \x00\xff
+    - [value] sorts as its json value among values of the same type, values of different types compare by type,
+      only values of the same type match a range
+    - keys are utf-8 which never contains \xff, entry + \xff is after every entry of the same value
+    - values of other types (list, object) and missing fields are not indexed
+"""
+
+import struct
+from typing import Any, Optional, Tuple
+
+NULL = 0x01
+BOOL = 0x02
+NUMBER = 0x03
+STRING = 0x04
+
+OP_LIST = ("==", "<", "<=", ">", ">=")
+
+FLOAT = struct.Struct(">d")
+
+
+def encode_value(v: Any) -> Optional[bytes]:
+    """
+    :return: [value] of v, None if v is not indexed
+    """
+    if v is None:
+        return bytes([NULL])
+    if isinstance(v, bool):
+        return bytes([BOOL, int(v)])
+    if isinstance(v, (int, float)):
+        b = bytearray(FLOAT.pack(float(v)))
+        if b[0] & 0x80:
+            b = bytearray(x ^ 0xFF for x in b)
+        else:
+            b[0] |= 0x80
+        return bytes([NUMBER]) + bytes(b)
+    if isinstance(v, str):
+        return bytes([STRING]) + v.encode("utf-8").replace(b"\x00", b"\x00\xff") + b"\x00"
+    return None
+
+
+def list_key(path: str) -> bytes:
+    """
+    indexed fields of path, json list
+    """
+    return f"{path}?indexes".encode("utf-8")
+
+
+def prefix(path: str, field: str) -> bytes:
+    return f"{path}?index={field}".encode("utf-8") + b"\x00"
+
+
+def entry(path: str, field: str, key: str, val: Any) -> Optional[bytes]:
+    """
+    :return: entry of field of val, None if val has no indexed field
+    """
+    if not isinstance(val, dict) or field not in val:
+        return None
+    b = encode_value(val[field])
+    if b is None:
+        return None
+    return prefix(path, field) + b + key.encode("utf-8")
+
+
+def key_of(b: bytes, i: int) -> str:
+    """
+    :return: key of the entry b whose [value] starts at i
+    """
+    tag = b[i]
+    i += 1
+    if tag == BOOL:
+        i += 1
+    elif tag == NUMBER:
+        i += FLOAT.size
+    elif tag == STRING:
+        while True:
+            j = b.index(0, i)
+            if j + 1 < len(b) and b[j + 1] == 0xFF:
+                i = j + 2
+                continue
+            i = j + 1
+            break
+    return b[i:].decode("utf-8")
+
+
+def bounds(path: str, field: str, op: str, value: Any) -> Tuple[bytes, bytes]:
+    """
+    :return: [start, stop) of the entries of field matching op value
+    """
+    if op not in OP_LIST:
+        raise Exception(f"unknown op {op}, expected one of {OP_LIST}")
+    b = encode_value(value)
+    if b is None:
+        raise Exception(f"value {value} of type {type(value).__name__} is not indexed")
+    p = prefix(path, field)
+    first, last = p + b[:1], p + bytes([b[0] + 1])  # entries of the type of value
+    if op == "==":
+        return p + b, p + b + b"\xff"
+    if op == "<":
+        return first, p + b
+    if op == "<=":
+        return first, p + b + b"\xff"
+    if op == ">":
+        return p + b + b"\xff", last
+    return p + b, last
+
+
+def match(v: Any, op: str, value: Any) -> bool:
+    """
+    whether v matches op value as an index would, for paths without index on the field
+    """
+    a, b = encode_value(v), encode_value(value)
+    if a is None or b is None or a[0] != b[0]:
+        return False
+    if op == "==":
+        return a == b
+    if op == "<":
+        return a < b
+    if op == "<=":
+        return a <= b
+    if op == ">":
+        return a > b
+    if op == ">=":
+        return a >= b
+    raise Exception(f"unknown op {op}, expected one of {OP_LIST}")
@@ -0,0 +1,125 @@
+import asyncio
+import time
+from typing import Dict, Tuple, Any, Optional
+
+import aiohttp
+import fastapi
+
+from my_collection.ddb import wire
+from my_collection.ddb.ring import Addr
+
+LATENCY_ALPHA = 0.2  # weight of the latest response time in the moving average
+
+
+class Pool:
+    """
+    keep-alive http connections to storages, shared by all requests of a server
+
+    - a session per storage with at most limit connections, requests beyond it wait for a free connection,
+      a slow storage only holds its own connections
+    - a request fails with 504 after timeout seconds and with 502 if the storage is unreachable
+    - sessions are created on first use, inside the event loop of the server
+    - response time of each storage is tracked as a moving average, failures count as timeout,
+      cancelled requests count as their time until cancelled
+    """
+    limit: int
+    timeout: float
+    session_map: Dict[Tuple[str, int], aiohttp.ClientSession]  # (host, port) -> session
+    latency_map: Dict[Tuple[str, int], float]  # (host, port) -> moving average of response time
+
+    def __init__(self, limit: int = 32, timeout: float = 10.0):
+        self.limit = limit
+        self.timeout = timeout
+        self.session_map = {}
+        self.latency_map = {}
+
+    def latency(self, addr: Addr) -> float:
+        return self.latency_map.get((addr.host, addr.port), 0.0)
+
+    def __observe(self, addr: Addr, latency: float):
+        old = self.latency_map.get((addr.host, addr.port), latency)
+        self.latency_map[(addr.host, addr.port)] = old + LATENCY_ALPHA * (latency - old)
+
+    def __session(self, addr: Addr) -> aiohttp.ClientSession:
+        session = self.session_map.get((addr.host, addr.port), None)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(
+                base_url=f"http://{addr.host}:{addr.port}",
+                connector=aiohttp.TCPConnector(limit=self.limit),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+            self.session_map[(addr.host, addr.port)] = session
+        return session
+
+    async def request(self, method: str, addr: Addr, path: str, params: Optional[Dict[str, str]] = None,
+                      json: Any = None, data: Optional[bytes] = None,
+                      headers: Optional[Dict[str, str]] = None) -> Tuple[int, Any]:
+        """
+        :return: status and body of the response, body is decoded from json if status is 200, text otherwise,
+        bytes if the response is in binary protocol
+        """
+        t0 = time.perf_counter()
+        try:
+            async with self.__session(addr).request(
+                    method, path, params=params, json=json, data=data, headers=headers,
+            ) as r:
+                if r.status != 200:
+                    body = await r.text()
+                elif r.content_type == wire.CONTENT_TYPE:
+                    body = await r.read()
+                else:
+                    body = await r.json()
+                self.__observe(addr, time.perf_counter() - t0)
+                return r.status, body
+        except asyncio.TimeoutError:
+            self.__observe(addr, self.timeout)
+            return 504, f"timed out after {self.timeout}s"
+        except aiohttp.ClientError as e:
+            self.__observe(addr, self.timeout)
+            return 502, f"unreachable: {e!r}"
+        except asyncio.CancelledError:
+            # losers of hedged requests are slower than the winner at least
+            self.__observe(addr, time.perf_counter() - t0)
+            raise
+
+    async def open(self, method: str, addr: Addr, path: str, params: Optional[Dict[str, str]] = None,
+                   json: Any = None, data: Optional[bytes] = None,
+                   headers: Optional[Dict[str, str]] = None) -> Tuple[int, Any]:
+        """
+        request without reading the body, for streams
+
+        - timeout applies to connecting and to each read, not to the whole stream
+        - the caller reads and releases the response
+
+        :return: status and the response if status is 200, text otherwise
+        """
+        try:
+            r = await self.__session(addr).request(
+                method, path, params=params, json=json, data=data, headers=headers,
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout),
+            )
+            if r.status != 200:
+                async with r:
+                    return r.status, await r.text()
+            return r.status, r
+        except asyncio.TimeoutError:
+            return 504, f"timed out after {self.timeout}s"
+        except aiohttp.ClientError as e:
+            return 502, f"unreachable: {e!r}"
+
+    async def call(self, method: str, addr: Addr, path: str, params: Optional[Dict[str, str]] = None,
+                   json: Any = None, data: Optional[bytes] = None, headers: Optional[Dict[str, str]] = None) -> Any:
+        """
+        request raising fastapi.HTTPException if status is not 200
+
+        :return: body of the response
+        """
+        status, body = await self.request(method, addr, path, params=params, json=json, data=data, headers=headers)
+        if status != 200:
+            raise fastapi.HTTPException(status_code=status, detail=f"storage {addr.host}:{addr.port}: {body}")
+        return body
+
+    async def close(self):
+        for session in self.session_map.values():
+            await session.close()
+        self.session_map = {}
@@ -0,0 +1,117 @@
+import bisect
+import hashlib
+from typing import List, Dict, Tuple, FrozenSet
+
+import pydantic
+
+
+HASH_END = 1 << 512  # hash is less than HASH_END
+
+
+def hash(key: str) -> int:
+    h = hashlib.blake2b()
+    h.update(key.encode("utf-8"))
+    return int.from_bytes(
+        bytes=h.digest(),
+        byteorder="big",
+        signed=False,
+    )
+
+
+class Addr(pydantic.BaseModel):
+    host: str
+    port: int
+    weight: float = 1.0  # share of keys relative to other storages
+
+
+class Ring:
+    """
+    consistent hash ring with virtual nodes
+
+    - each storage has round(num_vnodes * weight) points on the ring at hash of its host, port and point index,
+      points do not depend on the order of storages
+    - a key belongs to the storage of the first point at or after hash of the key, wrapping around
+    - adding or removing a storage moves only the keys between its points and the points before them
+    """
+    storage_list: List[Addr]
+    point_list: List[int]  # sorted
+    owner_list: List[int]  # index of the storage of each point
+
+    def __init__(self, storage_list: List[Addr], num_vnodes: int = 128):
+        self.storage_list = storage_list
+        point_map: Dict[int, int] = {}
+        for i, addr in enumerate(storage_list):
+            for j in range(max(1, round(num_vnodes * addr.weight))):
+                point_map[hash(f"{addr.host}:{addr.port}#{j}")] = i
+        self.point_list = sorted(point_map)
+        self.owner_list = [point_map[point] for point in self.point_list]
+
+    def lookup(self, key: str) -> int:
+        """
+        :return: index of the storage of key in storage_list
+        """
+        i = bisect.bisect_left(self.point_list, hash(key))
+        return self.owner_list[i % len(self.point_list)]
+
+    def lookup_list(self, key: str, n: int) -> List[int]:
+        """
+        :return: indices of the storages of n replicas of key, distinct storages of successive points
+        from the point of key, the first one is lookup(key)
+        """
+        return self.lookup_hash_list(hash(key), n)
+
+    def lookup_hash_list(self, h: int, n: int) -> List[int]:
+        """
+        lookup_list of a key of hash h
+        """
+        n = min(n, len(self.storage_list))
+        i = bisect.bisect_left(self.point_list, h)
+        out = []
+        while len(out) < n:
+            owner = self.owner_list[i % len(self.point_list)]
+            if owner not in out:
+                out.append(owner)
+            i += 1
+        return out
+
+
+def copy_set(r: Ring, h: int, replication: int) -> FrozenSet[Tuple[str, int, bool]]:
+    """
+    :return: (host, port, is replica) of the copies of a key of hash h, see Server
+    """
+    idx_list = r.lookup_hash_list(h, replication)
+    return frozenset((r.storage_list[idx].host, r.storage_list[idx].port, i > 0) for i, idx in enumerate(idx_list))
+
+
+def moved_range_list(old_ring: Ring, new_ring: Ring,
+                     replication: int) -> List[Tuple[int, int, FrozenSet[Tuple[str, int, bool]],
+                                                     FrozenSet[Tuple[str, int, bool]]]]:
+    """
+    ranges of hash whose copies differ between old_ring and new_ring
+
+    - keys of hash in (lo, hi] are in the same copies as points of both rings are bounds of ranges
+    - only keys in these ranges move when routing changes from old_ring to new_ring
+
+    :return: sorted (lo, hi, copies in old_ring, copies in new_ring), see copy_set
+    """
+    bound_list = sorted(set(old_ring.point_list) | set(new_ring.point_list))
+    out = []
+    for lo, hi in zip([-1] + bound_list, bound_list + [HASH_END]):
+        # hash after the last point wraps around to the first point
+        h = hi if hi < HASH_END else bound_list[0]
+        old_set, new_set = copy_set(old_ring, h, replication), copy_set(new_ring, h, replication)
+        if old_set == new_set:
+            continue
+        if len(out) > 0 and out[-1][1] == lo and out[-1][2:] == (old_set, new_set):
+            out[-1] = (out[-1][0], hi, old_set, new_set)
+        else:
+            out.append((lo, hi, old_set, new_set))
+    return out
+
+
+def in_range(h: int, lo_list: List[int], hi_list: List[int]) -> bool:
+    """
+    whether h is in one of sorted disjoint ranges (lo, hi]
+    """
+    i = bisect.bisect_left(lo_list, h) - 1
+    return i >= 0 and h <= hi_list[i]
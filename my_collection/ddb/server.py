@@ -1,51 +1,243 @@
+import asyncio
 import base64
-import hashlib
-from functools import reduce
-from typing import List, Dict, Any
+import contextlib
+import json
+import time
+import uuid
+from typing import List, Dict, Any, Callable, Awaitable, Tuple, AsyncIterator, Union, Set, Optional, FrozenSet
 
 import dill
 import fastapi
 import pydantic
-import requests
 
 from my_collection import http, logger
-from my_collection.ddb.storage import TransformRequest
+from my_collection.ddb import ring, wire
+from my_collection.ddb.pool import Pool
+from my_collection.ddb.ring import Addr, Ring
+from my_collection.ddb.storage import TransformRequest, ScanRequest, Versioned, QueryRequest, MapReduceRequest, \
+    MapRequest, RangeRequest, transform_id_of
 
 
-def hash(key: str) -> int:
-    h = hashlib.blake2b()
-    h.update(key.encode("utf-8"))
-    return int.from_bytes(
-        bytes=h.digest(),
-        byteorder="big",
-        signed=False,
-    )
+class RebalanceRequest(pydantic.BaseModel):
+    storage_list: List[Addr]
+    path_list: List[str]  # paths whose keys are moved to their new storage
 
 
-class Addr(pydantic.BaseModel):
-    host: str
-    port: int
-
+POLICY_FAIL_FAST = "fail_fast"  # fail on the first failed storage
+POLICY_BEST_EFFORT = "best_effort"  # skip failed storages, reported in header MISSING_HEADER
+MISSING_HEADER = "x-missing-storages"  # comma separated host:port of failed storages
 
 ctx = http.Router()
 
 
 class Server(http.Server):
-    def __init__(self, storage_list: List[Addr]):
+    background_set: Set[asyncio.Task]  # requests to replicas completing after the response
+    blocked_path_set: Set[str]  # paths being rebalanced, their writes wait
+    write_count_map: Dict[str, int]  # path -> number of running writes
+    write_cond: asyncio.Condition  # notified when a write ends or paths are unblocked
+    rebalance_lock: asyncio.Lock
+    transform_map: Dict[str, Tuple[bytes, Callable[[Any, Any], Any], Any]]  # id -> [transform], reduce_func, init
+
+    def __init__(self, storage_list: List[Addr], pool_limit: int = 32, timeout: float = 10.0,
+                 replication: int = 1, read_quorum: int = 1, write_quorum: int = 1, hedge_delay: float = 0.05):
+        """
+        keys are routed to storages by a consistent hash ring, see Ring
+
+        - a key has replication copies on the storages of successive points of the ring, the first one is
+          the primary copy
+        - bulk reads, read, scan, transform, select and map_reduce, see only primary copies and do not honour
+          read_quorum and write_quorum, they are eventually consistent: a primary copy missed by a write that
+          met its quorum without it stays stale until a get repairs it or a later write reaches it
+        - get, post and delete are versioned by the clock of the server, the newest version wins,
+          post and delete wait for write_quorum copies, others are written in the background
+        - get asks read_quorum copies of the fastest storages, another copy is asked if a storage has not
+          answered in hedge_delay seconds or failed, stale copies among the answers are repaired
+        - bulk write writes all copies with the same version, missing storages follow the policy
+
+        :param pool_limit: max number of keep-alive connections to each storage
+        :param timeout: seconds before a request to a storage fails
+        """
         super().__init__(ctx)
+        n = min(replication, len(storage_list))
+        if not (1 <= read_quorum <= n and 1 <= write_quorum <= n):
+            raise Exception(f"read_quorum and write_quorum must be in [1, {n}]")
         self.storage_list = storage_list
+        self.ring = Ring(storage_list)
+        self.pool = Pool(limit=pool_limit, timeout=timeout)
+        self.replication = replication
+        self.read_quorum = read_quorum
+        self.write_quorum = write_quorum
+        self.hedge_delay = hedge_delay
+        self.version = 0
+        self.background_set = set()
+        self.transform_map = {}
+        self.blocked_path_set = set()
+        self.write_count_map = {}
+        self.app.on_event("startup")(self.__start)
+        self.app.on_event("shutdown")(self.pool.close)
+
+    async def __start(self):
+        # inside the event loop of the server
+        self.write_cond = asyncio.Condition()
+        self.rebalance_lock = asyncio.Lock()
+
+    def __next_version(self) -> int:
+        self.version = max(self.version + 1, time.time_ns())
+        return self.version
+
+    def __background(self, task: asyncio.Task):
+        self.background_set.add(task)
+        task.add_done_callback(self.background_set.discard)
+
+    @contextlib.asynccontextmanager
+    async def __writing(self, path: str):
+        """
+        a write to path, it waits while path is rebalanced
+        """
+        async with self.write_cond:
+            await self.write_cond.wait_for(lambda: path not in self.blocked_path_set)
+            self.write_count_map[path] = self.write_count_map.get(path, 0) + 1
+        try:
+            yield
+        finally:
+            async with self.write_cond:
+                self.write_count_map[path] -= 1
+                self.write_cond.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def __blocking(self, path_list: List[str]):
+        """
+        block writes to path_list, running writes and requests to replicas in the background are waited for
+        """
+        async with self.write_cond:
+            self.blocked_path_set.update(path_list)
+            await self.write_cond.wait_for(lambda: all(self.write_count_map.get(path, 0) == 0 for path in path_list))
+        await asyncio.gather(*self.background_set, return_exceptions=True)
+        try:
+            yield
+        finally:
+            async with self.write_cond:
+                self.blocked_path_set.difference_update(path_list)
+                self.write_cond.notify_all()
+
+    def __replica_list(self, path: str, key: str) -> List[Tuple[Addr, bool]]:
+        """
+        :return: (storage, is replica) of the copies of key, the primary copy first
+        """
+        idx_list = self.ring.lookup_list(f"{path}?key={key}", self.replication)
+        return [(self.storage_list[idx], i > 0) for i, idx in enumerate(idx_list)]
+
+    def __request_replica(self, method: str, addr: Addr, replica: bool, path: str, key: str,
+                          v: Optional[Versioned] = None) -> asyncio.Task:
+        return asyncio.ensure_future(self.pool.request(
+            method, addr, f"/replica/{path}", params={"key": key, "replica": "true" if replica else "false"},
+            json=None if v is None else v.dict(),
+        ))
+
+    async def __write_quorum(self, path: str, key: str, v: Versioned):
+        task_list = [
+            self.__request_replica("POST", addr, replica, path, key, v)
+            for addr, replica in self.__replica_list(path, key)
+        ]
+        num_written, error = 0, None
+        pending = set(task_list)
+        while num_written < self.write_quorum and num_written + len(pending) >= self.write_quorum:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                status, body = task.result()
+                if status == 200:
+                    num_written += 1
+                else:
+                    error = body
+        for task in pending:
+            self.__background(task)
+        if num_written < self.write_quorum:
+            raise fastapi.HTTPException(
+                status_code=503,
+                detail=f"{num_written} of {self.write_quorum} copies of {path}?key={key} written: {error}",
+            )
+
+    async def __read_quorum(self, path: str, key: str) -> Versioned:
+        # fastest storages first
+        replica_list = sorted(self.__replica_list(path, key), key=lambda ar: self.pool.latency(ar[0]))
+        task_map: Dict[asyncio.Task, Tuple[Addr, bool]] = {}
+
+        def ask_next() -> asyncio.Task:
+            addr, replica = replica_list[len(task_map)]
+            task = self.__request_replica("GET", addr, replica, path, key)
+            task_map[task] = (addr, replica)
+            return task
+
+        pending = set(ask_next() for _ in range(self.read_quorum))
+        answer_list: List[Tuple[Addr, bool, Versioned]] = []
+        error = None
+        try:
+            while len(answer_list) < self.read_quorum and len(pending) > 0:
+                can_hedge = len(task_map) < len(replica_list)
+                done, pending = await asyncio.wait(
+                    pending, timeout=self.hedge_delay if can_hedge else None, return_when=asyncio.FIRST_COMPLETED,
+                )
+                if len(done) == 0:  # hedge
+                    pending.add(ask_next())
+                    continue
+                for task in done:
+                    status, body = task.result()
+                    if status == 200:
+                        answer_list.append((*task_map[task], Versioned(**body)))
+                        continue
+                    error = body
+                    if len(task_map) < len(replica_list):
+                        pending.add(ask_next())
+        finally:
+            for task in pending:
+                task.cancel()
+        if len(answer_list) < self.read_quorum:
+            raise fastapi.HTTPException(
+                status_code=503,
+                detail=f"{len(answer_list)} of {self.read_quorum} copies of {path}?key={key} read: {error}",
+            )
+        newest = max((v for _, _, v in answer_list), key=lambda v: v.version)
+        for addr, replica, v in answer_list:
+            if v.version < newest.version:
+                # read repair
+                self.__background(self.__request_replica("POST", addr, replica, path, key, newest))
+        return newest
+
+    async def __scatter(self, policy: str, missing: List[str],
+                        f: Callable[[Addr], Awaitable[Tuple[int, Any]]]) -> AsyncIterator[Any]:
+        """
+        call f on every storage concurrently, yield response bodies in order of arrival
+
+        - fail fast: raise on the first failed storage, other requests are cancelled
+        - best effort: host:port of failed storages are appended into missing
+        """
+        if policy not in (POLICY_FAIL_FAST, POLICY_BEST_EFFORT):
+            raise fastapi.HTTPException(status_code=400, detail=f"unknown policy {policy}")
+        task_map = {asyncio.ensure_future(f(addr)): addr for addr in self.storage_list}
+        pending = set(task_map)
+        try:
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    addr = task_map[task]
+                    status, body = task.result()
+                    if status == 200:
+                        yield body
+                        continue
+                    if policy == POLICY_FAIL_FAST:
+                        raise fastapi.HTTPException(status_code=status, detail=f"storage {addr.host}:{addr.port}: {body}")
+                    missing.append(f"{addr.host}:{addr.port}")
+        finally:
+            for task in pending:
+                task.cancel()
 
     @ctx.http_method(ctx.method_get, "/query/{path:path}")
     async def get(self,
                   path: str = fastapi.Path(default=None),
                   key: str = fastapi.Query(default=None),
                   ):
-        storage_idx = hash(f"{path}?key={key}") % len(self.storage_list)
-        addr = self.storage_list[storage_idx]
-        r = requests.get(f"http://{addr.host}:{addr.port}/query/{path}?key={key}")
-        if r.status_code != 200:
-            raise fastapi.HTTPException(status_code=r.status_code, detail=r.text)
-        return r.json()
+        v = await self.__read_quorum(path, key)
+        return None if v.deleted else v.val
 
     @ctx.http_method(ctx.method_post, "/query/{path:path}")
     async def post(self,
@@ -53,68 +245,444 @@ class Server(http.Server):
                    key: str = fastapi.Query(default=None),
                    val: Any = fastapi.Body(default=None),
                    ):
-        storage_idx = hash(f"{path}?key={key}") % len(self.storage_list)
-        addr = self.storage_list[storage_idx]
-        r = requests.post(f"http://{addr.host}:{addr.port}/query/{path}?key={key}", json=val)
-        if r.status_code != 200:
-            raise fastapi.HTTPException(status_code=r.status_code, detail=r.text)
-        logger.now().debug(f"write {path}?key={key} into storage {storage_idx}")
+        async with self.__writing(path):
+            v = Versioned(version=self.__next_version(), val=val)
+            await self.__write_quorum(path, key, v)
+        logger.now().debug(f"write {path}?key={key} version {v.version}")
 
     @ctx.http_method(ctx.method_delete, "/query/{path:path}")
     async def delete(self,
                      path: str = fastapi.Path(default=None),
                      key: str = fastapi.Query(default=None),
                      ):
-        storage_idx = hash(f"{path}?key={key}") % len(self.storage_list)
-        addr = self.storage_list[storage_idx]
-        r = requests.delete(f"http://{addr.host}:{addr.port}/query/{path}?key={key}")
-        if r.status_code != 200:
-            raise fastapi.HTTPException(status_code=r.status_code, detail=r.text)
-        logger.now().debug(f"write {path}?key={key} from storage {storage_idx}")
+        async with self.__writing(path):
+            v = Versioned(version=self.__next_version(), deleted=True)
+            await self.__write_quorum(path, key, v)
+        logger.now().debug(f"delete {path}?key={key} version {v.version}")
+
+    @ctx.http_method(ctx.method_post, "/registry")
+    async def register(self,
+                       t: bytes = fastapi.Body(default=None),
+                       ) -> str:
+        """
+        register a transform on every storage, fails if a storage fails, t is bytes of wire [transform]
+
+        :return: transform id, see storage.transform_id_of
+        """
+        _, reduce_b, init_b = wire.decode_transform(t)
+        transform_id = transform_id_of(t)
+        async for _ in self.__scatter(
+                POLICY_FAIL_FAST, [],
+                lambda addr: self.pool.request("POST", addr, "/registry", data=t,
+                                               headers={"Content-Type": wire.CONTENT_TYPE}),
+        ):
+            pass
+        self.transform_map[transform_id] = (t, dill.loads(reduce_b), json.loads(bytes(init_b)))
+        return transform_id
+
+    async def __registered(self, transform_id: str) -> Tuple[bytes, Callable[[Any, Any], Any], Any]:
+        """
+        transforms registered before the server started are loaded from the first storage that has it
+        """
+        if transform_id not in self.transform_map:
+            for addr in self.storage_list:
+                status, t = await self.pool.request("GET", addr, f"/registry/{transform_id}")
+                if status == 200:
+                    _, reduce_b, init_b = wire.decode_transform(t)
+                    self.transform_map[transform_id] = (t, dill.loads(reduce_b), json.loads(bytes(init_b)))
+                    break
+            else:
+                raise fastapi.HTTPException(status_code=404, detail=f"transform {transform_id} is not registered")
+        return self.transform_map[transform_id]
+
+    async def __transform_by_id(self, addr: Addr, path: str, transform_id: str) -> Tuple[int, Any]:
+        params = {"transform_id": transform_id}
+        status, body = await self.pool.request("POST", addr, f"/transform/{path}", params=params)
+        if status == 404:
+            # storages added or wiped since the transform was registered
+            status, body = await self.pool.request("POST", addr, "/registry", data=self.transform_map[transform_id][0],
+                                                   headers={"Content-Type": wire.CONTENT_TYPE})
+            if status == 200:
+                status, body = await self.pool.request("POST", addr, f"/transform/{path}", params=params)
+        return status, body
 
     @ctx.http_method(ctx.method_post, "/transform/{path:path}")
     async def transform(self,
+                        response: fastapi.Response,
                         path: str = fastapi.Path(default=None),
-                        t: TransformRequest = fastapi.Body(default=None),
+                        t: Union[TransformRequest, bytes, None] = fastapi.Body(default=None),
+                        policy: str = fastapi.Query(default=POLICY_FAIL_FAST),
+                        transform_id: Optional[str] = fastapi.Query(default=None),
                         ):
-        out = []
-        for addr in self.storage_list:
-            r = requests.post(f"http://{addr.host}:{addr.port}/transform/{path}", json=t.dict())
-            if r.status_code != 200:
-                raise fastapi.HTTPException(status_code=r.status_code, detail=r.text)
-            out.append(r.json())
-        reduce_func = dill.loads(base64.b64decode(t.reduce_func))
-        return reduce(reduce_func, out)
+        """
+        partial results of storages are reduced in order of arrival, reduce_func must be commutative
+
+        - t is bytes of wire [transform] in binary protocol, it is forwarded as is
+        - if transform_id is given, t is ignored, storages run the registered transform and cache its result
+        """
+        if transform_id is not None:
+            _, reduce_func, reduce_init = await self.__registered(transform_id)
+            f = lambda addr: self.__transform_by_id(addr, path, transform_id)
+        elif isinstance(t, bytes):
+            _, reduce_b, init_b = wire.decode_transform(t)
+            reduce_func, reduce_init = dill.loads(reduce_b), json.loads(bytes(init_b))
+            f = lambda addr: self.pool.request("POST", addr, f"/transform/{path}", data=t,
+                                               headers={"Content-Type": wire.CONTENT_TYPE})
+        else:
+            reduce_func, reduce_init = dill.loads(base64.b64decode(t.reduce_func)), t.reduce_init
+            f = lambda addr: self.pool.request("POST", addr, f"/transform/{path}", json=t.dict())
+        missing = []
+        out, empty = reduce_init, True
+        async for partial in self.__scatter(policy, missing, f):
+            out, empty = (partial if empty else reduce_func(out, partial)), False
+        response.headers[MISSING_HEADER] = ",".join(missing)
+        return out
+
+    @ctx.http_method(ctx.method_post, "/map_reduce/{path:path}")
+    async def map_reduce(self,
+                         path: str = fastapi.Path(default=None),
+                         t: MapReduceRequest = fastapi.Body(default=None),
+                         ):
+        """
+        keyed map reduce, partition i of keys is reduced by storage i
+
+        - map: every storage maps and combines its primary copies, then sends each partition to its storage
+        - reduce: every storage reduces the partitions it received
+        - partitions go between storages, the server only concatenates reduced partitions without decoding
+        - fails if a storage fails, its partitions would be lost
+
+        :return: wire [partitions] with disjoint keys
+        """
+        job = uuid.uuid4().hex
+        partition_map = {(addr.host, addr.port): i for i, addr in enumerate(self.storage_list)}
+
+        def map_request(addr: Addr) -> Dict[str, Any]:
+            return MapRequest(
+                job=job, partition=partition_map[(addr.host, addr.port)], partition_list=self.storage_list, **t.dict(),
+            ).dict()
+
+        part_list = []
+        try:
+            async for _ in self.__scatter(
+                    POLICY_FAIL_FAST, [],
+                    lambda addr: self.pool.request("POST", addr, f"/map/{path}", json=map_request(addr)),
+            ):
+                pass
+            async for partial in self.__scatter(
+                    POLICY_FAIL_FAST, [],
+                    lambda addr: self.pool.request("POST", addr, f"/reduce/{job}", data=base64.b64decode(t.reduce_func),
+                                                   headers={"Content-Type": wire.CONTENT_TYPE}),
+            ):
+                part_list.append(partial)
+        except BaseException:
+            # drop partitions received by storages
+            for addr in self.storage_list:
+                self.__background(asyncio.ensure_future(self.pool.request("DELETE", addr, f"/shuffle/{job}")))
+            raise
+        return fastapi.Response(content=b"".join(part_list), media_type=wire.CONTENT_TYPE)
+
+    @ctx.http_method(ctx.method_post, "/scan/{path:path}")
+    async def scan(self,
+                   path: str = fastapi.Path(default=None),
+                   t: Union[ScanRequest, bytes, None] = fastapi.Body(default=None),
+                   policy: str = fastapi.Query(default=POLICY_FAIL_FAST),
+                   accept: str = fastapi.Header(default=None),
+                   ):
+        """
+        stream (key, val) pairs of path, streams of storages are forwarded one after another without decoding,
+        pairs are in key order within each storage
+
+        - policy applies to opening the streams, a storage failing in the middle of its stream aborts the stream
+        - t is bytes of wire [scan] in binary protocol, it is forwarded as is
+        """
+        binary = wire.is_binary(accept)
+        kwargs = {"headers": {"Accept": wire.CONTENT_TYPE if binary else wire.NDJSON_CONTENT_TYPE}}
+        if isinstance(t, bytes):
+            kwargs["data"] = t
+            kwargs["headers"]["Content-Type"] = wire.CONTENT_TYPE
+        elif t is not None:
+            kwargs["json"] = t.dict()
+
+        missing = []
+        response_list = []
+        try:
+            async for r in self.__scatter(
+                    policy, missing, lambda addr: self.pool.open("POST", addr, f"/scan/{path}", **kwargs),
+            ):
+                response_list.append(r)
+        except BaseException:
+            for r in response_list:
+                r.release()
+            raise
+
+        async def chunk_iter() -> AsyncIterator[bytes]:
+            try:
+                for r in response_list:
+                    async for chunk in r.content.iter_any():
+                        yield chunk
+            finally:
+                for r in response_list:
+                    r.release()
+
+        return fastapi.responses.StreamingResponse(
+            chunk_iter(),
+            media_type=wire.CONTENT_TYPE if binary else wire.NDJSON_CONTENT_TYPE,
+            headers={MISSING_HEADER: ",".join(missing)},
+        )
 
     @ctx.http_method(ctx.method_get, "/file/{path:path}")
     async def read(self,
+                   response: fastapi.Response,
                    path: str = fastapi.Path(default=None),
+                   policy: str = fastapi.Query(default=POLICY_FAIL_FAST),
+                   accept: str = fastapi.Header(default=None),
                    ):
+        """
+        in binary protocol, wire [items] of storages are concatenated without decoding
+        """
+        missing = []
+        if wire.is_binary(accept):
+            part_list = []
+            async for partial in self.__scatter(
+                    policy, missing,
+                    lambda addr: self.pool.request("GET", addr, f"/file/{path}", headers={"Accept": wire.CONTENT_TYPE}),
+            ):
+                part_list.append(partial)
+            return fastapi.Response(
+                content=b"".join(part_list),
+                media_type=wire.CONTENT_TYPE,
+                headers={MISSING_HEADER: ",".join(missing)},
+            )
         out = {}
-        for addr in self.storage_list:
-            r = requests.get(f"http://{addr.host}:{addr.port}/file/{path}")
-            if r.status_code != 200:
-                continue
-            out = out | r.json()
+        async for partial in self.__scatter(
+                policy, missing, lambda addr: self.pool.request("GET", addr, f"/file/{path}"),
+        ):
+            out.update(partial)
+        response.headers[MISSING_HEADER] = ",".join(missing)
         return out
 
     @ctx.http_method(ctx.method_post, "/file/{path:path}")
     async def write(self,
+                    response: fastapi.Response,
                     path: str = fastapi.Path(default=None),
-                    data: Dict[str, Any] = fastapi.Body(default=None),
+                    data: Union[Dict[str, Any], bytes] = fastapi.Body(default=None),
+                    policy: str = fastapi.Query(default=POLICY_FAIL_FAST),
                     ):
-        data_list = [{} for _ in self.storage_list]
+        """
+        keys of missing storages are not written, keys of other storages are written,
+        all copies of all keys are written with the same version
 
-        for key, val in data.items():
-            storage_idx = hash(f"{path}?key={key}") % len(self.storage_list)
-            data_list[storage_idx][key] = val
+        data is bytes of wire [items] in binary protocol, values are forwarded without decoding
+        """
+        binary = isinstance(data, bytes)
+        version = self.__next_version()
+        data_map = {}  # (host, port) -> is replica -> key -> val
+        for key, val in wire.decode_items(data) if binary else data.items():
+            for addr, replica in self.__replica_list(path, key):
+                data_map.setdefault((addr.host, addr.port), {}).setdefault(replica, {})[key] = val
 
-        for i, addr in enumerate(self.storage_list):
-            requests.post(f"http://{addr.host}:{addr.port}/file/{path}", json=data_list[i])
+        async def write_copies(addr: Addr, replica: bool, copy_data: Dict[str, Any]) -> Tuple[int, Any]:
+            params = {"replica": "true" if replica else "false", "version": str(version)}
+            if binary:
+                return await self.pool.request(
+                    "POST", addr, f"/file/{path}", params=params,
+                    data=wire.encode_items(copy_data.items()), headers={"Content-Type": wire.CONTENT_TYPE},
+                )
+            return await self.pool.request("POST", addr, f"/file/{path}", params=params, json=copy_data)
+
+        async def write_storage(addr: Addr) -> Tuple[int, Any]:
+            result_list = await asyncio.gather(*(
+                write_copies(addr, replica, copy_data)
+                for replica, copy_data in data_map.get((addr.host, addr.port), {}).items()
+            ))
+            for status, body in result_list:
+                if status != 200:
+                    return status, body
+            return 200, None
+
+        missing = []
+        async with self.__writing(path):
+            async for _ in self.__scatter(policy, missing, write_storage):
+                pass
+        response.headers[MISSING_HEADER] = ",".join(missing)
+
+    @ctx.http_method(ctx.method_post, "/index/{path:path}")
+    async def create_index(self,
+                           path: str = fastapi.Path(default=None),
+                           field: str = fastapi.Query(default=None),
+                           ):
+        """
+        index field of path on every storage, fails if a storage fails
+        """
+        async for _ in self.__scatter(
+                POLICY_FAIL_FAST, [],
+                lambda addr: self.pool.request("POST", addr, f"/index/{path}", params={"field": field}),
+        ):
+            pass
+
+    @ctx.http_method(ctx.method_delete, "/index/{path:path}")
+    async def drop_index(self,
+                         path: str = fastapi.Path(default=None),
+                         field: str = fastapi.Query(default=None),
+                         ):
+        async for _ in self.__scatter(
+                POLICY_FAIL_FAST, [],
+                lambda addr: self.pool.request("DELETE", addr, f"/index/{path}", params={"field": field}),
+        ):
+            pass
+
+    @ctx.http_method(ctx.method_post, "/select/{path:path}")
+    async def select(self,
+                     response: fastapi.Response,
+                     path: str = fastapi.Path(default=None),
+                     q: QueryRequest = fastapi.Body(default=None),
+                     policy: str = fastapi.Query(default=POLICY_FAIL_FAST),
+                     ):
+        """
+        keys and values of path whose field matches op value, storages use their index on field if any
+        """
+        missing = []
+        out = {}
+        async for partial in self.__scatter(
+                policy, missing, lambda addr: self.pool.request("POST", addr, f"/select/{path}", json=q.dict()),
+        ):
+            out.update(partial)
+        response.headers[MISSING_HEADER] = ",".join(missing)
+        return out
 
     @ctx.http_method(ctx.method_delete, "/file/{path:path}")
     async def remove(self,
                      path: str = fastapi.Path(default=None),
                      ):
-        for addr in self.storage_list:
-            requests.delete(f"http://{addr.host}:{addr.port}/file/{path}")
+        async with self.__writing(path):
+            await asyncio.gather(*(
+                self.pool.request("DELETE", addr, f"/file/{path}")
+                for addr in self.storage_list
+            ))
+
+    async def __copy_range(self, path: str, old_ring: Ring, new_ring: Ring, addr: Addr, replica: bool,
+                           t: RangeRequest):
+        """
+        stream copies of path in the role of replica in the ranges of t from addr,
+        write them in chunks to the storages holding them in new_ring but not in old_ring, the newest version wins
+        """
+        addr_map = {(a.host, a.port): a for a in new_ring.storage_list}
+
+        async def flush(data_map: Dict[Tuple[str, int, bool], Dict[str, Any]]):
+            result_list = await asyncio.gather(*(
+                self.pool.request("POST", addr_map[(host, port)], f"/versioned/{path}",
+                                  params={"replica": "true" if new_replica else "false"}, json=data)
+                for (host, port, new_replica), data in data_map.items()
+            ))
+            for (host, port, _), (status, body) in zip(data_map, result_list):
+                if status != 200:
+                    raise fastapi.HTTPException(status_code=status, detail=f"storage {host}:{port}: {body}")
+
+        status, r = await self.pool.open("POST", addr, f"/range/{path}",
+                                         params={"replica": "true" if replica else "false"}, json=t.dict())
+        if status != 200:
+            raise fastapi.HTTPException(status_code=status, detail=f"storage {addr.host}:{addr.port}: {r}")
+        try:
+            buffer = bytearray()
+            data_map = {}  # (host, port, is replica) -> key -> versioned
+            num_copies = 0
+            async for chunk in r.content.iter_any():
+                buffer += chunk
+                for frame in wire.decode_complete(buffer):
+                    key, v = json.loads(frame)
+                    h = ring.hash(f"{path}?key={key}")
+                    for copy in ring.copy_set(new_ring, h, self.replication) - \
+                            ring.copy_set(old_ring, h, self.replication):
+                        data_map.setdefault(copy, {})[key] = v
+                    num_copies += 1
+                    if num_copies >= wire.SCAN_CHUNK:
+                        await flush(data_map)
+                        data_map, num_copies = {}, 0
+            if len(buffer) > 0:
+                raise fastapi.HTTPException(status_code=502, detail=f"storage {addr.host}:{addr.port}: truncated")
+            await flush(data_map)
+        finally:
+            r.release()
+
+    async def __delete_range(self, path: str, addr: Addr, replica: bool, t: RangeRequest) -> Tuple[int, Any]:
+        return await self.pool.request("DELETE", addr, f"/range/{path}",
+                                       params={"replica": "true" if replica else "false"}, json=t.dict())
+
+    @ctx.http_method(ctx.method_post, "/rebalance")
+    async def rebalance(self,
+                        t: RebalanceRequest = fastapi.Body(default=None),
+                        ):
+        """
+        route to a new list of storages, only ranges of hash whose copies change are moved, see ring.moved_range_list
+
+        - every old storage streams its copies of path_list in the ranges it holds, they are written with their
+          version to their new storages, then routing is switched and moved copies are deleted from old storages
+        - writes to path_list wait until the rebalance is done, other requests are served meanwhile
+        - if a copy fails, copies written to new storages are deleted and routing is not switched,
+          if a delete fails after routing is switched, the rebalance fails and the copies stay on old storages
+
+        :return: number of moved copies of each path
+        """
+        n = min(self.replication, len(t.storage_list))
+        if not (self.read_quorum <= n and self.write_quorum <= n):
+            raise fastapi.HTTPException(status_code=400, detail=f"read_quorum and write_quorum must be in [1, {n}]")
+        async with self.rebalance_lock:
+            old_ring, new_ring = self.ring, Ring(t.storage_list)
+            range_list = ring.moved_range_list(old_ring, new_ring, self.replication)
+
+            def request_list(storage_list: List[Addr], select: Callable[[FrozenSet, FrozenSet], FrozenSet]
+                             ) -> List[Tuple[Addr, bool, RangeRequest]]:
+                """
+                :return: (storage, is replica, ranges) of copies in select(copies in old_ring, copies in new_ring)
+                """
+                out = []
+                for addr in storage_list:
+                    for replica in (False, True):
+                        r = RangeRequest(range_list=[
+                            (lo, hi) for lo, hi, old_set, new_set in range_list
+                            if (addr.host, addr.port, replica) in select(old_set, new_set)
+                        ])
+                        if len(r.range_list) > 0:
+                            out.append((addr, replica, r))
+                return out
+
+            # old copies of ranges with new copies are streamed, copies only in old_ring are deleted after the switch,
+            # copies only in new_ring are deleted if a copy fails
+            copy_list = request_list(old_ring.storage_list, lambda o, n: o if len(n - o) > 0 else frozenset())
+            delete_list = request_list(old_ring.storage_list, lambda o, n: o - n)
+            cleanup_list = request_list(new_ring.storage_list, lambda o, n: n - o)
+
+            out = {}
+            async with self.__blocking(t.path_list):
+                for i, path in enumerate(t.path_list):
+                    result_list = await asyncio.gather(*(
+                        self.__copy_range(path, old_ring, new_ring, addr, replica, r)
+                        for addr, replica, r in copy_list
+                    ), return_exceptions=True)
+                    error = next((e for e in result_list if isinstance(e, BaseException)), None)
+                    if error is not None:
+                        await asyncio.gather(*(
+                            self.__delete_range(copied_path, addr, replica, r)
+                            for copied_path in t.path_list[:i + 1]
+                            for addr, replica, r in cleanup_list
+                        ))
+                        raise error
+                self.storage_list, self.ring = t.storage_list, new_ring
+                failed = []
+                for path in t.path_list:
+                    result_list = await asyncio.gather(*(
+                        self.__delete_range(path, addr, replica, r)
+                        for addr, replica, r in delete_list
+                    ))
+                    out[path] = 0
+                    for (addr, _, _), (status, body) in zip(delete_list, result_list):
+                        if status == 200:
+                            out[path] += body
+                        else:
+                            failed.append(f"{path} on {addr.host}:{addr.port}: {body}")
+                    logger.now().debug(f"rebalance {path}, moved {out[path]} copies")
+            if len(failed) > 0:
+                raise fastapi.HTTPException(
+                    status_code=502, detail=f"routing is switched, moved copies are not deleted: {failed}",
+                )
+            return out
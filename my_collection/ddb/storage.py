@@ -1,16 +1,23 @@
 from __future__ import annotations
 
+import asyncio
 import base64
+import hashlib
 import json
+import pickle
 from functools import reduce
-from typing import Any, Dict, Tuple
+from typing import Any, Dict, Tuple, Union, Optional, Iterator, List, Callable
 
 import dill
 import fastapi
 import plyvel
 import pydantic
 
-from my_collection import http
+from my_collection import http, transform
+from my_collection.ddb import index, ring, wire
+from my_collection.ddb.cache import LRU
+from my_collection.ddb.pool import Pool
+from my_collection.ddb.ring import Addr
 from my_collection.transform import t_map, t_filter
 
 
@@ -20,20 +27,168 @@ class TransformRequest(pydantic.BaseModel):
     reduce_init: Any
 
 
+class ScanRequest(pydantic.BaseModel):
+    transform_func: Optional[str] = None  # base64 of transform.Transform from and into (key, val) pairs
+
+
+class QueryRequest(pydantic.BaseModel):
+    field: str
+    op: str  # one of index.OP_LIST
+    value: Any
+
+
+class MapReduceRequest(pydantic.BaseModel):
+    map_func: str  # base64 of transform.Transform from values into (key, val) pairs
+    reduce_func: str  # base64 of Callable[[Any, Any], Any], merges values of a key from all storages
+    combine_func: Optional[str] = None  # base64 of Callable[[Any, Any], Any], merges values of a key in a storage
+
+
+class MapRequest(MapReduceRequest):
+    job: str
+    partition: int  # partition of the storage receiving the request
+    partition_list: List[Addr]  # storage of each partition
+
+
+class RangeRequest(pydantic.BaseModel):
+    range_list: List[Tuple[int, int]]  # sorted disjoint (lo, hi] of ring.hash of path?key=, see ring.moved_range_list
+
+
+class Versioned(pydantic.BaseModel):
+    version: int = 0  # 0 if the key is missing or was not written with a version
+    deleted: bool = False
+    val: Any = None
+
+
+def data_key(path: str, key: str, replica: bool = False) -> bytes:
+    """
+    primary copies are under path?key=, seen by read, scan and transform,
+    replica copies are under path?replica=, seen only by replica endpoints
+    """
+    return f"{path}?{'replica' if replica else 'key'}={key}".encode("utf-8")
+
+
+def version_key(path: str, key: str) -> bytes:
+    """
+    version of the copy of key in the storage, json of {"version": int, "deleted": bool}
+    """
+    return f"{path}?version={key}".encode("utf-8")
+
+
+def transform_key(transform_id: str) -> bytes:
+    """
+    wire [transform] of a registered transform
+    """
+    return f"?transform={transform_id}".encode("utf-8")
+
+
+def transform_id_of(b: bytes) -> str:
+    """
+    id of a registered transform, hash of its wire [transform]
+    """
+    return hashlib.sha256(b).hexdigest()
+
+
+def partition_of(key: Any, n: int) -> int:
+    """
+    partition of a map reduce key, the same in every process unlike builtin hash
+    """
+    return ring.hash(repr(key)) % n
+
+
+def in_range_of(path: str, t: RangeRequest) -> Callable[[str], bool]:
+    """
+    :return: whether a key of path is in the ranges of t
+    """
+    lo_list, hi_list = [lo for lo, _ in t.range_list], [hi for _, hi in t.range_list]
+    return lambda key: ring.in_range(ring.hash(f"{path}?key={key}"), lo_list, hi_list)
+
+
+def range_key_iter(sn, path: str, replica: bool, t: RangeRequest) -> Iterator[str]:
+    """
+    keys of copies of path in the role of replica in the snapshot whose hash is in the ranges of t
+    """
+    in_range = in_range_of(path, t)
+    prefix = data_key(path, "", replica)
+    for key_b in sn.iterator(prefix=prefix, include_value=False):
+        key = key_b[len(prefix):].decode("utf-8")
+        if in_range(key):
+            yield key
+
+
 ctx = http.Router()
 
 
 class Storage(http.Server):
-    def __init__(self, db_path: str, *args, **kwargs):
+    index_map: Dict[str, List[str]]  # path -> indexed fields, loaded on first use
+    shuffle_map: Dict[str, List[bytes]]  # map reduce job -> pickle of partitions received from storages
+    seq_map: Dict[str, int]  # path -> number of writes to primary copies since start
+    transform_cache: LRU  # transform id -> (transform_func, reduce_func, reduce_init)
+    result_cache: LRU  # (transform id, path) -> json of result, stamped by seq_map of path
+
+    def __init__(self, db_path: str, *args, transform_cache_size: int = 128, result_cache_size: int = 1 << 26,
+                 **kwargs):
+        """
+        :param transform_cache_size: number of registered transforms kept loaded
+        :param result_cache_size: byte budget of results of registered transforms
+        """
         super(Storage, self).__init__(ctx)
         self.db = plyvel.DB(db_path, create_if_missing=True, *args, **kwargs)
+        self.index_map = {}
+        self.shuffle_map = {}
+        self.seq_map = {}
+        self.transform_cache = LRU(transform_cache_size)
+        self.result_cache = LRU(result_cache_size)
+        self.pool = Pool()  # to other storages, for map reduce
+        self.app.on_event("shutdown")(self.pool.close)
+
+    def __index_list(self, path: str) -> List[str]:
+        index_list = self.index_map.get(path, None)
+        if index_list is None:
+            b = self.db.get(index.list_key(path))
+            index_list = [] if b is None else json.loads(b)
+            self.index_map[path] = index_list
+        return index_list
+
+    def __put(self, wb, path: str, key: str, val_b: Optional[bytes], replica: bool = False,
+              written: Optional[Dict[bytes, Optional[bytes]]] = None):
+        """
+        put val_b into the write batch, delete if None,
+        index entries of primary copies are updated in the same write batch,
+        cached results of path are invalidated
+
+        :param written: data key -> val_b put into the write batch so far, for a batch writing a key more than once
+        """
+        if not replica:
+            self.seq_map[path] = self.seq_map.get(path, 0) + 1
+        index_list = [] if replica else self.__index_list(path)
+        if len(index_list) > 0:
+            if written is not None and data_key(path, key) in written:
+                old_b = written[data_key(path, key)]
+            else:
+                old_b = self.db.get(data_key(path, key))
+            old = None if old_b is None else json.loads(old_b)
+            new = None if val_b is None else json.loads(val_b)
+            for field in index_list:
+                old_entry, new_entry = index.entry(path, field, key, old), index.entry(path, field, key, new)
+                if old_entry == new_entry:
+                    continue
+                if old_entry is not None:
+                    wb.delete(old_entry)
+                if new_entry is not None:
+                    wb.put(new_entry, b"")
+        if val_b is None:
+            wb.delete(data_key(path, key, replica))
+        else:
+            wb.put(data_key(path, key, replica), val_b)
+        if written is not None:
+            written[data_key(path, key, replica)] = val_b
 
     @ctx.http_method(ctx.method_get, "/query/{path:path}")
     async def get(self,
                   path: str = fastapi.Path(default=None),
                   key: str = fastapi.Query(default=None),
                   ):
-        out = self.db.get(f"{path}?key={key}".encode("utf-8"))
+        out = self.db.get(data_key(path, key))
         if out is None:
             return None
         return json.loads(out)
@@ -44,23 +199,215 @@ class Storage(http.Server):
                    key: str = fastapi.Query(default=None),
                    val: Any = fastapi.Body(default=None),
                    ):
-        self.db.put(f"{path}?key={key}".encode("utf-8"), json.dumps(val).encode("utf-8"))
+        wb = self.db.write_batch()
+        self.__put(wb, path, key, json.dumps(val).encode("utf-8"))
+        wb.write()
 
     @ctx.http_method(ctx.method_delete, "/query/{path:path}")
     async def delete(self,
                      path: str = fastapi.Path(default=None),
                      key: str = fastapi.Query(default=None),
                      ):
-        self.db.delete(f"{path}?key={key}".encode("utf-8"))
+        wb = self.db.write_batch()
+        self.__put(wb, path, key, None)
+        wb.write()
+
+    def __get_versioned(self, path: str, key: str, replica: bool, sn=None) -> Versioned:
+        """
+        :param sn: snapshot to read from, the db if None
+        """
+        db = self.db if sn is None else sn
+        val_b = db.get(data_key(path, key, replica))
+        version_b = db.get(version_key(path, key))
+        version = {} if version_b is None else json.loads(version_b)
+        if version.get("deleted", False):
+            return Versioned(version=version["version"], deleted=True)
+        if val_b is None:
+            # version may be of a copy in the other role before the ring changed
+            return Versioned()
+        return Versioned(version=version.get("version", 0), val=json.loads(val_b))
+
+    def __is_newer(self, path: str, key: str, replica: bool, v: Versioned) -> bool:
+        """
+        whether v is newer than the stored copy, a copy of version 0 is written only if the stored copy is missing
+        """
+        stored = self.__get_versioned(path, key, replica)
+        if v.version != stored.version:
+            return v.version > stored.version
+        return not v.deleted and not stored.deleted and self.db.get(data_key(path, key, replica)) is None
+
+    def __put_versioned(self, wb, path: str, key: str, replica: bool, v: Versioned):
+        self.__put(wb, path, key, None if v.deleted else json.dumps(v.val).encode("utf-8"), replica)
+        wb.put(version_key(path, key), json.dumps({"version": v.version, "deleted": v.deleted}).encode("utf-8"))
+
+    @ctx.http_method(ctx.method_get, "/replica/{path:path}")
+    async def get_versioned(self,
+                            path: str = fastapi.Path(default=None),
+                            key: str = fastapi.Query(default=None),
+                            replica: bool = fastapi.Query(default=False),
+                            ) -> Versioned:
+        return self.__get_versioned(path, key, replica)
+
+    @ctx.http_method(ctx.method_post, "/replica/{path:path}")
+    async def post_versioned(self,
+                             path: str = fastapi.Path(default=None),
+                             key: str = fastapi.Query(default=None),
+                             replica: bool = fastapi.Query(default=False),
+                             v: Versioned = fastapi.Body(default=None),
+                             ) -> bool:
+        """
+        write or delete if v is newer than the stored copy, last writer wins
+
+        :return: whether v is applied
+        """
+        if not self.__is_newer(path, key, replica, v):
+            return False
+        wb = self.db.write_batch()
+        self.__put_versioned(wb, path, key, replica, v)
+        wb.write()
+        return True
+
+    @ctx.http_method(ctx.method_post, "/versioned/{path:path}")
+    async def write_versioned(self,
+                              path: str = fastapi.Path(default=None),
+                              replica: bool = fastapi.Query(default=False),
+                              data: Dict[str, Versioned] = fastapi.Body(default=None),
+                              ) -> int:
+        """
+        write or delete copies of path in the role of replica that are newer than the stored copies
+
+        :return: number of copies applied
+        """
+        wb = self.db.write_batch()
+        num_applied = 0
+        for key, v in data.items():
+            if self.__is_newer(path, key, replica, v):
+                self.__put_versioned(wb, path, key, replica, v)
+                num_applied += 1
+        wb.write()
+        return num_applied
+
+    @ctx.http_method(ctx.method_post, "/range/{path:path}")
+    async def read_range(self,
+                         path: str = fastapi.Path(default=None),
+                         replica: bool = fastapi.Query(default=False),
+                         t: RangeRequest = fastapi.Body(default=None),
+                         ):
+        """
+        stream wire [copies] of path in the role of replica whose hash is in the ranges of t from a snapshot,
+        with their version, deleted keys in the ranges are streamed as their tombstone
+        """
+        sn = self.db.snapshot()
+
+        def chunk_iter() -> Iterator[bytes]:
+            def copy_iter() -> Iterator[Tuple[str, Versioned]]:
+                for key in range_key_iter(sn, path, replica, t):
+                    yield key, self.__get_versioned(path, key, replica, sn)
+                in_range = in_range_of(path, t)
+                prefix = version_key(path, "")
+                for key_b, version_b in sn.iterator(prefix=prefix):
+                    key = key_b[len(prefix):].decode("utf-8")
+                    version = json.loads(version_b)
+                    if version["deleted"] and sn.get(data_key(path, key, replica)) is None and in_range(key):
+                        yield key, Versioned(version=version["version"], deleted=True)
+
+            yield from wire.batch(
+                wire.encode_frames([json.dumps([key, v.dict()]).encode("utf-8")]) for key, v in copy_iter()
+            )
+
+        return fastapi.responses.StreamingResponse(chunk_iter(), media_type=wire.CONTENT_TYPE)
+
+    @ctx.http_method(ctx.method_delete, "/range/{path:path}")
+    async def delete_range(self,
+                           path: str = fastapi.Path(default=None),
+                           replica: bool = fastapi.Query(default=False),
+                           t: RangeRequest = fastapi.Body(default=None),
+                           ) -> int:
+        """
+        delete copies of path in the role of replica whose hash is in the ranges of t,
+        their versions are kept for the copies in the other role
+
+        :return: number of copies deleted
+        """
+        sn = self.db.snapshot()
+        wb = self.db.write_batch()
+        num_deleted = 0
+        for key in range_key_iter(sn, path, replica, t):
+            self.__put(wb, path, key, None, replica)
+            num_deleted += 1
+        wb.write()
+        return num_deleted
+
+    @ctx.http_method(ctx.method_post, "/registry")
+    async def register(self,
+                       t: bytes = fastapi.Body(default=None),
+                       ) -> str:
+        """
+        register a transform for /transform by id, t is bytes of wire [transform]
+
+        :return: transform id, see transform_id_of
+        """
+        wire.decode_transform(t)
+        transform_id = transform_id_of(t)
+        self.db.put(transform_key(transform_id), t)
+        return transform_id
+
+    @ctx.http_method(ctx.method_get, "/registry/{transform_id}")
+    async def get_registered(self,
+                             transform_id: str = fastapi.Path(default=None),
+                             ):
+        """
+        :return: wire [transform] of a registered transform
+        """
+        t = self.db.get(transform_key(transform_id))
+        if t is None:
+            raise fastapi.HTTPException(status_code=404, detail=f"transform {transform_id} is not registered")
+        return fastapi.Response(content=t, media_type=wire.CONTENT_TYPE)
+
+    def __load_transform(self, transform_id: str) -> Tuple[transform.Transform, Callable[[Any, Any], Any], Any]:
+        loaded = self.transform_cache.get(transform_id)
+        if loaded is None:
+            t = self.db.get(transform_key(transform_id))
+            if t is None:
+                raise fastapi.HTTPException(status_code=404, detail=f"transform {transform_id} is not registered")
+            transform_b, reduce_b, init_b = wire.decode_transform(t)
+            loaded = dill.loads(transform_b), dill.loads(reduce_b), json.loads(bytes(init_b))
+            self.transform_cache.put(transform_id, loaded)
+        return loaded
 
     @ctx.http_method(ctx.method_post, "/transform/{path:path}")
     async def transform(self,
                         path: str = fastapi.Path(default=None),
-                        t: TransformRequest = fastapi.Body(default=None),
+                        t: Union[TransformRequest, bytes, None] = fastapi.Body(default=None),
+                        transform_id: Optional[str] = fastapi.Query(default=None),
                         ):
-        transform_func = dill.loads(base64.b64decode(t.transform_func))
-        reduce_func = dill.loads(base64.b64decode(t.reduce_func))
+        """
+        t is bytes of wire [transform] in binary protocol
+
+        if transform_id is given, t is ignored, the registered transform is run, its result is cached
+        until the next write to path
+        """
+        if transform_id is not None:
+            seq = self.seq_map.get(path, 0)
+            out_b = self.result_cache.get((transform_id, path), seq)
+            if out_b is None:
+                transform_func, reduce_func, reduce_init = self.__load_transform(transform_id)
+                out_b = json.dumps(self.__transform(path, transform_func, reduce_func, reduce_init)).encode("utf-8")
+                self.result_cache.put((transform_id, path), out_b, seq, len(out_b))
+            return fastapi.Response(content=out_b, media_type="application/json")
+
+        if isinstance(t, bytes):
+            transform_b, reduce_b, init_b = wire.decode_transform(t)
+            transform_func, reduce_func = dill.loads(transform_b), dill.loads(reduce_b)
+            reduce_init = json.loads(bytes(init_b))
+        else:
+            transform_func = dill.loads(base64.b64decode(t.transform_func))
+            reduce_func = dill.loads(base64.b64decode(t.reduce_func))
+            reduce_init = t.reduce_init
+        return self.__transform(path, transform_func, reduce_func, reduce_init)
 
+    def __transform(self, path: str, transform_func: transform.Transform, reduce_func: Callable[[Any, Any], Any],
+                    reduce_init: Any) -> Any:
         sn = self.db.prefixed_db(f"{path}?key=".encode("utf-8")).snapshot()
 
         @t_map
@@ -68,30 +415,99 @@ class Storage(http.Server):
             return json.loads(kv[1])
 
         func = transform_func * kv_to_val
-        out = reduce(reduce_func, func(sn.iterator()), t.reduce_init)
+        out = reduce(reduce_func, func(sn.iterator()), reduce_init)
         return out
 
+    @ctx.http_method(ctx.method_post, "/scan/{path:path}")
+    async def scan(self,
+                   path: str = fastapi.Path(default=None),
+                   t: Union[ScanRequest, bytes, None] = fastapi.Body(default=None),
+                   accept: str = fastapi.Header(default=None),
+                   ):
+        """
+        stream (key, val) pairs of path in key order from a snapshot, in chunks of wire.SCAN_CHUNK pairs
+
+        - transform_func filters or projects pairs before they are sent
+        - t is bytes of wire [scan] in binary protocol
+        """
+        transform_func = None
+        if isinstance(t, bytes) and len(t) > 0:
+            transform_func = dill.loads(t)
+        if isinstance(t, ScanRequest) and t.transform_func is not None:
+            transform_func = dill.loads(base64.b64decode(t.transform_func))
+        binary = wire.is_binary(accept)
+        sn = self.db.prefixed_db(f"{path}?key=".encode("utf-8")).snapshot()
+
+        def chunk_iter() -> Iterator[bytes]:
+            if transform_func is None:
+                # stored values are sent as is
+                if binary:
+                    chunk_list = (wire.encode_frames(kv) for kv in sn.iterator())
+                else:
+                    chunk_list = (
+                        b"[" + json.dumps(key.decode("utf-8")).encode("utf-8") + b"," + val + b"]\n"
+                        for key, val in sn.iterator()
+                    )
+            else:
+                kv_iter = transform_func((key.decode("utf-8"), json.loads(val)) for key, val in sn.iterator())
+                if binary:
+                    chunk_list = (
+                        wire.encode_frames((key.encode("utf-8"), json.dumps(val).encode("utf-8")))
+                        for key, val in kv_iter
+                    )
+                else:
+                    chunk_list = (json.dumps([key, val]).encode("utf-8") + b"\n" for key, val in kv_iter)
+            yield from wire.batch(chunk_list)
+
+        return fastapi.responses.StreamingResponse(
+            chunk_iter(),
+            media_type=wire.CONTENT_TYPE if binary else wire.NDJSON_CONTENT_TYPE,
+        )
+
     @ctx.http_method(ctx.method_get, "/file/{path:path}")
     async def read(self,
                    path: str = fastapi.Path(default=None),
+                   accept: str = fastapi.Header(default=None),
                    ):
         sn = self.db.prefixed_db(f"{path}?key=".encode("utf-8")).snapshot()
 
+        if wire.is_binary(accept):
+            # stored values are sent as is
+            return fastapi.Response(
+                content=wire.encode_frames(frame for kv in sn.iterator() for frame in kv),
+                media_type=wire.CONTENT_TYPE,
+            )
+
         @t_map
         def kv_to_keyval(kv: Tuple[bytes, bytes]) -> Tuple[str, Any]:
-            return kv[0].decode("utf-8").split("?")[1][len("key="):], json.loads(kv[1])
+            # keys of prefixed db are without prefix
+            return kv[0].decode("utf-8"), json.loads(kv[1])
 
         return {key: val for key, val in kv_to_keyval(sn.iterator())}
 
     @ctx.http_method(ctx.method_post, "/file/{path:path}")
     async def write(self,
                     path: str = fastapi.Path(default=None),
-                    data: Dict[str, Any] = fastapi.Body(default=None),
+                    data: Union[Dict[str, Any], bytes] = fastapi.Body(default=None),
+                    replica: bool = fastapi.Query(default=False),
+                    version: Optional[int] = fastapi.Query(default=None),
                     ):
+        """
+        data is bytes of wire [items] in binary protocol
 
+        :param replica: write replica copies
+        :param version: version of all keys, overwritten regardless of their stored version
+        """
         wb = self.db.write_batch()
-        for key, val in data.items():
-            wb.put(f"{path}?key={key}".encode("utf-8"), json.dumps(val).encode("utf-8"))
+        written = {}
+        if isinstance(data, bytes):
+            item_iter = ((key, bytes(val)) for key, val in wire.decode_items(data))
+        else:
+            item_iter = ((key, json.dumps(val).encode("utf-8")) for key, val in data.items())
+        for key, val_b in item_iter:
+            self.__put(wb, path, key, val_b, replica, written)
+            if version is not None:
+                wb.put(version_key(path, key), json.dumps({"version": version, "deleted": False}).encode("utf-8"))
 
         wb.write()
 
@@ -99,15 +515,164 @@ class Storage(http.Server):
     async def remove(self,
                      path: str = fastapi.Path(default=None),
                      ):
-        db = self.db.prefixed_db(f"{path}?key=".encode("utf-8"))
-        sn = db.snapshot()
-
-        @t_map
-        def kv_to_key(kv: Tuple[bytes, bytes]) -> str:
-            return kv[0].decode("utf-8")
+        sn = self.db.snapshot()
+        self.seq_map[path] = self.seq_map.get(path, 0) + 1
 
-        wb = db.write_batch()
-        for key, val in kv_to_key(sn.iterator()):
-            if key.split("?")[0] == path:
+        wb = self.db.write_batch()
+        for prefix in ("key", "replica", "version", "index"):
+            for key in sn.iterator(prefix=f"{path}?{prefix}=".encode("utf-8"), include_value=False):
                 wb.delete(key)
         wb.write()
+
+    @ctx.http_method(ctx.method_get, "/index/{path:path}")
+    async def get_index(self,
+                        path: str = fastapi.Path(default=None),
+                        ) -> List[str]:
+        return self.__index_list(path)
+
+    @ctx.http_method(ctx.method_post, "/index/{path:path}")
+    async def create_index(self,
+                           path: str = fastapi.Path(default=None),
+                           field: str = fastapi.Query(default=None),
+                           ):
+        """
+        index field of primary copies of path, existing primary copies are indexed in the same write batch
+        """
+        index_list = self.__index_list(path)
+        if field in index_list:
+            return
+        sn = self.db.prefixed_db(data_key(path, "")).snapshot()
+        wb = self.db.write_batch()
+        for key, val_b in sn.iterator():
+            entry = index.entry(path, field, key.decode("utf-8"), json.loads(val_b))
+            if entry is not None:
+                wb.put(entry, b"")
+        wb.put(index.list_key(path), json.dumps(index_list + [field]).encode("utf-8"))
+        wb.write()
+        self.index_map[path] = index_list + [field]
+
+    @ctx.http_method(ctx.method_delete, "/index/{path:path}")
+    async def drop_index(self,
+                         path: str = fastapi.Path(default=None),
+                         field: str = fastapi.Query(default=None),
+                         ):
+        index_list = self.__index_list(path)
+        if field not in index_list:
+            return
+        wb = self.db.write_batch()
+        for entry in self.db.iterator(prefix=index.prefix(path, field), include_value=False):
+            wb.delete(entry)
+        index_list = [f for f in index_list if f != field]
+        wb.put(index.list_key(path), json.dumps(index_list).encode("utf-8"))
+        wb.write()
+        self.index_map[path] = index_list
+
+    @ctx.http_method(ctx.method_post, "/select/{path:path}")
+    async def select(self,
+                     path: str = fastapi.Path(default=None),
+                     q: QueryRequest = fastapi.Body(default=None),
+                     ) -> Dict[str, Any]:
+        """
+        primary copies of path whose field matches op value, see index for the order of values,
+        by the index on field if there is one, by a scan otherwise
+        """
+        if q.op not in index.OP_LIST:
+            raise fastapi.HTTPException(status_code=400, detail=f"unknown op {q.op}, expected one of {index.OP_LIST}")
+        if index.encode_value(q.value) is None:
+            raise fastapi.HTTPException(status_code=400, detail=f"value of type {type(q.value).__name__} is not indexed")
+        if q.field not in self.__index_list(path):
+            sn = self.db.prefixed_db(data_key(path, "")).snapshot()
+            out = {}
+            for key, val_b in sn.iterator():
+                val = json.loads(val_b)
+                if isinstance(val, dict) and q.field in val and index.match(val[q.field], q.op, q.value):
+                    out[key.decode("utf-8")] = val
+            return out
+        start, stop = index.bounds(path, q.field, q.op, q.value)
+        sn = self.db.snapshot()
+        value_start = len(index.prefix(path, q.field))
+        out = {}
+        for entry in sn.iterator(start=start, stop=stop, include_value=False):
+            key = index.key_of(entry, value_start)
+            out[key] = json.loads(sn.get(data_key(path, key)))
+        return out
+
+    @ctx.http_method(ctx.method_post, "/map/{path:path}")
+    async def map_partition(self,
+                            path: str = fastapi.Path(default=None),
+                            m: MapRequest = fastapi.Body(default=None),
+                            ) -> List[int]:
+        """
+        map phase of a map reduce job on primary copies of path
+
+        - values of the same key are combined, keys are partitioned by partition_of
+        - partitions are sent to their storages by /shuffle concurrently, it returns after all are received
+        - partitions are data, pickle is used instead of dill which is much slower on large dicts
+
+        :return: number of keys of each partition
+        """
+        map_func = dill.loads(base64.b64decode(m.map_func))
+        combine_func = dill.loads(base64.b64decode(m.reduce_func if m.combine_func is None else m.combine_func))
+        sn = self.db.prefixed_db(data_key(path, "")).snapshot()
+        n = len(m.partition_list)
+
+        def map_combine() -> List[Dict[Any, Any]]:
+            partition_list = [{} for _ in range(n)]
+            for key, val in map_func(json.loads(val_b) for val_b in sn.iterator(include_key=False)):
+                partition = partition_list[partition_of(key, n)]
+                partition[key] = combine_func(partition[key], val) if key in partition else val
+            return partition_list
+
+        # in a thread, partitions sent by other storages meanwhile are received
+        partition_list = await asyncio.get_running_loop().run_in_executor(None, map_combine)
+
+        async def send(i: int, partition: Dict[Any, Any]):
+            if len(partition) == 0:
+                return
+            if i == m.partition:
+                self.shuffle_map.setdefault(m.job, []).append(pickle.dumps(partition))
+                return
+            await self.pool.call("POST", m.partition_list[i], f"/shuffle/{m.job}", data=pickle.dumps(partition),
+                                 headers={"Content-Type": wire.CONTENT_TYPE})
+
+        await asyncio.gather(*(send(i, partition) for i, partition in enumerate(partition_list)))
+        return [len(partition) for partition in partition_list]
+
+    @ctx.http_method(ctx.method_post, "/shuffle/{job}")
+    async def shuffle(self,
+                      job: str = fastapi.Path(default=None),
+                      partition: bytes = fastapi.Body(default=None),
+                      ):
+        """
+        partition is pickle of a dict sent by the map phase of another storage
+        """
+        self.shuffle_map.setdefault(job, []).append(partition)
+
+    @ctx.http_method(ctx.method_delete, "/shuffle/{job}")
+    async def drop_shuffle(self,
+                           job: str = fastapi.Path(default=None),
+                           ):
+        self.shuffle_map.pop(job, None)
+
+    @ctx.http_method(ctx.method_post, "/reduce/{job}")
+    async def reduce_partition(self,
+                               job: str = fastapi.Path(default=None),
+                               reduce_b: bytes = fastapi.Body(default=None),
+                               ):
+        """
+        reduce phase of a map reduce job, reduce_b is dill of reduce_func
+
+        :return: wire [partitions] of the partition of the storage
+        """
+        reduce_func = dill.loads(reduce_b)
+        partition_b_list = self.shuffle_map.pop(job, [])
+
+        def reduce_all() -> bytes:
+            out = {}
+            for partition_b in partition_b_list:
+                for key, val in pickle.loads(partition_b).items():
+                    out[key] = reduce_func(out[key], val) if key in out else val
+            return pickle.dumps(out)
+
+        out_b = await asyncio.get_running_loop().run_in_executor(None, reduce_all)
+        return fastapi.Response(content=wire.encode_frames([out_b]), media_type=wire.CONTENT_TYPE)
@@ -0,0 +1,127 @@
+"""
+binary wire format of ddb, used instead of json if the request has Content-Type CONTENT_TYPE
+or the response is requested by Accept CONTENT_TYPE
+
+    [frames] = (<length> bytes)...
+    [items]  = [frames] of key, value, key, value, ...
+    [transform] = [frames] of transform_func, reduce_func, reduce_init
+    [scan] = transform_func, empty if there is no transform_func
+    [partitions] = [frames] of pickle dicts, results of map reduce
+    [copies] = [frames] of json [key, versioned], copies of keys moved by rebalance
+
+    - <length> is unsigned LEB128 varint
+    - key is utf-8, value is json encoded by the client and stored as is by the storage
+    - transform_func and reduce_func are raw dill bytes, reduce_init is json
+    - [items] of many storages concatenate into [items], so do [partitions]
+    - scan streams [items] in binary protocol, ndjson lines [key, value] otherwise
+"""
+
+from typing import Iterable, Iterator, List, Tuple, Union
+
+from my_collection.buffer_db.codec import encode_varint, decode_varint
+
+CONTENT_TYPE = "application/x-ddb-frames"
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+SCAN_CHUNK = 256  # number of pairs per chunk of a scan stream
+STREAM_CHUNK_SIZE = 1 << 16  # bytes read at once from a scan stream
+
+
+def is_binary(content_type: str) -> bool:
+    return content_type is not None and content_type.split(";")[0].strip() == CONTENT_TYPE
+
+
+def encode_frames(frame_list: Iterable[Union[bytes, memoryview]]) -> bytes:
+    out = bytearray()
+    for frame in frame_list:
+        encode_varint(out, len(frame))
+        out += frame
+    return bytes(out)
+
+
+def decode_frames(b: bytes) -> Iterator[memoryview]:
+    """
+    frames are views into b
+    """
+    m = memoryview(b)
+    i = 0
+    while i < len(m):
+        try:
+            length, i = decode_varint(m, i)
+        except IndexError:
+            raise Exception("truncated frame length")
+        if i + length > len(m):
+            raise Exception("truncated frame")
+        yield m[i:i + length]
+        i += length
+
+
+def encode_items(items: Iterable[Tuple[str, bytes]]) -> bytes:
+    return encode_frames(frame for key, value in items for frame in (key.encode("utf-8"), value))
+
+
+def batch(chunk_iter: Iterable[bytes], size: int = SCAN_CHUNK) -> Iterator[bytes]:
+    """
+    join every size chunks into one
+    """
+    chunk_list = []
+    for chunk in chunk_iter:
+        chunk_list.append(chunk)
+        if len(chunk_list) >= size:
+            yield b"".join(chunk_list)
+            chunk_list = []
+    if len(chunk_list) > 0:
+        yield b"".join(chunk_list)
+
+
+def decode_complete(buffer: bytearray) -> List[bytes]:
+    """
+    decode and remove complete frames at the start of buffer, the rest waits for the next chunk of a stream
+    """
+    frame_list = []
+    i = 0
+    while i < len(buffer):
+        try:
+            length, j = decode_varint(buffer, i)
+        except IndexError:
+            break  # length is in the next chunk
+        if j + length > len(buffer):
+            break
+        frame_list.append(bytes(buffer[j:j + length]))
+        i = j + length
+    del buffer[:i]
+    return frame_list
+
+
+def decode_stream(chunk_iter: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    decode frames from chunks of a stream, frames may span many chunks
+    """
+    buffer = bytearray()
+    for chunk in chunk_iter:
+        buffer += chunk
+        yield from decode_complete(buffer)
+    if len(buffer) > 0:
+        raise Exception("truncated frame")
+
+
+def _pair(frames: Iterator[Union[bytes, memoryview]]) -> Iterator[Tuple[str, Union[bytes, memoryview]]]:
+    for key in frames:
+        value = next(frames, None)
+        if value is None:
+            raise Exception("key without value")
+        yield bytes(key).decode("utf-8"), value
+
+
+def decode_items(b: bytes) -> Iterator[Tuple[str, memoryview]]:
+    return _pair(decode_frames(b))
+
+
+def decode_item_stream(chunk_iter: Iterable[bytes]) -> Iterator[Tuple[str, bytes]]:
+    return _pair(decode_stream(chunk_iter))
+
+
+def decode_transform(b: bytes) -> List[memoryview]:
+    frame_list = list(decode_frames(b))
+    if len(frame_list) != 3:
+        raise Exception(f"transform has {len(frame_list)} frames, expected 3")
+    return frame_list